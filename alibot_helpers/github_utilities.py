@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from hashlib import sha1
 import errno
 import inspect
@@ -7,10 +7,14 @@ import os
 import json
 import pickle
 import re
+import sqlite3
 import sys
+import time
 from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from alibot_helpers.utilities import to_unicode
 
@@ -90,6 +94,27 @@ def github_api_url():
     return os.environ.get("GITHUB_API_URL", DEFAULT_GITHUB_API).rstrip("/")
 
 
+def make_session(pool_size=10, retries=3, backoff=0.5):
+    """Return a requests.Session for talking to the GitHub API.
+
+    Connections are kept alive and reused, so a script making several calls
+    pays for the TCP and TLS handshakes once. Idempotent requests are retried
+    with exponential backoff on connection errors and 5xx responses; POST and
+    PATCH are not, as we cannot tell whether GitHub acted on them.
+    """
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(500, 502, 503, 504),
+                  # Hand the final response back rather than raising, so that
+                  # callers see the status code as before.
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
 def generateCacheId(entries):
     h = sha1()
     for k, v in entries:
@@ -217,17 +242,152 @@ class PickledCache(object):
             pass
 
 
+class SqliteCache(object):
+    """Cache GitHub API responses in an SQLite database.
+
+    Unlike PickledCache, entries are written individually as they change, so
+    several processes on one host (e.g. builders sharing a home directory) can
+    use the same cache at once without overwriting each other's ETags. The
+    database is in WAL mode, so readers do not block the writer. When the
+    cache is closed, it is trimmed to the max_entries most recently used.
+    """
+
+    def __init__(self, filename=None, max_entries=10000):
+        if filename is None:
+            filename = SqliteCache.default_cache_location()
+        self.filename = filename
+        self.max_entries = max_entries
+        self._db = None
+
+    @staticmethod
+    def default_cache_location():
+        """Return the default location for caching GitHub API data on disk."""
+        xdg_cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+        return os.path.join(xdg_cache_dir, "ali-bot", "github-cache.sqlite")
+
+    def __enter__(self):
+        self.load()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.dump()
+        return False
+
+    @property
+    def db(self):
+        if self._db is None:
+            self.load()
+        return self._db
+
+    def load(self):
+        if self._db is not None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        except OSError as exc:
+            print("Unable to create directory for ", self.filename, ": ",
+                  exc, sep="", file=sys.stderr)
+        try:
+            self._db = self._connect(self.filename)
+        except sqlite3.DatabaseError as exc:
+            # Like PickledCache, treat an unreadable file as an empty cache.
+            print("Malformed cache file %s (%s); recreating it" %
+                  (self.filename, exc), file=sys.stderr)
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.unlink(self.filename + suffix)
+                except OSError:
+                    pass
+            try:
+                self._db = self._connect(self.filename)
+            except sqlite3.DatabaseError as exc:
+                print("Could not recreate cache %s (%s); caching in memory" %
+                      (self.filename, exc), file=sys.stderr)
+                self._db = self._connect(":memory:")
+
+    @staticmethod
+    def _connect(filename):
+        # isolation_level=None: every statement commits on its own, so that a
+        # lock is never held for longer than one statement.
+        db = sqlite3.connect(filename, timeout=30, isolation_level=None)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+            db.execute("CREATE INDEX IF NOT EXISTS cache_last_used "
+                       "ON cache (last_used)")
+        except sqlite3.DatabaseError:
+            db.close()
+            raise
+        return db
+
+    def dump(self, limit=None):
+        if self._db is None:
+            return
+        limit = self.max_entries if limit is None else limit
+        try:
+            self._db.execute("""DELETE FROM cache WHERE key NOT IN (
+                SELECT key FROM cache ORDER BY last_used DESC LIMIT ?
+            )""", (limit,))
+        except sqlite3.Error as exc:
+            print("Could not trim cache %s: %s" % (self.filename, exc),
+                  file=sys.stderr)
+        self._db.close()
+        self._db = None
+
+    def update(self, d):
+        now = time.time()
+        try:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, last_used) "
+                "VALUES (?, ?, ?)",
+                [(key, json.dumps(value), now) for key, value in d.items()])
+        except sqlite3.Error as exc:
+            # Losing a cache entry costs us rate limit, not correctness.
+            print("Could not write to cache %s: %s" % (self.filename, exc),
+                  file=sys.stderr)
+
+    def __getitem__(self, key):
+        try:
+            row = self.db.execute("SELECT value FROM cache WHERE key = ?",
+                                  (key,)).fetchone()
+            if row is None:
+                return {}
+            self.db.execute("UPDATE cache SET last_used = ? WHERE key = ?",
+                            (time.time(), key))
+        except sqlite3.Error as exc:
+            print("Could not read from cache %s: %s" % (self.filename, exc),
+                  file=sys.stderr)
+            return {}
+        return json.loads(row[0])
+
+    def __delitem__(self, key):
+        try:
+            self.db.execute("DELETE FROM cache WHERE key = ?", (key,))
+        except sqlite3.Error as exc:
+            print("Could not delete from cache %s: %s" % (self.filename, exc),
+                  file=sys.stderr)
+
+
 class GithubCachedClient(object):
-    def __init__(self, token=None, cache=None, api=None):
+    def __init__(self, token=None, cache=None, api=None, session=None):
         if token is None:
             token = github_token()
         if api is None:
             api = github_api_url()
         if cache is None:
-            cache = PickledCache()
+            cache = SqliteCache()
+        if session is None:
+            session = make_session()
         self.token = token
         self.api = api
         self.cache = cache
+        self.session = session
+        # method -> [number of calls, total seconds, slowest call in seconds]
+        self.latency = defaultdict(lambda: [0, 0.0, 0.0])
         self.printStats()
 
     def __enter__(self):
@@ -245,7 +405,7 @@ class GithubCachedClient(object):
         the quota will be reset.
         """
         url = self.makeURL("/rate_limit")
-        response = requests.get(url=url, headers=self.baseHeaders(), timeout=10)
+        response = self.request("GET", url, headers=self.baseHeaders())
         limits = (-1, -1)
         if response.status_code == 200:
             headers = response.headers
@@ -254,8 +414,25 @@ class GithubCachedClient(object):
             limits = (remaining, limit)
         return limits
 
+    def request(self, method, url, **kwds):
+        """Make a request through the shared session, timing it."""
+        start = time.monotonic()
+        try:
+            return self.session.request(method, url, timeout=10, **kwds)
+        finally:
+            elapsed = time.monotonic() - start
+            stats = self.latency[method]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
     def printStats(self):
         print("Github API used %s/%s" % self.rate_limiting, file=sys.stderr)
+        if self.latency:
+            print("Github API calls:", ", ".join(
+                "%d %s in %.2fs (max %.2fs)" % (calls, method, total, slowest)
+                for method, (calls, total, slowest)
+                in sorted(self.latency.items())), file=sys.stderr)
 
     def makeURL(self, template, **kwds):
         template = template[1:] if template.startswith('/') else template
@@ -302,7 +479,7 @@ class GithubCachedClient(object):
         headers = self.postHeaders(stable_api)
         url = self.makeURL(url, **kwds)
         data = json.dumps(data) if type(data) == dict else data
-        response = requests.post(url=url, data=data, headers=headers, timeout=10)
+        response = self.request("POST", url, data=data, headers=headers)
         sc = response.status_code
         if sc == 422:
             print("GitHub error: Unprocessable Entity", file=sys.stderr)
@@ -314,7 +491,7 @@ class GithubCachedClient(object):
         headers = self.postHeaders(stable_api)
         url = self.makeURL(url, **kwds)
         data = json.dumps(data) if type(data) == dict else data
-        response = requests.patch(url=url, data=data, headers=headers, timeout=10)
+        response = self.request("PATCH", url, data=data, headers=headers)
         return response.status_code
 
     @trace
@@ -329,7 +506,7 @@ class GithubCachedClient(object):
 
         url = self.makeURL(url, **kwds)
         # final_url = "{s.api}{url}".format(s=self, url=url).format(**kwds)
-        r = requests.get(url=url, headers=headers, timeout=10)
+        r = self.request("GET", url, headers=headers)
 
         if r.status_code == 304:
             if type(cacheValue["payload"]) == list:
@@ -0,0 +1,269 @@
+"""Compact tables of S3 keys, and of the dependencies between them.
+
+repo-s3-cleanup and cleanup/repo-s3-cleanup hold every package symlink,
+store tarball and dist symlink of the architectures they clean up in memory
+at once, which on the largest stores is millions of keys. KeyIndex keeps each
+key once and gives it a consecutive integer id; SymlinkTable and
+DependencyGraph store the relationships between keys as arrays of those ids,
+rather than as dicts, sets and tuples of strings.
+
+benchmarks/bench_repo_s3_cleanup.py compares both on generated listings. On
+4 million keys, over the memory the listing itself takes, this analysis peaks
+at 430 MiB where the string-based one took 845 MiB, and takes 10.3s to its
+11.9s.
+"""
+
+import logging
+from array import array
+from itertools import chain, compress, islice
+
+LOG = logging.getLogger(__name__)
+
+# Array typecode for key ids: 4 bytes each, and -1 is free for "none".
+ID_TYPECODE = "i"
+
+
+def zeros(length):
+    """Return an array of length ids, all zero."""
+    return array(ID_TYPECODE, bytes(length * array(ID_TYPECODE).itemsize))
+
+
+class KeyIndex:
+    """Give each distinct string a consecutive integer id.
+
+    Every string is then kept once, however many relationships it is part of.
+    Iterating over the index gives the strings in id order.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._ids = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __getitem__(self, key_id):
+        return self._keys[key_id]
+
+    def intern(self, key):
+        """Return the id of key, giving it the next free one if it is new."""
+        key_id = self._ids.get(key)
+        if key_id is None:
+            key_id = self._ids[key] = len(self._keys)
+            self._keys.append(key)
+        return key_id
+
+    def intern_all(self, keys):
+        """Intern every key in keys; return an array of their ids."""
+        ids = self._ids
+        first_new = len(ids)
+        key_ids = array(ID_TYPECODE, [ids.setdefault(key, len(ids))
+                                      for key in keys])
+        # Ids are never removed, so the dict lists new keys in id order.
+        self._keys.extend(islice(ids, first_new, None))
+        return key_ids
+
+    def get(self, key):
+        """Return the id of key, or None if it was never interned."""
+        return self._ids.get(key)
+
+    def id_of(self, key):
+        """Return the id of key; KeyError if it was never interned."""
+        return self._ids[key]
+
+
+class SymlinkTable:
+    """Where each package symlink points, and which package it belongs to.
+
+    Symlinks are known by their basename, which includes the architecture, so
+    one table covers all architectures. Store keys are interned in the keys
+    index, which a DependencyGraph can share.
+    """
+
+    def __init__(self):
+        self.keys = KeyIndex()
+        self._basenames = KeyIndex()
+        self._packages = KeyIndex()
+        # The target and package ids that go with each basename id.
+        self._target = array(ID_TYPECODE)
+        self._package = array(ID_TYPECODE)
+
+    def __len__(self):
+        return len(self._basenames)
+
+    def add(self, basename, target, package):
+        """Record that basename, in package, points to target."""
+        basename_id = self._basenames.intern(basename)
+        target_id = self.keys.intern(target)
+        package_id = self._packages.intern(package)
+        if basename_id == len(self._target):
+            self._target.append(target_id)
+            self._package.append(package_id)
+        else:
+            self._target[basename_id] = target_id
+            self._package[basename_id] = package_id
+
+    def package(self, basename):
+        """Return the package of the symlink basename; KeyError if unknown."""
+        return self._packages[self._package[self._basenames.id_of(basename)]]
+
+    def target_ids_of_packages(self, packages):
+        """Return a flag per key id, set for targets of the given packages."""
+        wanted = bytearray(len(self._packages))
+        for package in packages:
+            package_id = self._packages.get(package)
+            if package_id is not None:
+                wanted[package_id] = 1
+        flags = bytearray(len(self.keys))
+        for target_id, package_id in zip(self._target, self._package):
+            if wanted[package_id]:
+                flags[target_id] = 1
+        return flags
+
+
+class DependencyGraph:
+    """Pairs of keys where the first needs the second, as arrays of key ids.
+
+    Pairs are stored in runs that share the key that needs the others, which
+    is how dist directories produce them.
+    """
+
+    def __init__(self, keys=None):
+        self.keys = KeyIndex() if keys is None else keys
+        # Run r says that _ups[r] needs _downs[_bounds[r]:_bounds[r + 1]].
+        self._ups = array(ID_TYPECODE)
+        self._bounds = array(ID_TYPECODE, [0])
+        self._downs = array(ID_TYPECODE)
+
+    def __len__(self):
+        return len(self._downs)
+
+    def add_ids(self, up, downs):
+        """Record that the key with id up needs those with the ids in downs."""
+        if not downs:
+            return
+        self._downs.extend(downs)
+        if self._ups and self._ups[-1] == up:
+            self._bounds[-1] = len(self._downs)
+        else:
+            self._ups.append(up)
+            self._bounds.append(len(self._downs))
+
+    def blocked_by(self, deleting):
+        """Return, per key id, the key keeping it from deletion, or -1.
+
+        deleting holds a flag per key id, set for keys to be deleted. A key is
+        blocked if it can be reached from any key that is not, via any chain
+        of pairs; the result names the key before it in one such chain.
+        """
+        ups, bounds, downs = self._ups, self._bounds, self._downs
+        # Sort the runs by the key that needs the others, then find where
+        # each key's runs start; this needs no list per key.
+        runs = array(ID_TYPECODE, sorted(range(len(ups)), key=ups.__getitem__))
+        starts = zeros(len(self.keys) + 1)
+        for up in ups:
+            starts[up + 1] += 1
+        for key_id in range(1, len(starts)):
+            starts[key_id] += starts[key_id - 1]
+
+        blocked_by = array(ID_TYPECODE, [-1]) * len(self.keys)
+        pending = [up for up in set(ups) if not deleting[up]]
+        while pending:
+            up = pending.pop()
+            for run in runs[starts[up]:starts[up + 1]]:
+                for down in downs[bounds[run]:bounds[run + 1]]:
+                    if blocked_by[down] < 0:
+                        blocked_by[down] = up
+                        pending.append(down)
+        return blocked_by
+
+
+def dist_dependencies(dist_symlinks, symlink_table, delete_with_symlinks):
+    """Return the dist symlinks to delete, and the dependency graph.
+
+    dist_symlinks must be a sorted list, so that the symlinks in each
+    TARS/<arch>/dist*/<package>/<package>-<version>/ are consecutive. Each
+    directory makes its package's tarball need the tarballs its symlinks
+    point to. If that tarball is in delete_with_symlinks, the directory is
+    deleted with it, so the tarball also needs the directory's symlinks;
+    only those symlinks are added to the graph's keys, which are shared with
+    symlink_table.
+    """
+    graph = DependencyGraph(symlink_table.keys)
+    keys = symlink_table.keys
+    # This loops over every dist symlink, so avoid method calls per symlink:
+    # look target ids up in symlink_table's arrays directly.
+    target = symlink_table._target
+    basename_ids = symlink_table._basenames._ids
+    # (main tarball id, first index, end index) of each directory to delete.
+    deleted_dirs = []
+    dir_start = main_id = None
+    dir_downs = []
+    delete_dir = False
+    this_dir = main_package = None
+    for index, symlink_key in enumerate(dist_symlinks):
+        symlink_dir, _, basename = symlink_key.rpartition("/")
+        if symlink_dir != this_dir:
+            graph.add_ids(main_id, dir_downs)
+            if delete_dir:
+                deleted_dirs.append((main_id, dir_start, index))
+            this_dir, dir_start, dir_downs, delete_dir = \
+                symlink_dir, index, [], False
+            _, arch, _ = symlink_dir.split("/", 2)
+            main_package = "%s.%s.tar.gz" % (
+                symlink_dir[symlink_dir.rfind("/") + 1:], arch)
+            main_id = target[basename_ids[main_package]]
+        if basename != main_package:
+            dir_downs.append(target[basename_ids[basename]])
+        elif keys[main_id] in delete_with_symlinks:
+            # This dist directory belongs to a tarball that we want to delete
+            # with its symlinks.
+            delete_dir = True
+    graph.add_ids(main_id, dir_downs)
+    if delete_dir:
+        deleted_dirs.append((main_id, dir_start, len(dist_symlinks)))
+
+    # Intern the deleted directories' symlinks all at once.
+    symlinks = list(chain.from_iterable(dist_symlinks[start:end]
+                                        for _, start, end in deleted_dirs))
+    key_ids = keys.intern_all(symlinks)
+    offset = 0
+    for main_id, start, end in deleted_dirs:
+        graph.add_ids(main_id, key_ids[offset:offset + end - start])
+        offset += end - start
+    return set(symlinks), graph
+
+
+def find_deletable(to_delete, dependencies, log=LOG):
+    """Return the keys in to_delete that nothing we keep depends on.
+
+    Each (up, down) pair in dependencies means that `up` needs `down`: a
+    tarball needs its dependencies, and a package's tarball keeps its dist*/
+    symlinks. A key is blocked if it can be reached from any key we keep, via
+    any chain of such pairs; everything else in to_delete can go. Blocked
+    keys are reported to `log`, e.g. the caller's logger.
+    """
+    keys = dependencies.keys
+    deleting = bytearray(len(keys))
+    # Keys that are in no dependency at all can go straight away.
+    deletable = set()
+    for key in to_delete:
+        key_id = keys.get(key)
+        if key_id is None:
+            deletable.add(key)
+        else:
+            deleting[key_id] = 1
+
+    blocked_by = dependencies.blocked_by(deleting)
+    debug = log.isEnabledFor(logging.DEBUG)
+    for key_id in compress(range(len(deleting)), deleting):
+        dependant = blocked_by[key_id]
+        if dependant < 0:
+            deletable.add(keys[key_id])
+        elif debug:
+            log.debug("not deleting %s: needed by %s",
+                      keys[key_id], keys[dependant])
+    return deletable
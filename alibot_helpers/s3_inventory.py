@@ -0,0 +1,276 @@
+"""An inventory of one architecture in the S3 remote store, from one listing.
+
+cleanup/repo-s3-cleanup and update-symlink-manifests need to know what is
+under TARS/<arch>/: the tarballs in store/, the symlinks pointing to them
+(under <package>/ and dist*/) and the manifests that aggregate those symlinks.
+list_inventory() answers all of that from a single recursive listing;
+Inventory.resolve_symlinks() then fills in symlink targets, from the
+manifests where they can be trusted and by reading the symlinks otherwise.
+
+The publisher keeps a leaner index of its own, but builds it with the same
+list_objects(), manifest_entries() and symlink_target_key(). repo-s3-cleanup
+also lists with list_objects(), but only puts package symlinks and manifests
+in an Inventory, as there are far more store tarballs and dist symlinks.
+
+An inventory can be saved as a snapshot, a gzipped JSON file stamped with the
+time of the listing, and read back with load_snapshot(); cleanup/repo-s3-cleanup
+uses this to reuse its listing between dry runs.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, NamedTuple, Optional
+
+from alibot_helpers.s3_utilities import fetch_objects
+
+PACKAGE_MANIFEST_EXT = ".manifest"
+DIST_MANIFEST_EXT = ".manifest.gz"
+DIST_KINDS = ("dist", "dist-direct", "dist-runtime")
+
+# Bump when the snapshot format changes; older snapshots are then ignored.
+SNAPSHOT_VERSION = 1
+
+
+class ObjectInfo(NamedTuple):
+    """What a listing says about one object."""
+    size: int
+    mtime: datetime
+    etag: str
+
+
+def symlink_target_key(symlink_key, target):
+    """Turn the contents of a symlink into the S3 key it points to.
+
+    Targets are either keys from the bucket root (possibly behind some
+    "../"), or paths relative to the top-level directory, e.g.
+    "<arch>/store/...", with or without a leading "../../".
+    """
+    target = target.strip()
+    root = symlink_key.split("/", 1)[0] + "/"
+    if target.lstrip("./").startswith(root):
+        return target.lstrip("./")
+    if not target.startswith("../../"):
+        target = "../../" + target
+    return posixpath.normpath(posixpath.dirname(symlink_key) + "/" + target)
+
+
+def manifest_entries(manifest, body):
+    """Generate (symlink key, target) pairs from a manifest's contents.
+
+    body is the manifest object as stored, i.e. still gzipped for dist
+    manifests. Malformed lines are skipped.
+    """
+    if manifest.endswith(DIST_MANIFEST_EXT):
+        # Lines of "<symlink key>\t<target>".
+        directory = ""
+        body = gzip.decompress(body)
+    else:
+        # Lines of "<symlink basename>\t<target>", for <package>/.
+        directory = manifest[:-len(PACKAGE_MANIFEST_EXT)] + "/"
+    for line in body.decode("utf-8").splitlines():
+        name, sep, target = line.partition("\t")
+        if sep and name and target:
+            yield directory + name, target.rstrip("\r\n")
+
+
+def symlink_etags(target):
+    """Return the ETags a symlink holding `target` may have.
+
+    Symlinks are tiny single-part uploads, so their ETag is the MD5 of their
+    contents; whoever wrote one may or may not have ended it with a newline.
+    """
+    return frozenset('"%s"' % hashlib.md5((target + ending).encode("utf-8"))
+                     .hexdigest() for ending in ("", "\n", "\r\n"))
+
+
+class Inventory:
+    """Objects under one TARS/<arch>/ prefix, sorted by what they are.
+
+    tarballs, symlinks, manifests and others map full S3 keys to ObjectInfo.
+    targets maps symlink keys to the key of the store tarball they point to,
+    for the symlinks that have been resolved so far. listed_at is the time of
+    the listing, in seconds since the epoch.
+    """
+
+    def __init__(self, bucket, prefix, listed_at):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.listed_at = listed_at
+        self.tarballs: Dict[str, ObjectInfo] = {}
+        self.symlinks: Dict[str, ObjectInfo] = {}
+        self.manifests: Dict[str, ObjectInfo] = {}
+        self.others: Dict[str, ObjectInfo] = {}
+        self.targets: Dict[str, str] = {}
+
+    def add(self, key, info):
+        """Record an object, given its full key."""
+        parts = key[len(self.prefix):].split("/")
+        if parts[0] == "store":
+            self.tarballs[key] = info
+        elif key.endswith(PACKAGE_MANIFEST_EXT) or key.endswith(DIST_MANIFEST_EXT):
+            self.manifests[key] = info
+        elif key.endswith(".tar.gz") and (
+                len(parts) == 2 or len(parts) == 4 and parts[0] in DIST_KINDS):
+            self.symlinks[key] = info
+        else:
+            self.others[key] = info
+
+    @property
+    def age(self):
+        """Seconds since the listing was made."""
+        return time.time() - self.listed_at
+
+    def packages(self):
+        """Return the names of packages with a symlink directory."""
+        return sorted({key[len(self.prefix):].split("/", 1)[0]
+                       for key in self.symlinks} - set(DIST_KINDS))
+
+    def package_symlinks(self, package=None):
+        """Return the keys of the symlinks under <prefix><package>/.
+
+        Without a package, return those under every package directory.
+        """
+        if package is None:
+            return [key for key in self.symlinks
+                    if key.count("/") == self.prefix.count("/") + 1]
+        start = "%s%s/" % (self.prefix, package)
+        return [key for key in self.symlinks
+                if key.startswith(start) and "/" not in key[len(start):]]
+
+    def reuse_targets(self, previous):
+        """Take targets from an earlier inventory of the same prefix.
+
+        Only symlinks listed with the same ETag then and now keep their
+        target. Return how many did.
+        """
+        reused = 0
+        for key, target in previous.targets.items():
+            info, old = self.symlinks.get(key), previous.symlinks.get(key)
+            if info is not None and old is not None and \
+               info.etag == old.etag and key not in self.targets:
+                self.targets[key] = target
+                reused += 1
+        return reused
+
+    def resolve_symlinks(self, s3c, keys=None, workers=32, use_manifests=True):
+        """Fill in the targets of the given symlinks (default: all of them).
+
+        The package and dist manifests covering them are read first, and each
+        entry is trusted only if the symlink's listed ETag matches the target the
+        manifest gives, i.e. the symlink has not changed since. Whatever is
+        left is read from the symlinks themselves, `workers` at a time; a
+        symlink deleted since the listing is dropped from the inventory.
+        Return the number of symlinks that had to be read.
+        """
+        wanted = {key for key in (self.symlinks if keys is None else keys)
+                  if key in self.symlinks and key not in self.targets}
+        if use_manifests and wanted:
+            manifests = set()
+            for key in wanted:
+                directory = key[len(self.prefix):].split("/", 1)[0]
+                manifests.add(self.prefix + directory + (
+                    DIST_MANIFEST_EXT if directory in DIST_KINDS
+                    else PACKAGE_MANIFEST_EXT))
+            for manifest, body in fetch_objects(
+                    s3c, self.bucket, sorted(manifests & self.manifests.keys()),
+                    workers=workers, missing_ok=True):
+                if body is None:
+                    continue
+                for link_key, target in manifest_entries(manifest, body):
+                    if link_key in wanted and \
+                       self.symlinks[link_key].etag in symlink_etags(target):
+                        self.targets[link_key] = symlink_target_key(link_key,
+                                                                    target)
+                        wanted.discard(link_key)
+        for link_key, body in fetch_objects(s3c, self.bucket, sorted(wanted),
+                                            workers=workers, missing_ok=True):
+            if body is None:
+                del self.symlinks[link_key]
+                continue
+            self.targets[link_key] = symlink_target_key(
+                link_key, body.decode("utf-8"))
+        return len(wanted)
+
+    def save(self, path):
+        """Write the inventory to a snapshot file at path, atomically.
+
+        Keys are stored relative to the prefix, and modification times in
+        whole seconds, which is all a listing gives anyway.
+        """
+        def objects(group):
+            return [[key[len(self.prefix):], info.size,
+                     int(info.mtime.timestamp()), info.etag.strip('"')]
+                    for key, info in sorted(group.items())]
+
+        snapshot = {
+            "version": SNAPSHOT_VERSION, "bucket": self.bucket,
+            "prefix": self.prefix, "listed_at": self.listed_at,
+            "objects": objects({**self.tarballs, **self.symlinks,
+                                **self.manifests, **self.others}),
+            "targets": {key[len(self.prefix):]: target
+                        for key, target in sorted(self.targets.items())},
+        }
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as tmp:
+            try:
+                with gzip.open(tmp, "wt", encoding="utf-8") as out:
+                    json.dump(snapshot, out, separators=(",", ":"))
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+        os.replace(tmp.name, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read an inventory back from a snapshot written by save()."""
+        with gzip.open(path, "rt", encoding="utf-8") as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            raise ValueError("%s: unsupported snapshot version %r"
+                             % (path, snapshot.get("version")))
+        prefix = snapshot["prefix"]
+        inventory = cls(snapshot["bucket"], prefix, snapshot["listed_at"])
+        for key, size, mtime, etag in snapshot["objects"]:
+            inventory.add(prefix + key, ObjectInfo(
+                size, datetime.fromtimestamp(mtime, timezone.utc), '"%s"' % etag))
+        inventory.targets = {prefix + key: target
+                             for key, target in snapshot["targets"].items()}
+        return inventory
+
+
+def list_objects(s3c, bucket, prefix):
+    """Generate (key, ObjectInfo) for every object under prefix."""
+    for page in s3c.get_paginator("list_objects_v2") \
+                   .paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", ()):
+            yield item["Key"], ObjectInfo(
+                item["Size"], item["LastModified"], item["ETag"])
+
+
+def list_inventory(s3c, bucket, prefix):
+    """List everything under prefix (e.g. "TARS/<arch>/") into an Inventory."""
+    inventory = Inventory(bucket, prefix, time.time())
+    for key, info in list_objects(s3c, bucket, prefix):
+        inventory.add(key, info)
+    return inventory
+
+
+def load_snapshot(path, bucket, prefix, max_age) -> Optional[Inventory]:
+    """Return the inventory saved at path, if it is for the same bucket and
+    prefix and at most max_age seconds old; otherwise None."""
+    try:
+        inventory = Inventory.load(path)
+    except (OSError, ValueError, KeyError, EOFError):
+        return None
+    if (inventory.bucket, inventory.prefix) != (bucket, prefix) or \
+       not 0 <= inventory.age <= max_age:
+        return None
+    return inventory
+
@@ -0,0 +1,156 @@
+"""Helpers shared by the scripts that maintain the S3 remote store."""
+
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import botocore.exceptions
+from botocore.config import Config
+
+LOG = logging.getLogger(__name__)
+
+# The most keys that a single DeleteObjects request may name.
+DELETE_BATCH_SIZE = 1000
+
+# Error codes that mean "try again later" rather than "this will never work".
+RETRYABLE_CODES = frozenset((
+    "SlowDown", "RequestTimeout", "InternalError", "ServiceUnavailable",
+    "500", "502", "503", "504",
+))
+
+
+def s3_client_config(pool_size=10):
+    """Return a botocore Config for a client used by pool_size threads.
+
+    boto3 clients are thread-safe, but keep only max_pool_connections
+    connections open; threads beyond that open and discard a connection for
+    every request. The checksum options need botocore 1.36 or later.
+    """
+    return Config(
+        max_pool_connections=pool_size,
+        request_checksum_calculation="WHEN_REQUIRED",
+        response_checksum_validation="WHEN_REQUIRED",
+    )
+
+
+def is_retryable(exc):
+    """Whether a failed request is worth sending again."""
+    if isinstance(exc, botocore.exceptions.ClientError):
+        return exc.response.get("Error", {}).get("Code") in RETRYABLE_CODES
+    return isinstance(exc, (botocore.exceptions.ConnectionError,
+                            botocore.exceptions.HTTPClientError))
+
+
+def is_missing(exc):
+    """Whether a failed request was for an object that does not exist."""
+    return isinstance(exc, botocore.exceptions.ClientError) and \
+        exc.response.get("Error", {}).get("Code") in ("NoSuchKey", "404")
+
+
+def fetch_object(s3c, bucket, key, retries=3, backoff=0.5, missing_ok=False):
+    """Return the body of an object, retrying transient errors.
+
+    With missing_ok=True, return None for an object that does not exist,
+    rather than raising ClientError.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return s3c.get_object(Bucket=bucket, Key=key)["Body"].read()
+        except Exception as exc:
+            if missing_ok and is_missing(exc):
+                return None
+            if attempt == retries or not is_retryable(exc):
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+
+def fetch_objects(s3c, bucket, keys, workers=32, retries=3, backoff=0.5,
+                  missing_ok=False):
+    """Fetch many small objects concurrently.
+
+    Generate (key, body) pairs in the order of keys, as soon as each one and
+    those before it are in. At most `workers` requests are in flight, and at
+    most a few times that many bodies are held waiting to be consumed, so keys
+    may be a generator over a listing of any size. Each request is retried as
+    fetch_object() does; an error that persists is raised here, in the order
+    the key would have been generated.
+
+    s3c must be thread-safe, as boto3 clients are; give it a pool of at least
+    `workers` connections (see s3_client_config).
+    """
+    keys = iter(keys)
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def fill():
+            for key in keys:
+                window.append((key, pool.submit(fetch_object, s3c, bucket, key,
+                                                retries, backoff, missing_ok)))
+                if len(window) >= 4 * workers:
+                    break
+        try:
+            fill()
+            while window:
+                key, future = window.popleft()
+                body = future.result()
+                fill()
+                yield key, body
+        finally:
+            # Stop early if the caller does not want the rest.
+            for _, future in window:
+                future.cancel()
+
+
+def delete_objects(s3c, bucket, to_delete, *, do_it=False, workers=8, log=LOG):
+    """Delete the given objects, if do_it is true; otherwise only log them.
+
+    Keys are deleted in batches of DELETE_BATCH_SIZE, up to `workers` batches
+    at a time. S3 reports failures per key in its response, so one failed key
+    is logged and makes this return False, but does not stop other deletions.
+    Each deletion and failure is reported to `log`, e.g. the caller's logger.
+    """
+    keys = sorted(to_delete)
+    if not do_it:
+        for item in keys:
+            log.info("would delete: %s", item)
+        return True
+
+    def delete_batch(batch):
+        """Delete one batch of keys; return (deleted count, success)."""
+        try:
+            response = s3c.delete_objects(Bucket=bucket, Delete={
+                "Quiet": False, "Objects": [{"Key": key} for key in batch],
+            })
+        except botocore.exceptions.ClientError as exc:
+            log.error("could not delete %d objects from %s to %s: %s",
+                      len(batch), batch[0], batch[-1], exc)
+            return 0, False
+        unconfirmed = set(batch)
+        for deleted in response.get("Deleted", ()):
+            log.info("deleted: %s", deleted["Key"])
+            unconfirmed.discard(deleted["Key"])
+        for error in response.get("Errors", ()):
+            log.error("error %s for %s: %s", error["Code"], error["Key"],
+                      error["Message"])
+            unconfirmed.discard(error["Key"])
+        for key in sorted(unconfirmed):
+            log.error("no deletion reported for %s", key)
+        return len(response.get("Deleted", ())), \
+            not response.get("Errors") and not unconfirmed
+
+    success = True
+    deleted_count = 0
+    start = time.monotonic()
+    batches = [keys[i:i + DELETE_BATCH_SIZE]
+               for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in as_completed([pool.submit(delete_batch, batch)
+                                    for batch in batches]):
+            batch_deleted, batch_success = future.result()
+            deleted_count += batch_deleted
+            success &= batch_success
+            elapsed = time.monotonic() - start
+            log.info("deleted %d of %d objects (%.0f objects/s)",
+                     deleted_count, len(keys),
+                     deleted_count / elapsed if elapsed else 0)
+    return success
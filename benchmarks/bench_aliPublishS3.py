@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""Benchmark publish/aliPublishS3 sync-dir against the in-memory S3 stand-in.
+
+Generates a synthetic TARS/<arch>/ tree (store tarballs, the package symlink
+directories and dist, dist-direct and dist-runtime) for --archs architectures,
+writes a configuration publishing the newest few top-level packages, and runs
+the script's main() as `aliPublishS3 --dry-run sync-dir`, with the
+PlainFilesystem publisher. boto3 is handed the stand-in, and the symlinks
+read over HTTP are served from it too.
+
+It reports the S3 and HTTP requests made, the time taken by each phase (from
+the script's own TIMING log lines; the fastest of --repeat runs), and the peak
+memory allocated by Python during one more, traced run. --latency charges every
+request a fixed delay, which is closer to production than an in-memory call.
+
+With --manifests, the dist*.manifest.gz files update-symlink-manifests writes
+are generated too, so that the publisher reads those instead of listing the
+dist trees.
+
+The generated tree only depends on the sizes given and --seed, so request
+counts are exactly comparable across changes, and timings roughly so. --json
+saves the results for later comparison. To compare against an older publisher,
+extract it next to the publish script template it reads, and point --script
+at it:
+
+  mkdir /tmp/old && cp publish/pub-file-template.sh /tmp/old/
+  git show HEAD~1:publish/aliPublishS3 > /tmp/old/aliPublishS3
+  python3 benchmarks/bench_aliPublishS3.py --script /tmp/old/aliPublishS3
+"""
+
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from time import time
+from unittest.mock import patch
+from urllib.parse import unquote
+
+import yaml
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test"))
+from s3stub import REPO, FakeS3Client, add_package, load_script
+sys.path.insert(0, REPO)
+
+ARCH = "slc9_x86-64"
+BASE_URL = "https://s3.example.invalid/alibuild-repo/"
+
+
+def populate(s3, packages, versions, deps, seed, arch=ARCH):
+    """Fill s3 with packages x versions, each depending on earlier packages."""
+    rng = random.Random(seed)
+    names = ["Pkg%04d" % i for i in range(packages)]
+    for i, name in enumerate(names):
+        for v in range(versions):
+            pick = rng.sample(names[:i], min(i, deps))
+            add_package(s3, arch, name, "v%d-1" % v,
+                        deps=[(dep, "v%d-1" % rng.randrange(versions))
+                              for dep in pick])
+    return names
+
+
+def write_dist_manifests(s3, arch):
+    """Write dist*.manifest.gz the way update-symlink-manifests does."""
+    for kind in ("dist", "dist-direct", "dist-runtime"):
+        start = "TARS/%s/%s/" % (arch, kind)
+        lines = ["%s\t%s\n" % (key, s3.body(key).decode().rstrip("\n"))
+                 for key in sorted(s3.objects) if key.startswith(start)]
+        s3.add(start.rstrip("/") + ".manifest.gz",
+               gzip.compress("".join(lines).encode()))
+
+
+def architectures(count):
+    return [ARCH] + ["slc%d_x86-64" % (9 - i) for i in range(1, count)]
+
+
+def write_config(path, tmp, archs, include):
+    """Write an aliPublish.conf for sync-dir into tmp."""
+    conf = {
+        "s3_endpoint_url": "https://s3.example.invalid",
+        "s3_bucket": "alibuild-repo",
+        "base_url": BASE_URL,
+        "base_prefix": "TARS",
+        "architectures": {arch: {"dir": arch.replace("_", "-"),
+                                 "include": {name: True for name in include}}
+                          for arch in archs},
+        "package_dir": os.path.join(tmp, "%(arch)s/Packages/%(package)s/%(version)s"),
+        "modulefile": os.path.join(tmp, "%(arch)s/Modules/%(package)s/%(version)s"),
+    }
+    with open(path, "w") as f:
+        yaml.safe_dump(conf, f)
+
+
+class TimingHandler(logging.Handler):
+    """Collect the durations sync() logs in its TIMING lines."""
+
+    def __init__(self):
+        super().__init__()
+        self.phases = {}
+
+    def emit(self, record):
+        if not isinstance(record.msg, str) or not record.msg.startswith("TIMING"):
+            return
+        args = record.args if isinstance(record.args, tuple) else (record.args,)
+        seconds = [arg for arg in args if isinstance(arg, float)]
+        if seconds:
+            # "TIMING: %s: listing bucket took %.1fs" -> "listing bucket", and
+            # summed over architectures.
+            phase = record.msg[len("TIMING: "):].replace("%s: ", "")
+            phase = re.split(r" took|:? %\.1fs", phase)[0]
+            self.phases[phase] = self.phases.get(phase, 0) + seconds[-1]
+
+
+def run_main(script, s3, config):
+    """Run `aliPublishS3 --dry-run sync-dir`; return its TIMING phases."""
+    def fake_get(url, **kwargs):
+        # Symlinks are read over plain HTTP, but it is still a round trip.
+        s3._request("http_get")
+        return type("Response", (), {
+            "status_code": 200,
+            "text": s3.body(unquote(url[len(BASE_URL):])).decode(),
+        })
+
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    timings = TimingHandler()
+    argv = ["aliPublishS3", "--config", config, "--dry-run", "--no-notification",
+            "sync-dir"]
+    try:
+        root.addHandler(timings)
+        # main() logs to a handler on stderr, which it creates on each run.
+        # Older publishers call requests.get() rather than a Session.
+        with contextlib.redirect_stderr(io.StringIO()), \
+             patch.object(sys, "argv", argv), \
+             patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "x",
+                                     "AWS_SECRET_ACCESS_KEY": "x"}), \
+             patch.object(script.boto3, "client", lambda *args, **kw: s3), \
+             patch.object(script.requests, "get", fake_get), \
+             patch.object(script.requests.Session, "get",
+                          lambda session, url, **kwargs: fake_get(url)):
+            rv = script.main()
+    finally:
+        for handler in root.handlers[:]:
+            if handler not in handlers:
+                root.removeHandler(handler)
+    if rv:
+        raise SystemExit("aliPublishS3 sync-dir failed with %r" % rv)
+    return timings.phases
+
+
+def main(args):
+    script = load_script(args.script, "aliPublishS3")
+    s3 = FakeS3Client()
+    archs = architectures(args.archs)
+    for arch in archs:
+        names = populate(s3, args.packages, args.versions, args.deps,
+                         args.seed, arch)
+        if args.manifests:
+            write_dist_manifests(s3, arch)
+    print("generated %d objects for %d architecture(s)"
+          % (len(s3.objects), len(archs)))
+    s3.latency = args.latency
+
+    tmp = tempfile.mkdtemp()
+    try:
+        config = os.path.join(tmp, "aliPublish.conf")
+        # Publish the newest few top-level packages, like a CVMFS config does.
+        write_config(config, tmp, archs, names[-args.include:])
+
+        runs = []
+        for _ in range(args.repeat):
+            s3.reset_calls()
+            start = time()
+            phases = run_main(script, s3, config)
+            phases["main()"] = time() - start
+            runs.append(phases)
+        calls = dict(s3.calls)
+
+        peak = None
+        if args.trace:
+            tracemalloc.start()
+            try:
+                run_main(script, s3, config)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    finally:
+        shutil.rmtree(tmp)
+
+    best = {phase: min(run.get(phase, 0) for run in runs) for phase in runs[0]}
+    print("phases (fastest of %d run(s)):" % len(runs))
+    for phase, seconds in best.items():
+        print("  %-32s %8.3fs" % (phase, seconds))
+    print("requests per run:")
+    for operation, count in sorted(calls.items()):
+        print("  %-32s %8d" % (operation, count))
+    if peak is not None:
+        print("peak memory allocated by Python: %.1f MiB" % (peak / 1024**2))
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("peak RSS of this process:        %.1f MiB" % max_rss)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "phases": best, "requests": calls,
+                       "peak_traced_bytes": peak, "max_rss_mib": max_rss},
+                      f, indent=2, sort_keys=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--script", default="publish/aliPublishS3",
+                        help="publisher to benchmark (default %(default)s)")
+    parser.add_argument("--archs", type=int, default=1,
+                        help="number of architectures to generate")
+    parser.add_argument("--packages", type=int, default=200)
+    parser.add_argument("--versions", type=int, default=20)
+    parser.add_argument("--deps", type=int, default=10,
+                        help="dependencies per package version")
+    parser.add_argument("--include", type=int, default=5,
+                        help="number of top-level packages to publish")
+    parser.add_argument("--manifests", action="store_true",
+                        help="also write the dist manifests the publisher "
+                        "reads instead of listing the dist trees")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every request")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed runs; the fastest is reported")
+    parser.add_argument("--no-trace", dest="trace", action="store_false",
+                        help="skip the extra run measuring peak memory")
+    parser.add_argument("--json", metavar="FILE",
+                        help="also write the results to FILE")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Time publish/aliPublishS3's installed() checks on realistic catalogues.
+
+sync() asks the publisher whether each candidate package is installed. For
+AliEn, that used to scan alimonitor's whole package list (--alien entries) per
+question; for RPMs, a list of every RPM in the repository (--rpms entries).
+Both now build a hashed index once. Each is asked --queries questions, and the
+old way is timed on a sample of them and extrapolated.
+"""
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+from time import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test"))
+from s3stub import REPO, FakeS3Client, load_script
+sys.path.insert(0, REPO)
+from test_aliPublishS3 import (
+    ALIEN_PLATFORMS, BASE_URL, CONN_PARAMS, alien_catalogue, alien_publisher,
+)
+
+
+def report(what, queries, t_new, t_old):
+    print("%-6s indexed:  %.3fs for %d queries" % (what, t_new, queries))
+    print("%-6s scanning: %.2fs (extrapolated; %.0fx slower)"
+          % (what, t_old, t_old / t_new))
+
+
+def bench_alien(script, args, rng):
+    catalogue = alien_catalogue(args.alien, rng)
+    queries = [(rng.choice(ALIEN_PLATFORMS), pkg["name"], pkg["version"])
+               for pkg in rng.choices(catalogue, k=args.queries)]
+    pub = alien_publisher(script, catalogue)
+    start = time()
+    for query in queries:
+        pub.installed(*query)
+    t_new = time() - start
+
+    sample = queries[:args.sample]
+    start = time()
+    for arch, name, version in sample:
+        any(pkg["name"] == name and pkg["version"] == version and
+            arch in pkg["platforms"] for pkg in catalogue)
+    t_old = (time() - start) / len(sample) * len(queries)
+    report("AliEn", len(queries), t_new, t_old)
+
+
+def bench_rpm(script, args, rng):
+    s3 = FakeS3Client()
+    versions = ["v%d-1" % i for i in range(args.rpms)]
+    for version in versions:
+        s3.add("RPMS/el9-x86_64/alisw-O2+%s-1-1.el9-x86_64.rpm" % version)
+    queries = [rng.choice(versions) for _ in range(args.queries)]
+    tmp = tempfile.mkdtemp()
+    try:
+        with patch.object(script, "getcwd", lambda: tmp):
+            pub = script.RPM(publishScriptTpl="", connParams=CONN_PARAMS,
+                             genUpdatableRpms=False, baseUrl=BASE_URL,
+                             s3Client=s3, s3Bucket="alibuild-repo")
+        start = time()
+        for version in queries:
+            pub.installed("el9-x86_64", "O2", version)
+        t_new = time() - start
+
+        # The same keys, looked up in a list as before.
+        remote = list(pub._remoteRpms["el9-x86_64"])
+        sample = queries[:args.sample]
+        start = time()
+        for version in sample:
+            kw = pub._kw(None, "el9-x86_64", "O2", version)
+            "RPMS/el9-x86_64/%s" % kw["rpm"] in remote
+        t_old = (time() - start) / len(sample) * len(queries)
+    finally:
+        shutil.rmtree(tmp)
+    report("RPM", len(queries), t_new, t_old)
+
+
+def main(args):
+    logging.disable(logging.CRITICAL)
+    script = load_script("publish/aliPublishS3", "aliPublishS3")
+    rng = random.Random(args.seed)
+    bench_alien(script, args, rng)
+    bench_rpm(script, args, rng)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--alien", type=int, default=30000,
+                        help="packages in the AliEn catalogue")
+    parser.add_argument("--rpms", type=int, default=30000,
+                        help="RPMs in the repository")
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--sample", type=int, default=500,
+                        help="queries to time the old way on")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Time how cleanup/repo-s3-cleanup applies its rules to every tarball.
+
+Writes a bucket listing in "s3cmd ls -r" format with --tarballs store tarballs
+and their symlinks, reads it back through MockS3Client, as --repo-listing does,
+and decides what to do with every tarball in the store: once with RuleMatcher,
+and once with the old per-tarball evaluate_rules(), which compiled a regex for
+every package and version pattern of every rule.
+"""
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test"))
+from s3stub import REPO, load_script
+sys.path.insert(0, REPO)
+from test_cleanup_repo_s3_cleanup import (
+    ARCHS, RULES_FILE, load_rules, random_tarballs, reference_evaluate,
+    write_listing,
+)
+
+
+def main(args):
+    logging.disable(logging.CRITICAL)
+    script = load_script("cleanup/repo-s3-cleanup", "cleanup_repo_s3_cleanup")
+    rules = load_rules(script, args.rules)
+    tarballs = random_tarballs(args.tarballs, random.Random(args.seed))
+    packages = {os.path.basename(key): package for package, key, _ in tarballs}
+    tmp = tempfile.mkdtemp()
+    try:
+        listing = os.path.join(tmp, "listing.txt")
+        write_listing(listing, tarballs)
+        with open(listing) as listing_file:
+            s3c = script.MockS3Client(listing_file)
+    finally:
+        shutil.rmtree(tmp)
+    store = [(packages[os.path.basename(key)], key, info.mtime)
+             for arch in ARCHS
+             for key, info in script.list_inventory(
+                 s3c, "alibuild-repo", "TARS/%s/" % arch).tarballs.items()]
+    print("%d rules, %d tarballs" % (len(rules), len(store)))
+
+    start = time()
+    matcher = script.RuleMatcher(rules)
+    decisions = [matcher.evaluate(*tarball) for tarball in store]
+    t_matcher = time() - start
+    print("RuleMatcher:      %.2fs" % t_matcher)
+    start = time()
+    expected = [reference_evaluate(script, rules, *tarball) for tarball in store]
+    t_old = time() - start
+    assert decisions == expected, "results differ"
+    print("evaluate_rules(): %.2fs (%.1fx slower)" % (t_old, t_old / t_matcher))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tarballs", type=int, default=100000)
+    parser.add_argument("--rules", default=RULES_FILE,
+                        help="rules file to apply (default: the real one)")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
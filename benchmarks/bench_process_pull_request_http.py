@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Time permission checks in ci/process-pull-request-http.py on a large PR.
+
+Generates perms.yml with many path rules, then works out who must approve a
+pull request changing many files: once with the per-file, per-rule loop the
+service used to run, and once with PermsIndex. It also times reading the YAML
+files for every PR against PermsLoader, which rereads them only on change.
+"""
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test"))
+from s3stub import load_script
+from test_process_pull_request_http import SERVICE, reference_approvers
+
+
+def main(args):
+    logging.disable(logging.CRITICAL)
+    script = load_script(SERVICE, "process_pull_request_http")
+    script.Approvers.usermap = {}
+    rng = random.Random(args.seed)
+    dirs = ["Detectors/D%02d/Sub%02d" % (i, j)
+            for i in range(args.rules // 10 + 1) for j in range(10)]
+    users = ["user%03d" % i for i in range(100)]
+    tmp = tempfile.mkdtemp()
+    try:
+        files = [os.path.join(tmp, name)
+                 for name in ("perms.yml", "groups.yml", "mapusers.yml")]
+        with open(files[0], "w") as permsf:
+            permsf.write("alisw/O2:\n  rules:\n")
+            for directory in dirs[:args.rules]:
+                permsf.write("    - '^%s/': %s approve=%s\n" % (
+                    directory, rng.choice(users),
+                    ",".join(rng.sample(users, 3))))
+        with open(files[1], "w") as groupsf:
+            groupsf.write("{}\n")
+        with open(files[2], "w") as mapusersf:
+            mapusersf.write("".join("%s: %s\n" % (u, u) for u in users))
+
+        changed = ["%s/src/File%d.cxx" % (rng.choice(dirs), i)
+                   for i in range(args.files)]
+        who = rng.choice(users)
+
+        start = time()
+        for _ in range(args.prs):
+            perms, _, _ = script.load_perms(*files, admins=["an-admin"])
+        t_load = time() - start
+        rules = perms["alisw/O2"]
+        start = time()
+        loader = script.PermsLoader(*files, admins=["an-admin"])
+        for _ in range(args.prs):
+            index = loader()[0]["alisw/O2"]
+        t_cached = time() - start
+
+        start = time()
+        expected = reference_approvers(script, rules, changed, who)
+        t_loop = time() - start
+        start = time()
+        approvers = script.Approvers(users_override=["an-admin"])
+        for num_approve, approve in index.approvals(changed, who):
+            approvers.push(num_approve, approve if isinstance(approve, bool)
+                           else sorted(approve))
+        t_index = time() - start
+    finally:
+        shutil.rmtree(tmp)
+
+    assert str(approvers) == str(expected), "results differ"
+    print("%d rules, %d changed files" % (len(rules), len(changed)))
+    print("load_perms x %d:  %.3fs" % (args.prs, t_load))
+    print("PermsLoader x %d: %.3fs" % (args.prs, t_cached))
+    print("per-rule loop:    %.3fs" % t_loop)
+    print("PermsIndex:       %.3fs (%.1fx faster)" % (t_index, t_loop / t_index))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rules", type=int, default=300)
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--prs", type=int, default=20,
+                        help="number of PRs processed, each loading perms")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
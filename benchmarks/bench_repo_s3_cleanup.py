@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Time repo-s3-cleanup's analysis of a bucket with millions of keys.
+
+Generates the listing that repo-s3-cleanup would see for a store of --tarballs
+package versions: a tarball under store/ and a symlink to it under <package>/
+for each, and its three dist*/ directories, each holding symlinks to it and to
+--deps of the tarballs built before it. --delete of the tarballs are old
+enough to go.
+
+The listing is then analysed as main() does, in a fresh process each time so
+that peak RSS is its own:
+
+- interned: the script's SymlinkTable, get_keys_for_deletion() and
+  find_deletable(), which keep each key once and the relationships between
+  keys in arrays of integer ids;
+- strings: the same algorithm on dicts, sets and lists of (up, down) tuples of
+  key strings, as the script used to hold them.
+
+Both report the peak RSS of the process once the listing alone is in memory,
+and at the end. With --fixed-point, both also check their answer against the
+fixed-point loop in test_repo_s3_cleanup, run on the strings analysis's
+dependency pairs, which is only practical for a few thousand tarballs:
+
+  python3 benchmarks/bench_repo_s3_cleanup.py --tarballs 3000 --fixed-point
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+from collections import defaultdict
+from time import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test"))
+from s3stub import REPO, load_script
+sys.path.insert(0, REPO)
+from test_repo_s3_cleanup import fixed_point_deletable
+
+ARCH = "slc9_x86-64"
+PREFIX = "TARS/%s/" % ARCH
+DISTS = ("dist", "dist-direct", "dist-runtime")
+
+
+def generate(args):
+    """Return (package symlinks, tarballs to delete, sorted dist symlinks).
+
+    Package symlinks are (basename, target, package) triples.
+    """
+    rng = random.Random(args.seed)
+    names = ["Pkg%04d" % (i % args.packages) for i in range(args.tarballs)]
+    basenames = ["%s-v%d-1.%s.tar.gz" % (name, i // args.packages, ARCH)
+                 for i, name in enumerate(names)]
+    store = ["%sstore/%02x/%040x/%s" % (PREFIX, i % 256, rng.getrandbits(160),
+                                        basename)
+             for i, basename in enumerate(basenames)]
+    package_symlinks = list(zip(basenames, store, names))
+    old = set(rng.sample(store, int(args.tarballs * args.delete)))
+    dist_symlinks = []
+    for i, (name, basename) in enumerate(zip(names, basenames)):
+        # Packages only depend on packages built before them.
+        needs = [basenames[j] for j in rng.sample(range(i), min(i, args.deps))]
+        version_dir = basename[:-len(".%s.tar.gz" % ARCH)]
+        for kind in DISTS:
+            dist_dir = "%s%s/%s/%s/" % (PREFIX, kind, name, version_dir)
+            dist_symlinks.extend(dist_dir + dep for dep in [basename] + needs)
+    dist_symlinks.sort()
+    return package_symlinks, old, dist_symlinks
+
+
+def interned(script, package_symlinks, old, dist_symlinks):
+    """Analyse the listing with the script's own structures."""
+    symlinks = script.SymlinkTable()
+    for basename, target, package in package_symlinks:
+        symlinks.add(basename, target, package)
+    consider = symlinks.target_ids_of_packages(
+        {package for _, _, package in package_symlinks})
+    to_delete = {symlinks.keys[key_id] for key_id in map(symlinks.keys.get, old)
+                 if consider[key_id]}
+    to_delete, dependencies = script.get_keys_for_deletion(
+        to_delete, dist_symlinks, symlinks)
+    return to_delete, dependencies, script.find_deletable(to_delete,
+                                                          dependencies)
+
+
+def strings(script, package_symlinks, old, dist_symlinks):
+    """Analyse the listing with dicts and tuples of key strings."""
+    symlink_mapping = {basename: target for basename, target, _
+                       in package_symlinks}
+    package_mapping = {basename: package for basename, _, package
+                       in package_symlinks}
+    packages = {package for _, _, package in package_symlinks}
+    consider = frozenset(target for basename, target in symlink_mapping.items()
+                         if package_mapping[basename] in packages)
+    to_delete = {key for key in old if key in consider}
+
+    symlinks = set()
+    dependencies = []
+    by_dir = defaultdict(list)
+    for key in dist_symlinks:
+        by_dir[key.rpartition("/")[0]].append(key)
+    for symlink_dir, contents in by_dir.items():
+        main = "%s.%s.tar.gz" % (os.path.basename(symlink_dir), ARCH)
+        for key in contents:
+            basename = key.rpartition("/")[2]
+            if basename != main:
+                dependencies.append((symlink_mapping[main],
+                                     symlink_mapping[basename]))
+        if symlink_mapping[main] in to_delete:
+            symlinks.update(contents)
+            dependencies.extend((symlink_mapping[main], key) for key in contents)
+    del by_dir
+    to_delete |= symlinks
+
+    needs = defaultdict(list)
+    for up, down in dependencies:
+        needs[up].append(down)
+    blocked_by = {}
+    pending = [up for up in needs if up not in to_delete]
+    while pending:
+        up = pending.pop()
+        for down in needs.get(up, ()):
+            if down not in blocked_by:
+                blocked_by[down] = up
+                pending.append(down)
+    return to_delete, dependencies, to_delete - blocked_by.keys()
+
+
+def peak_rss():
+    """Return this process's peak RSS in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(analysis, args):
+    """Generate the listing and analyse it; report how long and how big."""
+    logging.disable(logging.CRITICAL)
+    script = load_script("repo-s3-cleanup")
+    listing = generate(args)
+    listing_rss = peak_rss()
+    start = time()
+    to_delete, _, deletable = analysis(script, *listing)
+    elapsed = time() - start
+    rss = peak_rss()
+    if args.fixed_point:
+        # The interned graph gives no pairs back; check against the strings.
+        expected, dependencies, _ = strings(script, *listing)
+        assert to_delete == expected and \
+            deletable == fixed_point_deletable(to_delete, dependencies), \
+            "results differ from the fixed-point loop"
+    return elapsed, listing_rss, rss, len(to_delete), len(deletable)
+
+
+def main(args):
+    context = multiprocessing.get_context("fork")
+    keys = args.tarballs * (2 + len(DISTS) * (1 + args.deps))
+    print("%d tarballs, %d keys in the listing" % (args.tarballs, keys))
+    answers = set()
+    for analysis in (interned, strings):
+        with context.Pool(1) as pool:
+            elapsed, listing_rss, rss, considered, deletable = \
+                pool.apply(run, (analysis, args))
+        answers.add((considered, deletable))
+        print("%-9s %6.2fs, peak RSS %5.0f MiB (%4.0f MiB over the listing); "
+              "%d keys considered, %d deletable"
+              % (analysis.__name__ + ":", elapsed, rss / 2**20,
+                 (rss - listing_rss) / 2**20, considered, deletable))
+    assert len(answers) == 1, "results differ"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tarballs", type=int, default=100000)
+    parser.add_argument("--packages", type=int, default=2000,
+                        help="distinct package names")
+    parser.add_argument("--deps", type=int, default=5,
+                        help="dependencies per package version")
+    parser.add_argument("--delete", type=float, default=0.6,
+                        help="fraction of tarballs old enough to delete")
+    parser.add_argument("--fixed-point", action="store_true",
+                        help="check both answers against the old loop")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Compare one grep_logs call per search with a single scan_logs pass.
+
+Writes synthetic build logs of the given total size, then runs every search in
+report-pr-errors' LOG_SEARCHES both ways and checks that the results agree.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test"))
+from s3stub import load_script
+from test_report_pr_errors import write_log
+
+
+def main(args):
+    script = load_script("report-pr-errors")
+    tmp = tempfile.mkdtemp()
+    try:
+        rng = random.Random(args.seed)
+        logs = script.Logs.__new__(script.Logs)
+        logs.all_logs = []
+        lines_per_log = args.megabytes * 1024 * 1024 // 30 // args.logs
+        for i in range(args.logs):
+            path = os.path.join(tmp, "BUILD", "Pkg%d-latest" % i, "log")
+            write_log(path, lines_per_log, rng, interesting=args.interesting)
+            logs.all_logs.append(path)
+        logs.important_logs = logs.all_logs[-1:]
+        size = sum(map(os.path.getsize, logs.all_logs))
+        print("generated %d logs, %.1f MiB" % (len(logs.all_logs), size / 2**20))
+
+        start = time()
+        separate = {name: logs.grep_logs(s.regex, s.context_before,
+                                         s.context_after, s.main_packages_only,
+                                         s.ignore_log_files)
+                    for name, s in script.LOG_SEARCHES.items()}
+        t_separate = time() - start
+        start = time()
+        combined = logs.scan_logs(script.LOG_SEARCHES)
+        t_combined = time() - start
+    finally:
+        shutil.rmtree(tmp)
+
+    assert separate == combined, "results differ"
+    print("grep_logs x %d: %.2fs" % (len(script.LOG_SEARCHES), t_separate))
+    print("scan_logs:      %.2fs (%.1fx faster)" %
+          (t_combined, t_separate / t_combined))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--megabytes", type=int, default=200,
+                        help="total size of the generated logs")
+    parser.add_argument("--logs", type=int, default=10)
+    parser.add_argument("--interesting", type=float, default=0.001,
+                        help="fraction of lines that match some search")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Time building an S3 inventory of one architecture, and reusing it.
+
+Generates a synthetic TARS/<arch>/ tree in the in-memory S3 stand-in, with
+package and dist manifests covering all but --changed of its symlinks, then
+times and counts the requests for:
+
+- walking it the old way: listing each package directory on its own and
+  reading every symlink, one at a time (timed on a sample and extrapolated);
+- list_inventory() and Inventory.resolve_symlinks(), which list it once and
+  only read the symlinks the manifests do not vouch for;
+- saving that inventory as a snapshot, and load_snapshot() loading it back.
+
+Every request sleeps for --latency seconds.
+"""
+
+import argparse
+import gzip
+import os
+import random
+import sys
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test"))
+from s3stub import REPO, FakeS3Client, add_package, store_key
+sys.path.insert(0, REPO)
+from alibot_helpers.s3_inventory import list_inventory, load_snapshot
+
+ARCH = "slc9_x86-64"
+BUCKET = "alibuild-repo"
+PREFIX = "TARS/%s/" % ARCH
+
+
+def populate(s3, args):
+    rng = random.Random(args.seed)
+    names = ["Pkg%04d" % i for i in range(args.packages)]
+    for i, name in enumerate(names):
+        for v in range(args.versions):
+            add_package(s3, ARCH, name, "v%d-1" % v, deps=[
+                (dep, "v%d-1" % rng.randrange(args.versions))
+                for dep in rng.sample(names[:i], min(i, args.deps))])
+    manifests = {}
+    for key in sorted(s3.objects):
+        rest = key[len(PREFIX):]
+        directory, _, name = rest.partition("/")
+        if directory == "store":
+            continue
+        target = s3.body(key).decode().rstrip("\n")
+        if directory.startswith("dist"):
+            manifests.setdefault(directory + ".manifest.gz", []).append(
+                "%s\t%s\n" % (key, target))
+        else:
+            manifests.setdefault(directory + ".manifest", []).append(
+                "%s\t%s\n" % (name, target))
+    for manifest, lines in manifests.items():
+        body = "".join(lines).encode()
+        s3.add(PREFIX + manifest,
+               gzip.compress(body) if manifest.endswith(".gz") else body)
+    # Symlinks changed since the manifests were written.
+    symlinks = [key for key in s3.objects if key.endswith(".tar.gz")
+                and "/store/" not in key]
+    for key in rng.sample(sorted(symlinks), args.changed):
+        s3.add(key, store_key(ARCH, "Pkg0000", "v0-1") + "\n")
+    return names
+
+
+def walk_old_way(s3, names, sample):
+    """List each package directory, and read every symlink in it."""
+    start = time()
+    reads = 0
+    for name in names[:sample]:
+        for page in s3.get_paginator("list_objects_v2").paginate(
+                Bucket=BUCKET, Prefix="%s%s/" % (PREFIX, name), Delimiter="/"):
+            for item in page.get("Contents", ()):
+                s3.get_object(Bucket=BUCKET, Key=item["Key"])["Body"].read()
+                reads += 1
+    return (time() - start) / sample * len(names), reads
+
+
+def main(args):
+    s3 = FakeS3Client()
+    names = populate(s3, args)
+    print("%d objects under %s, %.0fms per request"
+          % (len(s3.objects), PREFIX, args.latency * 1000))
+    s3.latency = args.latency
+
+    t_old, _ = walk_old_way(s3, names, args.sample)
+    print("per-package listings, reading package symlinks: %.2fs "
+          "(extrapolated from %d packages; %d requests)"
+          % (t_old, args.sample, sum(s3.calls.values())
+             / args.sample * len(names)))
+
+    s3.reset_calls()
+    start = time()
+    inventory = list_inventory(s3, BUCKET, PREFIX)
+    t_list = time() - start
+    print("list_inventory():    %.2fs (%d pages; %d symlinks, %d tarballs)"
+          % (t_list, s3.calls["list_objects_v2"], len(inventory.symlinks),
+             len(inventory.tarballs)))
+
+    s3.reset_calls()
+    start = time()
+    read = inventory.resolve_symlinks(s3, workers=args.workers)
+    t_resolve = time() - start
+    print("resolve_symlinks():  %.2fs (%d manifests and %d symlinks read; "
+          "%d from manifests)"
+          % (t_resolve, s3.calls["get_object"] - read, read,
+             len(inventory.targets) - read))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, "inventory.json.gz")
+        start = time()
+        inventory.save(snapshot)
+        t_save = time() - start
+        start = time()
+        load_snapshot(snapshot, BUCKET, PREFIX, max_age=float("inf"))
+        t_load = time() - start
+        print("snapshot:            %.0f KiB; saved in %.2fs, loaded in %.2fs "
+              "(%.0fx faster than listing)"
+              % (os.path.getsize(snapshot) / 1024, t_save, t_load,
+                 t_list / t_load))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packages", type=int, default=200)
+    parser.add_argument("--versions", type=int, default=20)
+    parser.add_argument("--deps", type=int, default=5,
+                        help="dependencies per package version")
+    parser.add_argument("--changed", type=int, default=100,
+                        help="symlinks changed since the manifests were written")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="seconds per request (default %(default)s)")
+    parser.add_argument("--sample", type=int, default=5,
+                        help="packages to time the old walk on")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
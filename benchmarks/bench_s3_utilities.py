@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Time reading many symlinks from S3, one by one and with fetch_objects().
+
+Every request to the in-memory S3 stand-in sleeps for --latency seconds, which
+is what reading a tiny object costs in production. Reading --objects symlinks
+one at a time costs a round trip each; fetch_objects() overlaps them, up to
+--workers at a time.
+"""
+
+import argparse
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test"))
+from s3stub import REPO, FakeS3Client
+sys.path.insert(0, REPO)
+from alibot_helpers.s3_utilities import fetch_objects
+
+BUCKET = "alibuild-repo"
+
+
+def main(args):
+    s3 = FakeS3Client(latency=args.latency)
+    keys = ["TARS/slc9_x86-64/O2/O2-v%d-1.slc9_x86-64.tar.gz" % i
+            for i in range(args.objects)]
+    for key in keys:
+        s3.add(key, "../../store/00/0000/" + os.path.basename(key) + "\n")
+    print("%d objects, %.0fms per request" % (len(keys), args.latency * 1000))
+
+    sequential = keys[:args.sequential]
+    start = time()
+    for key in sequential:
+        s3.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+    t_old = (time() - start) / len(sequential) * len(keys)
+    print("one by one:       %.2fs (extrapolated from %d objects; "
+          "%.0f objects/s)" % (t_old, len(sequential), len(keys) / t_old))
+
+    for workers in args.workers:
+        start = time()
+        for _ in fetch_objects(s3, BUCKET, keys, workers=workers):
+            pass
+        t_new = time() - start
+        print("%3d workers:      %.2fs (%.0f objects/s; %.0fx faster)"
+              % (workers, t_new, len(keys) / t_new, t_old / t_new))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--objects", type=int, default=20000)
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="seconds per request (default %(default)s)")
+    parser.add_argument("--sequential", type=int, default=500,
+                        help="objects to time the one-by-one reads on")
+    parser.add_argument("--workers", type=int, nargs="+", default=[8, 32, 128])
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Time update-symlink-manifests' dist manifest for one big package.
+
+Uploads --versions versions of O2 to the in-memory S3 stand-in, next to
+--store other tarballs in the store, and builds the dist/ manifest in
+read-only mode. Each directory is checked against the store by tarball name.
+That check used to scan the basename of every store tarball, per directory;
+it is timed on a sample of --old-dirs directories and extrapolated, since
+running it for all of them takes hours at production scale.
+
+The manifest is then written, and updated with nothing changed, which should
+only take the listing and reading the manifest back.
+"""
+
+import argparse
+import logging
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test"))
+from s3stub import REPO, FakeS3Client, load_script
+sys.path.insert(0, REPO)
+from test_update_symlink_manifests import ARCH, BUCKET, big_package
+
+
+class ScanningBasenames:
+    """Answer membership the way the old code did, by scanning the store."""
+
+    def __init__(self, store_tarballs):
+        self.store_tarballs = store_tarballs
+
+    def __contains__(self, name):
+        return name in map(os.path.basename, self.store_tarballs)
+
+
+def main(args):
+    logging.disable(logging.CRITICAL)
+    script = load_script("update-symlink-manifests")
+    s3 = FakeS3Client()
+    dirs = sorted(big_package(s3, args.versions))
+    for i in range(args.store):
+        s3.add("TARS/%s/store/%02x/%040x/Other-v%d-1.%s.tar.gz"
+               % (ARCH, i % 256, i, i, ARCH))
+    store_tarballs = frozenset(script.list_files(
+        s3, BUCKET, "TARS/%s/store/" % ARCH, recursive=True))
+    print("%d dist directories, %d store tarballs"
+          % (len(dirs), len(store_tarballs)))
+
+    start = time()
+    store_basenames = frozenset(map(os.path.basename, store_tarballs))
+    script.build_dist_manifest(s3, BUCKET, store_tarballs, store_basenames,
+                               "TARS/%s/dist/" % ARCH, read_only=True)
+    t_new = time() - start
+    print("basename set:     %.2fs" % t_new)
+
+    sample = dirs[:args.old_dirs]
+    scanning = ScanningBasenames(store_tarballs)
+    start = time()
+    for path in sample:
+        script.get_dist_symlinks_for_package(s3, BUCKET, path, store_tarballs,
+                                             scanning)
+    t_old = (time() - start) / len(sample) * len(dirs)
+    print("basename scan:    %.2fs (extrapolated from %d directories; "
+          "%.0fx slower)" % (t_old, len(sample), t_old / t_new))
+
+    # Write the manifest, then update it: only changes are read and written.
+    for run in ("first write", "unchanged"):
+        s3.reset_calls()
+        start = time()
+        script.build_dist_manifest(s3, BUCKET, store_tarballs, store_basenames,
+                                   "TARS/%s/dist/" % ARCH, read_only=False)
+        print("%-17s %.2fs (%s)" % (run + ":", time() - start, ", ".join(
+            "%d %s" % (count, op) for op, count in sorted(s3.calls.items()))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--versions", type=int, default=20000)
+    parser.add_argument("--store", type=int, default=100000,
+                        help="other tarballs in the store")
+    parser.add_argument("--old-dirs", type=int, default=200,
+                        help="directories to time the old check on")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -4,12 +4,15 @@ from logging import debug, info, warning, error
 from argparse import ArgumentParser
 from os.path import expanduser
 import logging
+import os
 import re
 import json
+import threading
 import yaml
+from concurrent.futures import ThreadPoolExecutor
 from klein import Klein
 from twisted.internet.task import LoopingCall
-from twisted.internet import reactor, threads
+from twisted.internet import reactor
 from time import time
 from metagit import MetaGit,MetaGitException
 
@@ -128,41 +131,7 @@ class State(object):
            pull.changed_files)
       self.approvers.push(1, self.approvers.users_override)
     else:
-      for fn in pull.get_files():
-        debug("determining permissions for file %s" % fn)
-        num_approve_this_file = 1   # 0 is treated specially, see below
-        approvers_for_file = set()
-        for rule in perms:
-          num_approve,approve = rule(fn, pull.who)  # approve can be bool or set (not list)
-          if approve:
-            debug("file %s matched by rule %s: %s" % (fn, rule.path_regexp, approve))
-            # This isn't quite airtight: we're trying to construct an OR-ed
-            # rule here. 1 of {x, y} OR 1 of {a, b} == 1 of {a, b, x, y}, so
-            # this is fine, but e.g. 2 of {x, y, z} OR 1 of {a, b} is not the
-            # same as 2 of {a, b, x, y, z}. If we take num_approve to mean we
-            # need this many approvers in general, not necessarily out of the
-            # specific set given, then this algorithm is fine.
-            if num_approve > 0 and num_approve_this_file > 0:
-              num_approve_this_file = max(num_approve_this_file, num_approve)
-            else:
-              # If num_approve is zero, that means approve is True (not a set),
-              # and we need a num_approve_this_file of zero to go with it.
-              num_approve_this_file = 0
-            # Now compute approvers_for_file = approvers_for_file OR approve.
-            if isinstance(approvers_for_file, bool):
-              if not approvers_for_file:
-                # False OR X is X.
-                approvers_for_file = approve
-              # Other case (approvers_for_file is True): True OR X is True, so
-              # nothing changes.
-            elif isinstance(approve, bool):
-              # We know approve is truthy; x OR True is True.
-              approvers_for_file = True
-            else:
-              # Handle the case where both are sets.
-              approvers_for_file |= approve
-        assert approvers_for_file != set(), \
-          "this should not happen: for file %s no rule matches" % fn
+      for num_approve_this_file, approvers_for_file in perms.approvals(pull.get_files(), pull.who):
         debug("approvers are (n=%d): %r", num_approve_this_file,
               approvers_for_file if isinstance(approvers_for_file, bool)
               else sorted(approvers_for_file))
@@ -374,119 +343,311 @@ class Perms(object):
 
   def __call__(self, path, current_user):
     if self.path_match(path):
-      if current_user in self.authorized:
-        return 0,True
-      else:
-        return self.num_approve,set(self.approve)
+      return self.outcome(current_user)
     return 0,False
 
+  def outcome(self, current_user):
+    # What this rule says about a file it matches
+    if current_user in self.authorized:
+      return 0,True
+    return self.num_approve,set(self.approve)
+
+class PermsIndex(object):
+  """All path rules of one repository, compiled into a single matcher.
+
+  Most rules are a plain path prefix, like ^Detectors/TPC/. Those are looked up
+  by prefix: one dictionary lookup per distinct prefix length, instead of one
+  regular expression search per rule. Only the other rules are searched for,
+  each with its own precompiled expression.
+  """
+
+  # ^ followed by literal text (possibly with escaped punctuation), then
+  # optionally .* or .*$, which match any path anyway.
+  LITERAL_PREFIX = re.compile(r"\^((?:[^.^$*+?{}\[\]\\|()]|\\[^A-Za-z0-9])*)(?:\.\*\$?)?")
+
+  def __init__(self, rules):
+    self.rules = rules
+    self.prefixes = {}    # literal prefix -> indices of its rules
+    self.searched = []    # (index, compiled) of every other rule
+    for i, rule in enumerate(rules):
+      literal = self.LITERAL_PREFIX.fullmatch(rule.path_regexp)
+      if literal:
+        prefix = re.sub(r"\\(.)", r"\1", literal.group(1))
+        self.prefixes.setdefault(prefix, []).append(i)
+        continue
+      try:
+        self.searched.append((i, re.compile(rule.path_regexp)))
+      except re.error as e:
+        warning("path regular expression %s is not valid: %s" % (rule.path_regexp, e))
+    self.lengths = sorted(set(map(len, self.prefixes)))
+
+  def match(self, path):
+    # Indices of the rules matching path, in the order of the rules
+    matched = [ i for length in self.lengths if length <= len(path)
+                for i in self.prefixes.get(path[:length], ()) ]
+    matched.extend(i for i, compiled in self.searched if compiled.search(path))
+    return tuple(sorted(matched))
+
+  def approvals(self, files, who):
+    """Yield (num_approve, approvers) for the files in one pass over them.
+
+    Files matching the same rules need the same approvals, so each distinct
+    outcome is yielded once, in the order it is first met; approvers can be
+    a bool or a set. Pushing an outcome again would not change anything.
+    """
+    seen = set()
+    for fn in files:
+      matched = self.match(fn)
+      if matched in seen:
+        continue
+      seen.add(matched)
+      debug("file %s matched by rules %s" % (fn, [ self.rules[i].path_regexp for i in matched ]))
+      yield self.combine(matched, who, fn)
+
+  def combine(self, matched, who, fn):
+    num_approve_this_file = 1   # 0 is treated specially, see below
+    approvers_for_file = set()
+    for i in matched:
+      num_approve,approve = self.rules[i].outcome(who)  # approve can be bool or set (not list)
+      # This isn't quite airtight: we're trying to construct an OR-ed
+      # rule here. 1 of {x, y} OR 1 of {a, b} == 1 of {a, b, x, y}, so
+      # this is fine, but e.g. 2 of {x, y, z} OR 1 of {a, b} is not the
+      # same as 2 of {a, b, x, y, z}. If we take num_approve to mean we
+      # need this many approvers in general, not necessarily out of the
+      # specific set given, then this algorithm is fine.
+      if num_approve > 0 and num_approve_this_file > 0:
+        num_approve_this_file = max(num_approve_this_file, num_approve)
+      else:
+        # If num_approve is zero, that means approve is True (not a set),
+        # and we need a num_approve_this_file of zero to go with it.
+        num_approve_this_file = 0
+      # Now compute approvers_for_file = approvers_for_file OR approve.
+      if isinstance(approvers_for_file, bool):
+        if not approvers_for_file:
+          # False OR X is X.
+          approvers_for_file = approve
+        # Other case (approvers_for_file is True): True OR X is True, so
+        # nothing changes.
+      elif isinstance(approve, bool):
+        # We know approve is truthy; x OR True is True.
+        approvers_for_file = True
+      else:
+        # Handle the case where both are sets.
+        approvers_for_file |= approve
+    assert approvers_for_file != set(), \
+      "this should not happen: for file %s no rule matches" % fn
+    return num_approve_this_file,approvers_for_file
+
+class PermsLoader(object):
+  """Calls load_perms(), but only again once one of its files has changed.
+
+  Returns the same (perms, tests, usermap) as load_perms(), except that perms
+  maps each repository to a PermsIndex.
+  """
+
+  def __init__(self, f_perms, f_groups, f_mapusers, admins):
+    self.files = (f_perms, f_groups, f_mapusers)
+    self.admins = admins
+    self.lock = threading.Lock()
+    self.signature = None
+    self.loaded = None
+
+  @staticmethod
+  def stat(fn):
+    try:
+      st = os.stat(fn)
+    except OSError:
+      return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+  def __call__(self):
+    with self.lock:
+      signature = tuple(map(self.stat, self.files))
+      if signature != self.signature:
+        info("loading permissions from %s" % ", ".join(self.files))
+        perms,tests,usermap = load_perms(*self.files, admins=self.admins)
+        self.loaded = ({ repo: PermsIndex(rules) for repo, rules in perms.items() },
+                       tests, usermap)
+        self.signature = signature
+      return self.loaded
+
+class PrQueue(object):
+  """Pull requests waiting to be processed, and those being processed.
+
+  Up to `workers` pull requests are processed at once, each by calling
+  process(pr), which returns True when done with it or False to retry it on the
+  next tick(). The same PR is never processed by two workers at once: if it is
+  queued again meanwhile, it waits for the running one to finish.
+  """
+
+  def __init__(self, process, workers):
+    self.process = process
+    self.workers = workers
+    self.pool = ThreadPoolExecutor(max_workers=workers)
+    self.lock = threading.Lock()
+    self.queued = set()
+    self.retry = set()
+    self.running = {}   # pr -> time its processing started
+    self.processed = 0
+    self.requeued = 0
+    self.latency_total = 0.0
+    self.latency_max = 0.0
+
+  def add(self, prs):
+    # Events are accumulated until the next tick(), so that a burst of them for
+    # the same PR is processed once.
+    with self.lock:
+      self.queued.update(prs)
+
+  def tick(self):
+    # Called periodically: start what was queued meanwhile, and give PRs that
+    # could not be processed another chance.
+    with self.lock:
+      self.queued.update(self.retry)
+      self.retry.clear()
+    self.dispatch()
+
+  def dispatch(self):
+    with self.lock:
+      ready = [pr for pr in self.queued if pr not in self.running]
+      ready = ready[:self.workers - len(self.running)]
+      for pr in ready:
+        self.queued.remove(pr)
+        self.running[pr] = time()
+    for pr in ready:
+      self.pool.submit(self.run, pr)
+
+  def run(self, pr):
+    ok = False
+    try:
+      ok = self.process(pr)
+    except Exception as e:
+      error("Uncaught exception processing %s: %s" % (pr, e))
+    with self.lock:
+      latency = time() - self.running.pop(pr)
+      self.processed += 1
+      self.latency_total += latency
+      self.latency_max = max(self.latency_max, latency)
+      if not ok:
+        self.requeued += 1
+        self.retry.add(pr)
+    self.dispatch()
+
+  def running_since(self):
+    # How long the longest-running PR has been processed for, or 0.
+    with self.lock:
+      return time() - min(self.running.values()) if self.running else 0
+
+  def snapshot(self):
+    with self.lock:
+      return {"queued"        : sorted(self.queued | self.retry),
+              "in_progress"   : sorted(self.running),
+              "workers"       : self.workers,
+              "processed"     : self.processed,
+              "requeued"      : self.requeued,
+              "latency_avg_s" : self.latency_total / self.processed if self.processed else 0,
+              "latency_max_s" : self.latency_max}
+
+  def shutdown(self):
+    self.pool.shutdown(wait=False)
+
 class PrRPC(object):
   app = Klein()
-  items = set()
 
   def __init__(self, host, port, bot_user, admins, processQueueEvery, processAllEvery,
-               processStuckThreshold, dummyGit, dryRun):
+               processStuckThreshold, dummyGit, dryRun, workers=4):
     self.bot_user = bot_user
     self.admins = admins
     self.dryRun = dryRun
     self.must_exit = False
-    self.processStartTime = 0
     self.processStuckThreshold = processStuckThreshold
-    self.git = MetaGit.init(backend="Dummy" if dummyGit else "GitHub",
-                            bot_user=bot_user,
-                            store="dummy",
-                            token=open(expanduser("~/.github-token")).read().strip(),
-                            rw=not dryRun)
+    token = open(expanduser("~/.github-token")).read().strip()
+    self.new_git = lambda: MetaGit.init(backend="Dummy" if dummyGit else "GitHub",
+                                        bot_user=bot_user,
+                                        store="dummy",
+                                        token=token,
+                                        rw=not dryRun)
+    # Used from the reactor thread only. Each worker gets its own, see
+    # worker_git().
+    self.git = self.new_git()
+    self.worker_gits = threading.local()
+    self.queue = PrQueue(self.process_pull_request, workers)
+    self.load_perms = PermsLoader("perms.yml", "groups.yml", "mapusers.yml", admins=admins)
 
     def set_must_exit():
       self.must_exit = True
+      self.queue.shutdown()
     reactor.addSystemEventTrigger("before", "shutdown", set_must_exit)
 
-    def schedule_process_pull_requests():
-      items_to_process = self.items.copy()
-      self.items = set()  # empty queue
-      self.processStartTime = time()
-      def resetStartTime(x):
-        self.processStartTime = 0
-      d = threads.deferToThread(self.process_pull_requests, items_to_process,
-                                                            self.bot_user,
-                                                            self.admins,
-                                                            self.dryRun)
-      d.addCallback(lambda unprocessed: self.items.update(unprocessed))  # repush (requeue) unprocessed
-      d.addErrback(lambda x: error("Uncaught exception during pull request test: %s" % str(x)))
-      d.addBoth(lambda x: reactor.callLater(processQueueEvery, schedule_process_pull_requests))
-      d.addBoth(resetStartTime)
-      return d
-
     if processAllEvery <= 0:
       warning("Pull requests will be processed only upon callbacks")
     else:
       reactor.callLater(1, LoopingCall(self.add_all_open_prs).start, processAllEvery)
 
-    reactor.callLater(10, schedule_process_pull_requests)
+    # Accumulate events for a while before the first round, then start queued
+    # PRs every processQueueEvery seconds. While workers are busy, the next
+    # queued PR starts as soon as one is free.
+    reactor.callLater(10, LoopingCall(self.queue.tick).start, processQueueEvery)
     self.app.run(host, port)
 
   def j(self, req, obj):
     req.setHeader("Content-Type", "application/json")
     return json.dumps(obj, default=lambda o: o.__dict__)
 
+  def worker_git(self):
+    # The MetaGit of the calling worker thread, created on first use. Workers
+    # must not share one: its caches and its PyGithub client are not safe to
+    # use from several threads at once.
+    git = getattr(self.worker_gits, "git", None)
+    if git is None:
+      git = self.worker_gits.git = self.new_git()
+    return git
+
   def add_all_open_prs(self):
-    perms,_,_ = load_perms("perms.yml", "groups.yml", "mapusers.yml", admins=args.admins.split(","))
+    perms,_,_ = self.load_perms()
     for repo in perms:
       try:
         newpr = self.git.get_pulls(repo)
-        self.items.update(newpr)
+        self.queue.add(newpr)
         for n in newpr:
           debug("Process all: appending %s" % n)
       except MetaGitException as e:
         warning("Cannot get pulls for %s: %s" % (repo, e))
 
-  # Processes a list of pull requests. Takes as input an iterable of pull requests
-  # in the form Group/Repo#PrNum and returns a set of processed pull requests.
-  def process_pull_requests(self, prs, bot_user, admins, dryRun):
-    info("Processing all scheduled pull requests: %d to go" % len(prs))
-    unprocessed = set(prs)  # keep track of what could not be processed
-
-    # Load permissions as first thing
-    perms,tests,usermap = load_perms("perms.yml", "groups.yml", "mapusers.yml", admins=admins)
-    #debug("permissions:\n"+json.dumps(perms, indent=2, default=lambda o: o.__dict__))
-    #debug("tests:\n"+json.dumps(tests, indent=2))
-    #debug("GitHub to full names mapping:\n"+json.dumps(usermap, indent=2))
-    setattr(Approvers, "usermap", usermap)
+  # Processes a single pull request in the form Group/Repo#PrNum. Returns True if
+  # done with it, or False if it should be processed again later.
+  def process_pull_request(self, pr):
+    if self.must_exit:
+      info("Not processing %s: must exit" % pr)
+      return False
+    repo,prnum = pr.split("#", 1)
+    prnum = int(prnum)
+    debug("Queued PR: %s#%d" % (repo,prnum))
 
-    for pr in prs:
-      if self.must_exit:
-        info("Interrupting loop: must exit")
-        break
-      repo,prnum = pr.split("#", 1)
-      prnum = int(prnum)
-      debug("Queued PR: %s#%d" % (repo,prnum))
-      if repo not in perms:
-        debug("Skipping %s: not a configured repository" % pr)
-        unprocessed.remove(pr)
-        continue
+    # Load permissions as first thing (only reread if changed)
+    perms,tests,usermap = self.load_perms()
+    setattr(Approvers, "usermap", usermap)
+    if repo not in perms:
+      debug("Skipping %s: not a configured repository" % pr)
+      return True
 
-      ok = False
-      try:
-        ok = self.pull_state_machine(pr,
-                                     perms.get(repo, []),
+    try:
+      return self.pull_state_machine(pr,
+                                     perms[repo],
                                      tests.get(repo, []),
-                                     bot_user,
-                                     admins,
-                                     dryRun)
-      except MetaGitException as e:
-        error("Cannot process pull request %s#%d, removing from list: %s" % (repo, prnum, e))
-        ok = True
-      except Exception as e:
-        error("Cannot process pull request %s#%d, retrying, strange error: %s" % (repo, prnum, e))
-
-      # PR can be removed from list
-      if ok:
-        unprocessed.remove(pr)
-    return unprocessed  # empty set in case of full success
+                                     self.bot_user,
+                                     self.admins,
+                                     self.dryRun)
+    except MetaGitException as e:
+      error("Cannot process pull request %s#%d, removing from list: %s" % (repo, prnum, e))
+      return True
+    except Exception as e:
+      error("Cannot process pull request %s#%d, retrying, strange error: %s" % (repo, prnum, e))
+      return False
 
   def pull_state_machine(self, pr, perms, tests, bot_user, admins, dryRun):
-    pull = self.git.get_pull(pr)
+    git = self.worker_git()
+    pull = git.get_pull(pr)
     info("")
     info("~~~ processing %s: %s (changed files: %d) ~~~" % (pr, pull.title, pull.changed_files))
 
@@ -495,24 +656,24 @@ class PrRPC(object):
       return True
 
     if not pull.changed_files:
-      if self.git.get_status(pr, "review") != ("error", "empty pull request"):
-        self.git.add_comment(pr, ("@%s: your pull request changes no files (%s)." + \
-                                  "You may want to fix it or close it.") % \
-                                  (pull.who, pull.sha))
-        self.git.set_status(pr, "review", "error", "empty pull request")
+      if git.get_status(pr, "review") != ("error", "empty pull request"):
+        git.add_comment(pr, ("@%s: your pull request changes no files (%s)." + \
+                             "You may want to fix it or close it.") % \
+                             (pull.who, pull.sha))
+        git.set_status(pr, "review", "error", "empty pull request")
       info("%s: skipping: empty!" % pr)
       return True
 
     if not pull.mergeable:
       if pull.mergeable_state == "dirty":
         # It really cannot be merged. Notify user
-        if self.git.get_status(pr, "review") != ("error", "conflicts"):
-          self.git.add_comment(pr, ("@%s: there are conflicts in your changes (%s) you need to fix.\n\n" + \
-                                    "_You can have a look at the "                                       + \
-                                    "[documentation](http://alisw.github.io/git-advanced/) or you can "  + \
-                                    "press the **Resolve conflicts** button and try to fix them from "   + \
-                                    "the web interface._") % (pull.who, pull.sha))
-          self.git.set_status(pr, "review", "error", "conflicts")
+        if git.get_status(pr, "review") != ("error", "conflicts"):
+          git.add_comment(pr, ("@%s: there are conflicts in your changes (%s) you need to fix.\n\n" + \
+                               "_You can have a look at the "                                       + \
+                               "[documentation](http://alisw.github.io/git-advanced/) or you can "  + \
+                               "press the **Resolve conflicts** button and try to fix them from "   + \
+                               "the web interface._") % (pull.who, pull.sha))
+          git.set_status(pr, "review", "error", "conflicts")
         info("%s: skipping: cannot merge" % pr)
         return True
       else:  # mergeable_state is "unknown"
@@ -526,7 +687,7 @@ class PrRPC(object):
                   haveApproved=[],
                   haveApproved_p2=[])
 
-    for comment in self.git.get_comments(pr):
+    for comment in git.get_comments(pr):
       if (comment.when-pull.when).total_seconds() < 0:
         info("* %s @ %s UTC: %s ==> skipping" % (comment.who, comment.when, comment.short))
         continue
@@ -540,7 +701,7 @@ class PrRPC(object):
           break
 
     info("Final state is %s: executing action" % state)
-    state.action(self.git, pr, perms, tests)
+    state.action(git, pr, perms, tests)
     return True
 
   @app.route("/", methods=["POST"])
@@ -571,43 +732,52 @@ class PrRPC(object):
       prid = int(prid)
       prfull = "%s#%d" % (repo, prid)
       info("Received relevant event (%s) for %s" % (etype, prfull))
-      self.items.add(prfull)
+      self.queue.add([prfull])
     else:
       debug("Received unhandled event from GitHub:\n%s" % json.dumps(data, indent=2))
     return "roger"
 
   @app.route("/list")
   def get_list(self, req):
-    return self.j(req, {"queued": list(self.items)})
+    return self.j(req, {"queued": self.queue.snapshot()["queued"]})
 
   @app.route("/perms")
   def check_loaded_perms(self, req):
-    perms,tests,usermap = load_perms("perms.yml", "groups.yml", "mapusers.yml", admins=self.admins)
-    out = { "perms": perms, "tests": tests, "usermap": usermap }
+    perms,tests,usermap = self.load_perms()
+    out = { "perms": { repo: index.rules for repo, index in perms.items() },
+            "tests": tests, "usermap": usermap }
     return self.j(req, out)
 
   @app.route("/process/all")
   def process_all(self, req):
     self.add_all_open_prs()
-    return self.j(req, {"queued": list(self.items)})
+    return self.j(req, {"queued": self.queue.snapshot()["queued"]})
 
   @app.route("/process/<group>/<repo>/<prid>")
   def process(self, req, group, repo, prid):
     pr = "%s/%s#%d" % (group, repo, int(prid))
-    self.items.add(pr)
+    self.queue.add([pr])
     return self.j(req, {"added_to_queue": pr})
 
   @app.route("/health")
   def health(self, req):
-    runningSince = time()-self.processStartTime if self.processStartTime else 0
+    # A single PR taking this long means a worker is stuck on it.
+    runningSince = self.queue.running_since()
     if runningSince > self.processStuckThreshold:
       req.setResponseCode(500)
       status = "stuck"
     else:
       status = "ok"
+    queue = self.queue.snapshot()
     return self.j(req, {"status"           : status,
                         "running_since"    : runningSince,
-                        "stuck_threshold_s": self.processStuckThreshold })
+                        "stuck_threshold_s": self.processStuckThreshold,
+                        "queued"           : len(queue["queued"]),
+                        "in_progress"      : len(queue["in_progress"]) })
+
+  @app.route("/metrics")
+  def metrics(self, req):
+    return self.j(req, self.queue.snapshot())
 
 # Parse file
 def load_perms(f_perms, f_groups, f_mapusers, admins):
@@ -619,7 +789,8 @@ def load_perms(f_perms, f_groups, f_mapusers, admins):
 
   # Load user mapping (CERN -> GitHub)
   try:
-    mapusers = yaml.safe_load(open(f_mapusers))
+    with open(f_mapusers) as f:
+      mapusers = yaml.safe_load(f)
     for k in mapusers:
       if " " not in mapusers[k]:
         mapusers[k] = mapusers[k] + " " + mapusers[k]
@@ -631,7 +802,8 @@ def load_perms(f_perms, f_groups, f_mapusers, admins):
 
   # Load external groups
   try:
-    groups = yaml.safe_load(open(f_groups))
+    with open(f_groups) as f:
+      groups = yaml.safe_load(f)
     for k in groups:
       groups[k] = groups[k].split()
   except (IOError,yaml.YAMLError) as e:
@@ -639,7 +811,8 @@ def load_perms(f_perms, f_groups, f_mapusers, admins):
 
   # Load permissions
   try:
-    c = yaml.safe_load(open(f_perms))
+    with open(f_perms) as f:
+      c = yaml.safe_load(f)
   except (IOError,yaml.YAMLError) as e:
     error("cannot load permissions from %s: %s" % (f_perms, e))
     c = {}
@@ -737,6 +910,8 @@ if __name__ == "__main__":
                       help="Process all pull requests every that many seconds (0: callbacks only)")
   parser.add_argument("--process-stuck-threshold", dest="processStuckThreshold", default=300, type=int,
                       help="Report as unhealthy if too long in the process loop (defaults 300 s)")
+  parser.add_argument("--workers", dest="workers", default=4, type=int,
+                      help="Process up to that many pull requests at once (defaults 4)")
   parser.add_argument("--dummy-git", dest="dummyGit",
                       action="store_true", default=False,
                       help="Use the dummy Git backend for testing")
@@ -749,6 +924,8 @@ if __name__ == "__main__":
     parser.error("Please specify the GitHub usernames of admins (--admins)")
   if args.processQueueEvery < 5:
     parser.error("--process-queue-every must be at least 5 seconds")
+  if args.workers < 1:
+    parser.error("--workers must be at least 1")
   if args.processAllEvery > 0 and args.processAllEvery < 10:
     parser.error("--process-all-every must be either 0 (disable) or at least 10 seconds")
 
@@ -769,4 +946,5 @@ if __name__ == "__main__":
                 processAllEvery=args.processAllEvery,
                 processStuckThreshold=args.processStuckThreshold,
                 dummyGit=args.dummyGit,
-                dryRun=args.dryRun)
+                dryRun=args.dryRun,
+                workers=args.workers)
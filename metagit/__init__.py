@@ -98,7 +98,8 @@ class MetaGit_Dummy(MetaGit):
 
   def read(self, repo, num):
     try:
-      return yaml.safe_load(self.open(repo, num))
+      with self.open(repo, num) as f:
+        return yaml.safe_load(f)
     except Exception as e:
       raise MetaGitException("Cannot read %s#%s: %s" % (repo, num, e))
 
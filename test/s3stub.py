@@ -0,0 +1,201 @@
+"""An in-memory stand-in for the parts of a boto3 S3 client that we use."""
+
+import bisect
+import hashlib
+import importlib.machinery
+import importlib.util
+import io
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGE_SIZE = 1000
+
+
+def load_script(path, name=None):
+    """Load an extension-less script from the repository as a module."""
+    name = name or os.path.basename(path).replace("-", "_")
+    loader = importlib.machinery.SourceFileLoader(name, os.path.join(REPO, path))
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def no_such_key(operation):
+    return ClientError({"Error": {"Code": "NoSuchKey",
+                                  "Message": "The specified key does not exist."}},
+                       operation)
+
+
+class FakeS3Client:
+    """Serve a single bucket's worth of objects from memory."""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = Counter()
+        self.objects = {}       # key -> (body, LastModified, ETag)
+        self._sorted = None
+        self._lock = threading.Lock()
+
+    # ---- fixture helpers; not counted as requests ----------------------------
+
+    def add(self, key, body=b"", mtime=None):
+        """Create or replace an object, as a test fixture would."""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        mtime = mtime or datetime.now(timezone.utc)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        with self._lock:
+            if key not in self.objects:
+                self._sorted = None
+            self.objects[key] = (body, mtime, etag)
+
+    def remove(self, key):
+        with self._lock:
+            if self.objects.pop(key, None) is not None:
+                self._sorted = None
+
+    def body(self, key):
+        return self.objects[key][0]
+
+    def reset_calls(self):
+        self.calls.clear()
+
+    # ---- the boto3 API ------------------------------------------------------
+
+    def _request(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _keys(self):
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted(self.objects)
+            return self._sorted
+
+    def get_paginator(self, operation):
+        if operation != "list_objects_v2":
+            raise NotImplementedError(operation)
+        return self
+
+    def paginate(self, Bucket, Prefix="", Delimiter=None, **_):
+        keys = self._keys()
+        start = bisect.bisect_left(keys, Prefix)
+        page = {"Contents": [], "CommonPrefixes": []}
+        last_prefix = None
+        pages = 0
+        # Index rather than slice: a slice copies the rest of the bucket.
+        for index in range(start, len(keys)):
+            key = keys[index]
+            if not key.startswith(Prefix):
+                break
+            cut = key.find(Delimiter, len(Prefix)) if Delimiter else -1
+            if cut != -1:
+                prefix = key[:cut + 1]
+                if prefix == last_prefix:
+                    continue
+                last_prefix = prefix
+                page["CommonPrefixes"].append({"Prefix": prefix})
+            else:
+                _, mtime, etag = self.objects[key]
+                page["Contents"].append({
+                    "Key": key, "LastModified": mtime, "ETag": etag,
+                    "Size": len(self.objects[key][0]),
+                })
+            if len(page["Contents"]) + len(page["CommonPrefixes"]) == PAGE_SIZE:
+                self._request("list_objects_v2")
+                pages += 1
+                yield page
+                page = {"Contents": [], "CommonPrefixes": []}
+        # S3 answers an empty listing with one empty page, not with nothing.
+        if page["Contents"] or page["CommonPrefixes"] or not pages:
+            self._request("list_objects_v2")
+            yield page
+
+    def get_object(self, Bucket, Key, **_):
+        self._request("get_object")
+        try:
+            body, mtime, etag = self.objects[Key]
+        except KeyError:
+            raise no_such_key("GetObject") from None
+        return {"Body": io.BytesIO(body), "LastModified": mtime, "ETag": etag,
+                "ContentLength": len(body)}
+
+    def head_object(self, Bucket, Key, **_):
+        self._request("head_object")
+        try:
+            body, mtime, etag = self.objects[Key]
+        except KeyError:
+            raise no_such_key("HeadObject") from None
+        return {"LastModified": mtime, "ETag": etag, "ContentLength": len(body)}
+
+    def put_object(self, Bucket, Key, Body, **_):
+        self._request("put_object")
+        self.add(Key, Body.read() if hasattr(Body, "read") else Body)
+        return {"ETag": self.objects[Key][2]}
+
+    def copy_object(self, CopySource, Bucket, Key, **_):
+        self._request("copy_object")
+        self.add(Key, self.objects[CopySource["Key"]][0])
+
+    def delete_objects(self, Bucket, Delete):
+        self._request("delete_objects")
+        deleted = []
+        for obj in Delete["Objects"]:
+            self.remove(obj["Key"])
+            deleted.append({"Key": obj["Key"]})
+        return {"Deleted": deleted}
+
+    def download_file(self, Bucket, Key, Filename, Callback=None, **_):
+        self._request("get_object")
+        try:
+            body = self.objects[Key][0]
+        except KeyError:
+            raise no_such_key("GetObject") from None
+        with open(Filename, "wb") as f:
+            f.write(body)
+        if Callback is not None:
+            Callback(len(body))
+
+    def upload_file(self, Filename, Bucket, Key, **_):
+        self._request("put_object")
+        with open(Filename, "rb") as f:
+            self.add(Key, f.read())
+
+
+def store_key(arch, name, version, prefix="TARS"):
+    """Return where aliBuild uploads the tarball for a package version."""
+    tarball = "%s-%s.%s.tar.gz" % (name, version, arch)
+    digest = hashlib.sha1(tarball.encode("utf-8")).hexdigest()
+    return "%s/%s/store/%s/%s/%s" % (prefix, arch, digest[:2], digest, tarball)
+
+
+def add_package(s3, arch, name, version, deps=(), mtime=None, prefix="TARS"):
+    """Upload a package version the way aliBuild lays it out in the store.
+
+    That is: the tarball under store/, a symlink to it under <package>/, and
+    a dist, dist-direct and dist-runtime directory each holding symlinks to the
+    package itself and to every (name, version) pair in `deps`.
+    """
+    def symlink(dep_name, dep_version):
+        return store_key(arch, dep_name, dep_version, prefix) + "\n"
+
+    tarball = "%s-%s.%s.tar.gz" % (name, version, arch)
+    s3.add(store_key(arch, name, version, prefix), b"tarball " + tarball.encode(),
+           mtime=mtime)
+    s3.add("%s/%s/%s/%s" % (prefix, arch, name, tarball),
+           symlink(name, version), mtime=mtime)
+    for kind in ("dist", "dist-direct", "dist-runtime"):
+        for dep_name, dep_version in ((name, version),) + tuple(deps):
+            s3.add("%s/%s/%s/%s/%s-%s/%s-%s.%s.tar.gz" % (
+                prefix, arch, kind, name, name, version,
+                dep_name, dep_version, arch,
+            ), symlink(dep_name, dep_version), mtime=mtime)
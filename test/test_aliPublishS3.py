@@ -0,0 +1,719 @@
+"""Tests for publish/aliPublishS3's sync() and RPM publisher, run on s3stub."""
+
+import gzip
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from urllib.parse import unquote
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from s3stub import FakeS3Client, add_package, load_script, store_key
+
+ARCH = "slc9_x86-64"
+BASE_URL = "https://s3.example.invalid/alibuild-repo/"
+CONN_PARAMS = {"http_ssl_verify": True, "conn_timeout_s": 6.05,
+               "conn_retries": 3, "conn_dethrottle_s": 0}
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+
+
+def patch_session_get(script, fake_get):
+    """Serve the symlinks sync() reads through its requests.Session."""
+    return patch.object(script.requests.Session, "get",
+                        lambda session, url, **kwargs: fake_get(url, **kwargs))
+
+
+class SyncTestBase(unittest.TestCase):
+    """Run sync() on a few packages; the tests are in subclasses."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script("publish/aliPublishS3", "aliPublishS3")
+        self.s3 = FakeS3Client()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        add_package(self.s3, ARCH, "zlib", "v1.3-1")
+        add_package(self.s3, ARCH, "ROOT", "v6-30-1", deps=[("zlib", "v1.3-1")])
+        add_package(self.s3, ARCH, "O2", "v1.0.0-1",
+                    deps=[("ROOT", "v6-30-1"), ("zlib", "v1.3-1")])
+        add_package(self.s3, ARCH, "O2", "v2.0.0-1",
+                    deps=[("ROOT", "v6-30-1"), ("zlib", "v1.3-1")])
+        self.http_gets = []
+
+    def fake_get(self, url, **kwargs):
+        self.http_gets.append(url)
+        return FakeResponse(self.s3.body(unquote(url[len(BASE_URL):])).decode())
+
+    def run_sync(self, include, exclude=None, auto_include_deps=True, limit=0,
+                 use_manifests=True, manifest_grace=timedelta(days=1)):
+        """Run sync() and return the (name, version, deps) it installed."""
+        pub = self.script.PlainFilesystem(
+            modulefileTpl=os.path.join(self.tmp, "%(package)s/%(version)s.mod"),
+            pkgdirTpl=os.path.join(self.tmp, "%(arch)s/%(package)s/%(version)s"),
+            publishScriptTpl="", connParams=CONN_PARAMS, dryRun=True)
+        installs = []
+        pub.install = lambda url, arch, name, ver, deps, allDeps: \
+            installs.append((name, ver, sorted(d["name"] for d in allDeps))) or 0
+        rules = {"include": {ARCH: include}, "exclude": {ARCH: exclude or {}}}
+        with patch_session_get(self.script, self.fake_get):
+            ok = self.script.sync(
+                pub=pub, architectures={ARCH: "el9-x86_64"}, s3Client=self.s3,
+                bucket="alibuild-repo", baseUrl=BASE_URL, basePrefix="TARS",
+                rules=rules, autoIncludeDeps=auto_include_deps, notifEmail={},
+                dryRun=True, connParams=CONN_PARAMS, publishLimit=limit,
+                useManifests=use_manifests, manifestGrace=manifest_grace)
+        self.assertTrue(ok)
+        return installs
+
+
+class PublisherTestCase(SyncTestBase):
+    def test_dependencies_are_pulled_in(self):
+        installs = self.run_sync({"O2": ["^v2"]})
+        self.assertEqual(installs, [
+            ("O2", "v2.0.0-1", ["ROOT", "zlib"]),
+            ("ROOT", "v6-30-1", ["zlib"]),
+            ("zlib", "v1.3-1", []),
+        ])
+
+    def test_exclude_rules_apply(self):
+        installs = self.run_sync({"O2": True}, exclude={"O2": ["^v1"]})
+        self.assertEqual([(n, v) for n, v, _ in installs],
+                         [("O2", "v2.0.0-1"), ("ROOT", "v6-30-1"),
+                          ("zlib", "v1.3-1")])
+
+    def test_without_auto_include_deps_only_matches_are_installed(self):
+        installs = self.run_sync({"ROOT": True}, auto_include_deps=False)
+        self.assertEqual(installs, [("ROOT", "v6-30-1", ["zlib"])])
+
+    def test_incomplete_uploads_are_not_published(self):
+        """aliBuild uploads the store tarball last; until then, leave it."""
+        add_package(self.s3, ARCH, "O2", "v3.0.0-1", deps=[("zlib", "v1.3-1")])
+        self.s3.remove([key for key in self.s3.objects
+                        if "/store/" in key and "v3.0.0-1" in key][0])
+        installs = self.run_sync({"O2": ["^v3"]})
+        self.assertEqual(installs, [])
+
+    def test_the_bucket_is_listed_once(self):
+        """Discovery must not cost a listing per package, version or kind.
+
+        Without dist manifests, that is one listing of TARS/<arch>/, after
+        looking for the three manifests."""
+        self.run_sync({"O2": True})
+        self.assertEqual(self.s3.calls["list_objects_v2"], 1)
+        self.assertEqual(self.s3.calls["get_object"], 3)
+
+    def test_the_listing_is_paginated(self):
+        """One listing can still be several pages; all of them are read."""
+        for i in range(700):
+            add_package(self.s3, ARCH, "GEANT4", "v%d-1" % i)
+        installs = self.run_sync({"GEANT4": ["^v699-"]})
+        self.assertEqual(installs, [("GEANT4", "v699-1", [])])
+        self.assertGreater(self.s3.calls["list_objects_v2"], 1)
+
+
+def write_dist_manifests(s3, arch=ARCH, kinds=("dist", "dist-direct", "dist-runtime")):
+    """Write dist*.manifest.gz the way update-symlink-manifests does."""
+    for kind in kinds:
+        start = "TARS/%s/%s/" % (arch, kind)
+        lines = ["%s\t%s\n" % (key, s3.body(key).decode().rstrip("\n"))
+                 for key in sorted(s3.objects) if key.startswith(start)]
+        s3.add(start.rstrip("/") + ".manifest.gz",
+               gzip.compress("".join(lines).encode()))
+
+
+class DistManifestTestCase(SyncTestBase):
+    """sync() with the dist manifests written by update-symlink-manifests."""
+
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(1)
+        names = ["Pkg%02d" % i for i in range(60)]
+        for i, name in enumerate(names):
+            for v in range(5):
+                add_package(self.s3, ARCH, name, "v%d-1" % v, deps=[
+                    (dep, "v%d-1" % rng.randrange(5))
+                    for dep in rng.sample(names[:i], min(i, 5))])
+        self.include = {"O2": True, "Pkg59": ["^v[34]-"], "Pkg30": True}
+
+    def test_same_installs_with_fewer_requests(self):
+        expected = self.run_sync(self.include, use_manifests=False)
+        listings = self.s3.calls["list_objects_v2"]
+        self.assertEqual(len(self.http_gets), len(expected))
+        write_dist_manifests(self.s3)
+        self.s3.reset_calls()
+        self.http_gets = []
+        self.assertEqual(self.run_sync(self.include), expected)
+        # store/ alone, and the three manifests instead of any symlink.
+        self.assertEqual(self.s3.calls["list_objects_v2"], 1)
+        self.assertEqual(self.s3.calls["get_object"], 3)
+        self.assertEqual(self.http_gets, [])
+        self.assertLess(self.s3.calls["list_objects_v2"] * 5, listings)
+
+    def test_uploads_after_the_manifest_are_listed(self):
+        write_dist_manifests(self.s3)
+        add_package(self.s3, ARCH, "O2", "v3.0.0-1",
+                    deps=[("ROOT", "v6-30-1"), ("zlib", "v1.3-1")])
+        # Not complete until its store tarball is there.
+        add_package(self.s3, ARCH, "O2", "v4.0.0-1", deps=[("zlib", "v1.3-1")])
+        self.s3.remove(store_key(ARCH, "O2", "v4.0.0-1"))
+        self.s3.reset_calls()
+        installs = self.run_sync({"O2": ["^v[34]"]})
+        self.assertEqual(installs, [("O2", "v3.0.0-1", ["ROOT", "zlib"]),
+                                    ("ROOT", "v6-30-1", ["zlib"]),
+                                    ("zlib", "v1.3-1", [])])
+        # store/, then per kind: package names and the one new directory.
+        self.assertEqual(self.s3.calls["list_objects_v2"], 1 + 3 * 2)
+        self.assertEqual([url.rsplit("/", 1)[-1] for url in self.http_gets],
+                         ["O2-v3.0.0-1.%s.tar.gz" % ARCH])
+
+    def test_missing_manifest_is_listed(self):
+        write_dist_manifests(self.s3, kinds=("dist", "dist-direct"))
+        expected = self.run_sync(self.include, use_manifests=False)
+        self.s3.reset_calls()
+        self.assertEqual(self.run_sync(self.include), expected)
+        self.assertEqual(self.s3.calls["list_objects_v2"],
+                         1 + -(-sum(1 for key in self.s3.objects
+                                    if "/dist-runtime/" in key) // 1000))
+
+    def test_many_new_uploads_list_the_whole_tree(self):
+        write_dist_manifests(self.s3)
+        for i in range(10):
+            add_package(self.s3, ARCH, "Pkg%02d" % i, "v9-1")
+        self.s3.reset_calls()
+        installs = self.run_sync({"Pkg00": ["^v9-"]})
+        self.assertEqual(installs, [("Pkg00", "v9-1", [])])
+        # Fewer pages than the ten new directories' six requests each.
+        self.assertLess(self.s3.calls["list_objects_v2"], 1 + 3 * 10)
+
+    def test_uploads_shortly_before_the_manifest_are_listed(self):
+        """The store is listed before the manifests are written; allow for it."""
+        write_dist_manifests(self.s3)
+        add_package(self.s3, ARCH, "O2", "v3.0.0-1",
+                    mtime=datetime.now(timezone.utc) - timedelta(hours=1))
+        self.assertEqual(self.run_sync({"O2": ["^v3"]}, auto_include_deps=False),
+                         [("O2", "v3.0.0-1", [])])
+        self.assertEqual(self.run_sync({"O2": ["^v3"]}, auto_include_deps=False,
+                                       manifest_grace=timedelta(minutes=30)), [])
+
+
+class SmallDistManifestTestCase(SyncTestBase):
+    def test_small_trees_are_listed_whole(self):
+        """Under one page per dist* tree, listing it beats listing new dirs."""
+        write_dist_manifests(self.s3)
+        add_package(self.s3, ARCH, "O2", "v3.0.0-1", deps=[("zlib", "v1.3-1")])
+        self.s3.reset_calls()
+        self.assertEqual(self.run_sync({"O2": ["^v3"]}, auto_include_deps=False),
+                         [("O2", "v3.0.0-1", ["zlib"])])
+        # store/, then one page per kind, rather than two requests per kind.
+        self.assertEqual(self.s3.calls["list_objects_v2"], 1 + 3)
+
+
+class PrefetchTestCase(unittest.TestCase):
+    """Packages are found and fetched ahead of the installs, in order."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script("publish/aliPublishS3", "aliPublishS3")
+        self.s3 = FakeS3Client()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        add_package(self.s3, ARCH, "zlib", "v1.3-1")
+        for i in range(12):
+            add_package(self.s3, ARCH, "Pkg%02d" % i, "v1-1",
+                        deps=[("zlib", "v1.3-1")])
+        self.lock = threading.Lock()
+        self.in_flight = self.max_in_flight = 0
+        self.installs = []
+
+    def fake_get(self, url, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            self.s3._request("http_get")
+            return FakeResponse(self.s3.body(unquote(url[len(BASE_URL):])).decode())
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def fake_install(self, url, arch, name, ver, deps, allDeps):
+        if url.startswith("file://"):
+            with open(unquote(url[len("file://"):]), "rb") as tarball:
+                url = tarball.read()
+        self.installs.append((name, url))
+        return 0
+
+    def run_sync(self, workers, dry_run=False, limit=0):
+        pub = self.script.PlainFilesystem(
+            modulefileTpl=os.path.join(self.tmp, "%(package)s/%(version)s.mod"),
+            pkgdirTpl=os.path.join(self.tmp, "%(arch)s/%(package)s/%(version)s"),
+            publishScriptTpl="", connParams=CONN_PARAMS, dryRun=dry_run)
+        pub.install = self.fake_install
+        with patch_session_get(self.script, self.fake_get), \
+             patch.object(self.script, "getcwd", lambda: self.tmp):
+            self.assertTrue(self.script.sync(
+                pub=pub, architectures={ARCH: "el9-x86_64"}, s3Client=self.s3,
+                bucket="alibuild-repo", baseUrl=BASE_URL, basePrefix="TARS",
+                rules={"include": {ARCH: {"zlib": True, **{
+                    "Pkg%02d" % i: True for i in range(12)}}},
+                       "exclude": {ARCH: {}}},
+                autoIncludeDeps=True, notifEmail={}, dryRun=dry_run,
+                connParams=CONN_PARAMS, publishLimit=limit,
+                prefetchWorkers=workers, useManifests=False))
+
+    def test_tarballs_are_prefetched_and_installed_in_order(self):
+        self.s3.latency = 0.01
+        self.run_sync(workers=4)
+        names = ["Pkg%02d" % i for i in range(12)] + ["zlib"]
+        self.assertEqual([name for name, _ in self.installs], names)
+        for name, tarball in self.installs:
+            self.assertEqual(tarball, ("tarball %s-%s.%s.tar.gz" % (
+                name, "v1.3-1" if name == "zlib" else "v1-1", ARCH)).encode())
+        self.assertGreater(self.max_in_flight, 1)
+        self.assertLessEqual(self.max_in_flight, 4)
+        self.assertEqual(os.listdir(self.tmp), [], "prefetched files left over")
+
+    def test_dry_run_downloads_nothing(self):
+        self.run_sync(workers=4, dry_run=True)
+        self.assertEqual(len(self.installs), 13)
+        self.assertTrue(all(url.startswith(BASE_URL) for _, url in self.installs))
+        self.assertEqual(self.s3.calls["get_object"], 0)
+
+    def test_publish_limit_is_respected(self):
+        self.run_sync(workers=8, limit=3)
+        self.assertEqual(len(self.installs), 3)
+        self.assertEqual(self.s3.calls["http_get"], 3)
+        self.assertEqual(self.s3.calls["get_object"], 3)
+
+    def test_failed_prefetch_falls_back_to_the_url(self):
+        download_file = self.s3.download_file
+
+        def flaky_download_file(Bucket, Key, Filename, **kwargs):
+            if "/Pkg03-" in Key:
+                with open(Filename, "wb") as partial:
+                    partial.write(b"tarb")
+                raise OSError("connection reset")
+            return download_file(Bucket, Key, Filename, **kwargs)
+
+        self.s3.download_file = flaky_download_file
+        self.run_sync(workers=4)
+        urls = dict(self.installs)
+        self.assertTrue(urls["Pkg03"].startswith(BASE_URL))
+        self.assertEqual(urls["Pkg04"], ("tarball Pkg04-v1-1.%s.tar.gz"
+                                         % ARCH).encode())
+        self.assertEqual(os.listdir(self.tmp), [], "partial download left over")
+
+
+class SymlinkHandler(BaseHTTPRequestHandler):
+    """Serve objects from `s3` over keep-alive HTTP, counting connections."""
+    protocol_version = "HTTP/1.1"
+    s3 = None
+    connections = 0
+    requests = 0
+
+    def setup(self):
+        type(self).connections += 1
+        super().setup()
+
+    def do_GET(self):
+        type(self).requests += 1
+        key = unquote(self.path[len("/alibuild-repo/"):])
+        if key in self.s3.objects:
+            status, body = 200, self.s3.body(key)
+        else:
+            status, body = 404, b"<Error><Code>NoSuchKey</Code></Error>"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SymlinkResolverTestCase(unittest.TestCase):
+    """Symlinks are read through a pooled Session, and cached."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script("publish/aliPublishS3", "aliPublishS3")
+        self.s3 = FakeS3Client()
+        add_package(self.s3, ARCH, "zlib", "v1.3-1")
+        for i in range(12):
+            add_package(self.s3, ARCH, "Pkg%02d" % i, "v1-1",
+                        deps=[("zlib", "v1.3-1")])
+        SymlinkHandler.s3 = self.s3
+        SymlinkHandler.connections = SymlinkHandler.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SymlinkHandler)
+        threading.Thread(target=self.server.serve_forever, args=(0.01,),
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = "http://127.0.0.1:%d/alibuild-repo/" \
+            % self.server.server_address[1]
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def symlink_url(self, name, version):
+        return "%sTARS/%s/dist-direct/%s/%s-%s/%s-%s.%s.tar.gz" % (
+            self.base_url, ARCH, name, name, version, name, version, ARCH)
+
+    def test_sync_reuses_connections(self):
+        pub = self.script.PlainFilesystem(
+            modulefileTpl=os.path.join(self.tmp, "%(package)s/%(version)s.mod"),
+            pkgdirTpl=os.path.join(self.tmp, "%(arch)s/%(package)s/%(version)s"),
+            publishScriptTpl="", connParams=CONN_PARAMS, dryRun=True)
+        urls = []
+        pub.install = lambda url, *args: urls.append(url) or 0
+        self.assertTrue(self.script.sync(
+            pub=pub, architectures={ARCH: "el9-x86_64"}, s3Client=self.s3,
+            bucket="alibuild-repo", baseUrl=self.base_url, basePrefix="TARS",
+            rules={"include": {ARCH: {"Pkg%02d" % i: True for i in range(12)}},
+                   "exclude": {ARCH: {}}},
+            autoIncludeDeps=True, notifEmail={}, dryRun=True,
+            connParams=CONN_PARAMS, publishLimit=0, prefetchWorkers=4))
+        self.assertEqual(len(urls), 13)
+        self.assertIn(self.base_url + store_key(ARCH, "zlib", "v1.3-1"), urls)
+        self.assertEqual(SymlinkHandler.requests, 13)
+        self.assertLessEqual(SymlinkHandler.connections, 4)
+
+    def test_targets_are_fetched_once(self):
+        resolver = self.script.SymlinkResolver(CONN_PARAMS)
+        url = self.symlink_url("zlib", "v1.3-1")
+        for _ in range(3):
+            self.assertEqual(resolver.target(url),
+                             store_key(ARCH, "zlib", "v1.3-1"))
+        self.assertEqual((SymlinkHandler.requests, SymlinkHandler.connections),
+                         (1, 1))
+
+    def test_errors_are_not_cached(self):
+        resolver = self.script.SymlinkResolver(CONN_PARAMS)
+        url = self.symlink_url("ROOT", "v6-1")
+        resolver.target(url)
+        add_package(self.s3, ARCH, "ROOT", "v6-1")
+        self.assertEqual(resolver.target(url), store_key(ARCH, "ROOT", "v6-1"))
+        self.assertEqual(SymlinkHandler.requests, 2)
+
+
+class InventoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.script = load_script("publish/aliPublishS3", "aliPublishS3")
+        self.s3 = FakeS3Client()
+        add_package(self.s3, ARCH, "zlib", "v1.3-1")
+        add_package(self.s3, ARCH, "ROOT", "v6-30-1", deps=[("zlib", "v1.3-1")])
+        # Manifests and another architecture must not leak into the index.
+        self.s3.add("TARS/%s/ROOT.manifest" % ARCH, "")
+        add_package(self.s3, "slc8_x86-64", "ROOT", "v6-28-1")
+        self.inventory = self.script.Inventory(self.s3, "alibuild-repo",
+                                               "TARS", ARCH)
+
+    def test_tarballs(self):
+        self.assertEqual(self.inventory.tarballs, {
+            "zlib-v1.3-1.%s.tar.gz" % ARCH, "ROOT-v6-30-1.%s.tar.gz" % ARCH,
+        })
+
+    def test_lookups(self):
+        self.assertEqual(sorted(self.inventory.packages("dist")), ["ROOT", "zlib"])
+        self.assertEqual(self.inventory.versionDirs("dist-direct", "ROOT"),
+                         ["ROOT-v6-30-1"])
+        self.assertEqual(sorted(self.inventory.files("dist-runtime", "ROOT",
+                                                     "ROOT-v6-30-1")),
+                         ["ROOT-v6-30-1.%s.tar.gz" % ARCH,
+                          "zlib-v1.3-1.%s.tar.gz" % ARCH])
+
+    def test_missing_entries_are_empty(self):
+        self.assertEqual(self.inventory.versionDirs("dist", "GCC"), [])
+        self.assertEqual(self.inventory.files("dist", "ROOT", "ROOT-v0"), [])
+
+
+ALIEN_ENV = {"ALIEN_CLIENT_CERT": "cert", "ALIEN_CLIENT_KEY": "key",
+             "ALIEN_USER": "user", "ALIEN_TOKEN": "token"}
+ALIEN_PLATFORMS = ["el7-x86_64", "el8-x86_64", "el9-x86_64", "el9-aarch64"]
+
+
+def alien_catalogue(packages, rng):
+    """Return a package list shaped like alimonitor's packages.jsp export."""
+    names = ["AliRoot", "AliPhysics", "O2", "O2Physics", "QualityControl",
+             "O2DPG", "ROOT", "GEANT4", "jalien", "xjalienfs"]
+    return [{"name": rng.choice(names), "version": "vAN-2024%04d-%d" % (i, i % 3),
+             "platforms": rng.sample(ALIEN_PLATFORMS, rng.randint(1, 3))}
+            for i in range(packages)]
+
+
+def alien_publisher(script, catalogue):
+    """Return an AliEn publisher that gets `catalogue` from alimonitor."""
+    with patch.dict(os.environ, ALIEN_ENV):
+        pub = script.AliEn(CONN_PARAMS, "alice.cern.ch",
+                           "/cvmfs/%(repo)s/%(arch)s/%(package)s/%(version)s")
+    response = type("Response", (), {"status_code": 200,
+                                      "json": lambda self: catalogue})()
+    pub._session.get = lambda url, **kwargs: response
+    return pub
+
+
+class InstalledTestCase(unittest.TestCase):
+    """installed() looks packages up in a hashed index."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script("publish/aliPublishS3", "aliPublishS3")
+
+    def test_alien(self):
+        rng = random.Random(1)
+        catalogue = alien_catalogue(25000, rng)
+        pub = alien_publisher(self.script, catalogue)
+        queries = [(platform, pkg["name"], pkg["version"])
+                   for pkg in rng.sample(catalogue, 200)
+                   for platform in ALIEN_PLATFORMS]
+        queries += [("el9-x86_64", "O2", "vAN-20240001-9"),
+                    ("el9-x86_64", "AliPhysics", "nonexistent")]
+        for arch, name, version in queries:
+            self.assertEqual(pub.installed(arch, name, version), any(
+                pkg["name"] == name and pkg["version"] == version and
+                arch in pkg["platforms"] for pkg in catalogue))
+
+    def test_rpm(self):
+        s3 = FakeS3Client()
+        s3.add("RPMS/el9-x86_64/alisw-O2+v1-1-1-1.el9-x86_64.rpm")
+        s3.add("RPMS/el9-x86_64/repodata/repomd.xml")
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        with patch.object(self.script, "getcwd", lambda: tmp):
+            pub = self.script.RPM(
+                publishScriptTpl="", connParams=CONN_PARAMS,
+                genUpdatableRpms=False, baseUrl=BASE_URL, s3Client=s3,
+                s3Bucket="alibuild-repo")
+        self.assertTrue(pub.installed("el9-x86_64", "O2", "v1-1"))
+        self.assertFalse(pub.installed("el9-x86_64", "O2", "v2-1"))
+        self.assertEqual(s3.calls["list_objects_v2"], 1)
+
+
+PRIMARY_NS = "http://linux.duke.edu/metadata/common"
+
+
+def primary_xml(rpms):
+    """Return a gzipped primary.xml listing the given RPM file names."""
+    return gzip.compress(("<metadata xmlns='%s'>%s</metadata>" % (PRIMARY_NS, "".join(
+        "<package><location href='%s'/></package>" % rpm for rpm in rpms
+    ))).encode("utf-8"))
+
+
+def write_big_primary_xml(path, packages):
+    """Write a gzipped primary.xml shaped like createrepo's, and return the
+    RPM names it lists.
+
+    Each package carries the fields createrepo writes, with a description and
+    a few hundred provides, which is what makes the real index big. Some
+    <location> elements outside of a <package> must be ignored.
+    """
+    rpm_ns = "http://linux.duke.edu/metadata/rpm"
+    names = []
+    with gzip.open(path, "wt", encoding="utf-8") as out:
+        out.write("<?xml version='1.0' encoding='UTF-8'?>\n"
+                  "<metadata xmlns='%s' xmlns:rpm='%s' packages='%d'>\n"
+                  % (PRIMARY_NS, rpm_ns, packages))
+        out.write("<location href='not-a-package.rpm'/>\n")
+        for i in range(packages):
+            name = "alisw-O2+v%d-1-1.el9.x86_64.rpm" % i
+            names.append(name)
+            out.write(
+                "<package type='rpm'><name>alisw-O2+v%d-1</name>"
+                "<arch>x86_64</arch><version epoch='0' ver='1' rel='1.el9'/>"
+                "<checksum type='sha256' pkgid='YES'>%064x</checksum>"
+                "<summary>O2 v%d</summary><description>%s</description>"
+                "<packager/><url/><time file='1700000000' build='1700000000'/>"
+                "<size package='123456789' installed='0' archive='0'/>"
+                "<location href='%s'/><format><rpm:license>GPL</rpm:license>"
+                "<rpm:provides>%s</rpm:provides></format></package>\n"
+                % (i, i, i, "O2 for ALICE. " * 20, name, "".join(
+                    "<rpm:entry name='libO2Module%d.so()(64bit)'/>" % j
+                    for j in range(200))))
+        out.write("</metadata>\n")
+    return names
+
+
+def reference_rpm_names(primary_xml_file):
+    """The old way: build the whole tree, then pick the locations out."""
+    from xml.etree.ElementTree import ElementTree
+    return {
+        location.attrib["href"]
+        for location in ElementTree(file=primary_xml_file).iterfind(
+            "./c:package/c:location", {"c": PRIMARY_NS})
+    }
+
+
+class PrimaryXmlTestCase(unittest.TestCase):
+    """primary.xml.gz is streamed rather than parsed into a tree."""
+
+    def setUp(self):
+        self.script = load_script("publish/aliPublishS3", "aliPublishS3")
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, "primary.xml.gz")
+        self.names = write_big_primary_xml(self.path, 400)
+
+    def peak_memory(self, parse):
+        with gzip.open(self.path) as primary:
+            tracemalloc.start()
+            try:
+                result = set(parse(primary))
+                return result, tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    def test_same_names_in_a_fraction_of_the_memory(self):
+        streamed, streamed_peak = self.peak_memory(self.script.primaryRpmNames)
+        full, full_peak = self.peak_memory(reference_rpm_names)
+        self.assertEqual(streamed, full)
+        self.assertEqual(streamed, set(self.names))
+        self.assertLess(streamed_peak * 10, full_peak)
+
+
+class CountingS3Client(FakeS3Client):
+    """Record transfers in the order they finish, and how many overlap."""
+
+    def __init__(self, latency=0):
+        super().__init__(latency)
+        self.uploaded = []
+        self.in_flight = self.max_in_flight = 0
+
+    def _transfer(self, method, *args, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def download_file(self, *args, **kwargs):
+        return self._transfer(super().download_file, *args, **kwargs)
+
+    def upload_file(self, *args, **kwargs):
+        self._transfer(super().upload_file, *args, **kwargs)
+        with self._lock:
+            self.uploaded.append(kwargs["Key"])
+
+
+class RPMPublishTestCase(unittest.TestCase):
+    """RPM.publish() transfers RPMs concurrently."""
+
+    PREFIX = "RPMS/el9-x86_64/"
+
+    def setUp(self):
+        self.script = load_script("publish/aliPublishS3", "aliPublishS3")
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.s3 = CountingS3Client()
+        self.s3.add(self.PREFIX + "repodata/repomd.xml",
+                    "<location href='repodata/0abc-primary.xml.gz'/>")
+        self.s3.add(self.PREFIX + "repodata/0abc-primary.xml.gz",
+                    primary_xml(["indexed-%d.rpm" % i for i in range(3)]))
+        for i in range(3):
+            self.s3.add(self.PREFIX + "indexed-%d.rpm" % i, b"x" * 100)
+        for i in range(10):
+            self.s3.add(self.PREFIX + "old-%d.rpm" % i, b"x" * 100)
+        self.createrepo_saw = None
+        with patch.object(self.script, "getcwd", lambda: self.tmp):
+            self.pub = self.script.RPM(
+                publishScriptTpl="", connParams=CONN_PARAMS,
+                genUpdatableRpms=False, baseUrl=BASE_URL, s3Client=self.s3,
+                s3Bucket="alibuild-repo", transferWorkers=4)
+        self.assertTrue(self.pub.transaction())
+        self.stagedir = os.path.join(self.pub._stageDir, "el9-x86_64")
+        os.makedirs(self.stagedir)
+        for i in range(5):
+            with open(os.path.join(self.stagedir, "new-%d.rpm" % i), "wb") as f:
+                f.write(b"new RPM payload %d" % i)
+
+    def fake_execute(self, command, fail=None):
+        if command[0] == fail:
+            return 1
+        if command[0] == "createrepo":
+            self.createrepo_saw = sorted(os.listdir(command[-1]))
+        elif command[0] == "mergerepo":
+            repodata = os.path.join(command[-1], "repodata")
+            os.makedirs(repodata)
+            for name in ("repomd.xml", "1def-primary.xml.gz", "1def-filelists.xml.gz"):
+                with open(os.path.join(repodata, name), "w") as f:
+                    f.write("merged " + name)
+        return 0
+
+    def publish(self, fail=None):
+        with patch.object(self.script, "execute",
+                          lambda command: self.fake_execute(command, fail)):
+            return self.pub.publish(["el9-x86_64"])
+
+    def test_repository_is_updated(self):
+        self.assertTrue(self.publish())
+        self.assertEqual(self.createrepo_saw,
+                         sorted(["new-%d.rpm" % i for i in range(5)] +
+                                ["old-%d.rpm" % i for i in range(10)]))
+        for i in range(5):
+            self.assertEqual(self.s3.body(self.PREFIX + "new-%d.rpm" % i),
+                             b"new RPM payload %d" % i)
+        self.assertEqual(self.s3.body(self.PREFIX + "repodata/repomd.xml"),
+                         b"merged repomd.xml")
+        self.assertTrue(any(key.startswith(self.PREFIX + "repodata/repomd.xml.")
+                            for key in self.s3.objects), "no backup")
+        self.assertEqual(self.s3.calls["get_object"], 2 + 10)
+
+    def test_repomd_is_uploaded_last(self):
+        """Clients must never see metadata naming files that are not there."""
+        self.assertTrue(self.publish())
+        self.assertEqual(len(self.s3.uploaded), 5 + 3)
+        self.assertEqual(self.s3.uploaded[-1], self.PREFIX + "repodata/repomd.xml")
+
+    def test_downloads_respect_the_byte_budget(self):
+        """The RPM crossing the budget is fetched, later ones wait a run."""
+        self.pub.MAX_DOWNLOAD_BYTES = 250
+        self.assertTrue(self.publish())
+        self.assertEqual([name for name in self.createrepo_saw
+                          if name.startswith("old-")],
+                         ["old-0.rpm", "old-1.rpm", "old-2.rpm"])
+
+    def test_transfers_run_concurrently(self):
+        self.s3.latency = 0.02
+        self.assertTrue(self.publish())
+        self.assertGreater(self.s3.max_in_flight, 1)
+        self.assertLessEqual(self.s3.max_in_flight, 4)
+
+    def test_failed_metadata_leaves_rpms_for_the_next_run(self):
+        """New RPMs may be uploaded before createrepo fails; they are then
+        non-indexed, which is what the next run picks up -- but the old
+        metadata must be left alone."""
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(self.publish(fail="createrepo"))
+        self.assertTrue(all("/repodata/" not in key for key in self.s3.uploaded))
+        self.assertEqual(self.s3.body(self.PREFIX + "repodata/repomd.xml"),
+                         b"<location href='repodata/0abc-primary.xml.gz'/>")
+
+    def test_phases_are_timed(self):
+        with self.assertLogs(level="INFO") as logs:
+            self.assertTrue(self.publish())
+        timings = [line for line in logs.output if "TIMING" in line]
+        self.assertEqual(len(timings), 3)
+        self.assertIn("downloading 10 non-indexed RPM(s)", timings[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,258 @@
+"""Tests for cleanup/repo-s3-cleanup's rules, dependencies and snapshots."""
+
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+from argparse import Namespace
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from s3stub import REPO, load_script
+
+RULES_FILE = os.path.join(REPO, "cleanup", "cleanup-rules.yaml")
+ARCHS = ["slc7_aarch64", "slc8_x86-64", "slc9_x86-64", "ubuntu2204_x86-64",
+         "osx_arm64"]
+PACKAGES = ["O2PDPSuite", "O2", "O2Physics", "O2sim", "O2DPG",
+            "DataDistribution", "QualityControl", "ROOT", "GCC-Toolchain"]
+
+
+def reference_evaluate(script, rules, package, key, mtime):
+    """The old evaluate_rules(), evaluate_rule() and tarball_matches_any()."""
+    def tarball_matches_any(tarball, arch, packages, versions_revisions):
+        arch = re.escape(arch)
+        return any(re.fullmatch(rf"{pkg}-{ver}.{arch}\.tar\.gz", tarball)
+                   for pkg in map(re.escape, packages)
+                   for ver in versions_revisions)
+
+    def evaluate_rule(rule):
+        if package not in rule["packages"]:
+            return script.DeletionAction.UNDECIDED, \
+                "not matched by rule with the correct package"
+        arch = script.tarball_arch(key)
+        if arch not in rule["architectures"]:
+            return script.DeletionAction.UNDECIDED, \
+                "not matched by rule with the correct architecture"
+        action_if_deletion = script.DeletionAction.DELETE_WITH_SYMLINKS \
+            if rule["delete_symlinks"] \
+            else script.DeletionAction.DELETE_TARBALL_ONLY
+        tarball = os.path.basename(key)
+        if tarball_matches_any(tarball, arch, rule["packages"], rule["keep"]):
+            return script.DeletionAction.KEEP, "matched by regex"
+        if tarball_matches_any(tarball, arch, rule["packages"], rule["delete"]):
+            return action_if_deletion, "matched by regex"
+        cutoff = rule["delete_older_than"]
+        if cutoff is not None and mtime < cutoff:
+            return action_if_deletion, \
+                cutoff.strftime("older than %Y-%m-%d %H:%M:%S %Z")
+        return script.DeletionAction.UNDECIDED, "not matched by rule"
+
+    return min(evaluate_rule(rule) for rule in rules)
+
+
+def random_version(rng):
+    """Return a version like the ones cleanup-rules.yaml is written for."""
+    day = datetime(2021, 1, 1) + timedelta(days=rng.randrange(4 * 365))
+    return rng.choice([
+        "nightly-%s-%d" % (day.strftime("%Y%m%d"), rng.randrange(1, 3)),
+        "nightly-%s-gpu-1" % day.strftime("%Y%m%d"),
+        "epn-%s.%d-DDv1.6.0-flp-suite-v1.8.0-1" % (day.strftime("%Y%m%d"),
+                                                  rng.randrange(1, 3)),
+        "epn-20230829.1-DDv1.6.1-flp-suite-v1.8.0-ODC-0.80.0-1",
+        "v%s-%d" % (day.strftime("%Y%m%d"), rng.randrange(1, 3)),
+        "v1.%d.%d-%d" % (rng.randrange(10), rng.randrange(10),
+                         rng.randrange(1, 3)),
+        "358bbf3602ec199cbae58c30e1964ed1d49c1716-1",
+    ])
+
+
+def random_tarballs(n, rng):
+    """Return n (package, store key, mtime) tuples."""
+    now = datetime.now(timezone.utc)
+    return [(package,
+             "TARS/%s/store/%02x/%040x/%s-%s.%s.tar.gz" % (
+                 arch, i % 256, i, package, random_version(rng), arch),
+             now - timedelta(days=rng.randrange(120)))
+            for i, package, arch in ((i, rng.choice(PACKAGES), rng.choice(ARCHS))
+                                     for i in range(n))]
+
+
+def write_listing(path, tarballs, bucket="alibuild-repo"):
+    """Write store keys and their symlinks as "s3cmd ls -r" would list them."""
+    with open(path, "w") as listing:
+        for package, key, mtime in tarballs:
+            arch = key.split("/")[1]
+            stamp = mtime.strftime("%Y-%m-%d %H:%M")
+            listing.write("%s %10d   s3://%s/%s\n" % (stamp, 1024**2, bucket, key))
+            listing.write("%s %10d   s3://%s/TARS/%s/%s/%s\n" % (
+                stamp, 100, bucket, arch, package, os.path.basename(key)))
+
+
+def load_rules(script, path=RULES_FILE):
+    with open(path) as rules_file:
+        return [script.parse_rule(entry) for entry in yaml.safe_load(rules_file)]
+
+
+class RuleMatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script("cleanup/repo-s3-cleanup",
+                                  "cleanup_repo_s3_cleanup")
+
+    def check(self, rules, tarballs):
+        matcher = self.script.RuleMatcher(rules)
+        actions = set()
+        for package, key, mtime in tarballs:
+            expected = reference_evaluate(self.script, rules, package, key, mtime)
+            self.assertEqual(matcher.evaluate(package, key, mtime), expected, key)
+            actions.add(expected[0])
+        return actions
+
+    def test_the_real_rules(self):
+        tarballs = random_tarballs(3000, random.Random(1))
+        actions = self.check(load_rules(self.script), tarballs)
+        self.assertEqual(actions, set(self.script.DeletionAction))
+
+    def test_patterns_match_any_of_the_rules_packages(self):
+        """A rule's version regexes are tried with all its package names."""
+        rules = [self.script.parse_rule({
+            "architectures": ["slc9_x86-64"], "packages": ["O2", "O2-foo"],
+            "delete": ["foo-v1"], "keep": ["(v2)-\\1"],
+        })]
+        now = datetime.now(timezone.utc)
+        self.check(rules, [
+            ("O2-foo", "TARS/slc9_x86-64/store/00/00/O2-foo-v1.slc9_x86-64.tar.gz", now),
+            ("O2", "TARS/slc9_x86-64/store/00/00/O2-foo-v1.slc9_x86-64.tar.gz", now),
+            ("O2", "TARS/slc9_x86-64/store/00/00/O2-v2-v2.slc9_x86-64.tar.gz", now),
+        ])
+
+    def test_reasons_of_rules_that_do_not_apply(self):
+        rules = load_rules(self.script)
+        now = datetime.now(timezone.utc)
+        self.check(rules, [
+            ("ROOT", "TARS/slc8_x86-64/store/00/00/ROOT-v6-1.slc8_x86-64.tar.gz", now),
+            ("O2", "TARS/osx_arm64/store/00/00/O2-v1-1.osx_arm64.tar.gz", now),
+        ])
+
+
+class DependencyTestCase(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script("cleanup/repo-s3-cleanup",
+                                  "cleanup_repo_s3_cleanup")
+
+    def test_kept_tarballs_block_their_dependencies(self):
+        arch = "slc9_x86-64"
+        table = self.script.SymlinkTable()
+        store, dist_symlinks = {}, []
+        for name, deps in (("A", ["B"]), ("B", []), ("C", ["B"])):
+            basename = "%s-v1-1.%s.tar.gz" % (name, arch)
+            store[name] = "TARS/%s/store/00/00/%s" % (arch, basename)
+            table.add(basename, store[name], name)
+            dist_symlinks.extend(
+                "TARS/%s/dist/%s/%s-v1-1/%s-v1-1.%s.tar.gz"
+                % (arch, name, name, dep, arch) for dep in [name] + deps)
+        dist_symlinks.sort()
+        # A is kept, so B must stay; C goes, with its dist directory.
+        to_delete, dependencies = self.script.get_symlinks_for_deletion(
+            {store["B"], store["C"]}, set(), dist_symlinks, table)
+        c_symlinks = {key for key in dist_symlinks if "/dist/C/" in key}
+        self.assertEqual(to_delete, {store["B"], store["C"]} | c_symlinks |
+                         {key for key in dist_symlinks if "/dist/B/" in key})
+        self.assertEqual(self.script.find_deletable(to_delete, dependencies),
+                         {store["C"]} | c_symlinks)
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script("cleanup/repo-s3-cleanup",
+                                  "cleanup_repo_s3_cleanup")
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.listing = os.path.join(self.tmp, "listing.txt")
+        self.tarballs = random_tarballs(3000, random.Random(2))
+
+    def run_main(self, do_it=False, max_age=0):
+        """Run main() on the listing; return what it would delete, and the
+        requests it made."""
+        clients, deleted = [], []
+
+        class RecordingClient(self.script.MockS3Client):
+            def __init__(self, *args):
+                super().__init__(*args)
+                clients.append(self)
+
+        def delete_objects(s3c, bucket, to_delete, **kwargs):
+            deleted.extend(to_delete)
+            return True
+
+        write_listing(self.listing, self.tarballs)
+        with open(self.listing) as listing, open(RULES_FILE) as rules, \
+             patch.object(self.script, "MockS3Client", RecordingClient), \
+             patch.object(self.script, "delete_objects", delete_objects):
+            self.assertEqual(self.script.main(Namespace(
+                verbose=False, do_it=do_it, jobs=8, fetch_concurrency=8,
+                endpoint_url=None, bucket="alibuild-repo",
+                repo_listing=listing, config_file=rules,
+                snapshot_dir=os.path.join(self.tmp, "snapshots"),
+                snapshot_max_age=max_age)), 0)
+        return sorted(deleted), clients[0].calls
+
+    def test_top_level_listing(self):
+        write_listing(self.listing, self.tarballs[:50])
+        with open(self.listing) as listing:
+            s3c = self.script.MockS3Client(listing)
+        arch = "TARS/slc9_x86-64/"
+        pages = list(s3c.paginate("alibuild-repo", arch, Delimiter="/"))
+        self.assertEqual(
+            sorted(p["Prefix"] for page in pages for p in page["CommonPrefixes"]),
+            sorted({arch + key.split("/")[2] + "/" for key in
+                    (key for _, key, _ in self.tarballs[:50])
+                    if key.startswith(arch)} |
+                   {arch + package + "/" for package, key, _ in self.tarballs[:50]
+                    if key.startswith(arch)}))
+
+    def test_second_run_reads_no_symlinks(self):
+        archs = {arch for rule in load_rules(self.script)
+                 for arch in rule["architectures"]}
+        symlinks = {(key.split("/")[1], package, os.path.basename(key))
+                    for package, key, _ in self.tarballs
+                    if key.split("/")[1] in archs}
+        deleted, calls = self.run_main()
+        self.assertTrue(deleted)
+        self.assertEqual(calls["get_object"], len(symlinks))
+        again, calls = self.run_main()
+        self.assertEqual(again, deleted)
+        self.assertEqual(calls["get_object"], 0)
+        self.assertGreater(calls["list_objects_v2"], 0)
+
+    def test_only_new_symlinks_are_read(self):
+        self.run_main()
+        now = datetime.now(timezone.utc)
+        self.tarballs.append(("O2", "TARS/slc9_x86-64/store/ff/%040x/"
+                              "O2-v1.0.0-1.slc9_x86-64.tar.gz" % 10**6, now))
+        _, calls = self.run_main()
+        self.assertEqual(calls["get_object"], 1)
+
+    def test_recent_listing_is_reused_for_dry_runs_only(self):
+        deleted, _ = self.run_main()
+        again, calls = self.run_main(max_age=3600)
+        self.assertEqual(again, deleted)
+        self.assertEqual(sum(calls.values()), 0)
+        _, calls = self.run_main(do_it=True, max_age=3600)
+        self.assertGreater(calls["list_objects_v2"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,31 @@
+import contextlib
+import io
 import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
-from unittest.mock import patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import Mock, patch
 from alibot_helpers.github_utilities import calculateMessageHash
 from alibot_helpers.github_utilities import parseGithubRef
 from alibot_helpers.github_utilities import GithubCachedClient
 from alibot_helpers.github_utilities import relativeLink
+from alibot_helpers.github_utilities import SqliteCache
+from alibot_helpers.github_utilities import make_session
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_client(**kwargs):
+  """Build a GithubCachedClient without its initial rate-limit request."""
+  kwargs.setdefault("token", "SECRET")
+  kwargs.setdefault("api", "https://api.github.com")
+  with patch.object(GithubCachedClient, "printStats"):
+    return GithubCachedClient(**kwargs)
 
 
 class TestAuthorizationHeader(unittest.TestCase):
@@ -88,5 +109,171 @@ class TestGithubHelpers(unittest.TestCase):
     self.assertEqual(parseGithubRef("foo/bar#100@4787895789324784"), ("foo/bar", "100", "4787895789324784"))
     self.assertEqual(parseGithubRef("foo/bar#100"), ("foo/bar", "100", "master"))
 
+
+class FakeResponse:
+  def __init__(self, status_code, payload=None, headers=None):
+    self.status_code = status_code
+    self.payload = payload
+    self.headers = headers or {}
+
+  def json(self):
+    return self.payload
+
+
+class TestSqliteCache(unittest.TestCase):
+  """The GitHub cache is shared by every process on a builder."""
+
+  WRITER = """
+import sys
+from alibot_helpers.github_utilities import SqliteCache
+with SqliteCache(sys.argv[1]) as cache:
+  for i in range(200):
+    cache.update({"%s-%d" % (sys.argv[2], i): {"payload": [i], "ETag": "e%d" % i}})
+    cache["shared"]
+"""
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp)
+    self.filename = os.path.join(self.tmp, "cache", "github.sqlite")
+
+  def test_concurrent_processes_keep_all_entries(self):
+    writers = [subprocess.Popen([sys.executable, "-c", self.WRITER,
+                                 self.filename, name], cwd=REPO)
+               for name in ("a", "b", "c")]
+    for writer in writers:
+      self.assertEqual(writer.wait(), 0)
+    with SqliteCache(self.filename) as cache:
+      for name in ("a", "b", "c"):
+        for i in range(200):
+          self.assertEqual(cache["%s-%d" % (name, i)],
+                           {"payload": [i], "ETag": "e%d" % i})
+    with sqlite3.connect(self.filename) as db:
+      self.assertEqual(db.execute("PRAGMA integrity_check").fetchone(), ("ok",))
+
+  def test_missing_and_deleted_entries_are_empty(self):
+    with SqliteCache(self.filename) as cache:
+      self.assertEqual(cache["nope"], {})
+      cache.update({"key": {"payload": True}})
+      del cache["key"]
+      del cache["key"]    # deleting twice is not an error
+      self.assertEqual(cache["key"], {})
+
+  def test_a_corrupt_file_is_replaced_by_an_empty_cache(self):
+    os.makedirs(os.path.dirname(self.filename))
+    with open(self.filename, "wb") as f:
+      f.write(b"this is not an SQLite database" * 100)
+    with contextlib.redirect_stderr(io.StringIO()) as stderr, \
+         SqliteCache(self.filename) as cache:
+      self.assertEqual(cache["key"], {})
+      cache.update({"key": {"payload": True}})
+    self.assertIn("Malformed cache file", stderr.getvalue())
+    with SqliteCache(self.filename) as cache:
+      self.assertEqual(cache["key"], {"payload": True})
+
+  def test_least_recently_used_entries_are_evicted(self):
+    with SqliteCache(self.filename, max_entries=2) as cache:
+      for key in ("old", "used", "new"):
+        cache.update({key: {"payload": key}})
+      cache["used"]       # reading an entry refreshes it
+      cache.db.execute("UPDATE cache SET last_used = 0 WHERE key = 'old'")
+    with SqliteCache(self.filename) as cache:
+      self.assertEqual(cache["old"], {})
+      self.assertEqual(cache["used"], {"payload": "used"})
+      self.assertEqual(cache["new"], {"payload": "new"})
+
+  def test_an_etag_from_another_process_gives_a_304(self):
+    """The point of sharing: one builder's response saves the next a request."""
+    statuses = []
+
+    def fake_request(method, url, headers, timeout):
+      if headers.get("If-None-Match") == '"abc"':
+        response = FakeResponse(304)
+      else:
+        response = FakeResponse(200, {"sha": "1234"}, {"ETag": '"abc"'})
+      statuses.append(response.status_code)
+      return response
+
+    for _ in range(2):    # each time with a fresh client and connection
+      with SqliteCache(self.filename) as cache:
+        client = make_client(cache=cache, session=Mock(request=fake_request))
+        self.assertEqual(client.get("/repos/a/b/commits/1234"), {"sha": "1234"})
+    self.assertEqual(statuses, [200, 304])
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+  """Answer every GET with an empty JSON list, counting connections."""
+  protocol_version = "HTTP/1.1"    # keep-alive, as GitHub does
+  connections = 0
+  requests = 0
+  fail_first = 0
+
+  def setup(self):
+    type(self).connections += 1
+    super().setup()
+
+  def do_GET(self):
+    type(self).requests += 1
+    if type(self).fail_first > 0:
+      type(self).fail_first -= 1
+      status, body = 503, b"{}"
+    else:
+      status, body = 200, b"[]"
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class TestSession(unittest.TestCase):
+  """Requests share pooled connections."""
+
+  def setUp(self):
+    CountingHandler.connections = CountingHandler.requests = 0
+    CountingHandler.fail_first = 0
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), CountingHandler)
+    threading.Thread(target=self.server.serve_forever, args=(0.01,),
+                     daemon=True).start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+    self.api = "http://127.0.0.1:%d" % self.server.server_address[1]
+    self.tmp = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp)
+
+  def client(self, **session_args):
+    cache = SqliteCache(os.path.join(self.tmp, "cache.sqlite"))
+    return make_client(cache=cache, api=self.api,
+                       session=make_session(**session_args))
+
+  def test_one_connection_for_many_calls(self):
+    client = self.client()
+    for i in range(5):
+      self.assertEqual(list(client.get("/repos/a/b/statuses/%d" % i)), [])
+    client.rate_limiting
+    self.assertEqual(CountingHandler.requests, 6)
+    self.assertEqual(CountingHandler.connections, 1)
+
+  def test_server_errors_are_retried(self):
+    CountingHandler.fail_first = 2
+    client = self.client(backoff=0)
+    self.assertEqual(list(client.get("/repos/a/b/statuses/x")), [])
+    self.assertEqual(CountingHandler.requests, 3)
+
+  def test_calls_are_timed(self):
+    client = self.client()
+    client.get("/repos/a/b/statuses/x")
+    client.get("/repos/a/b/statuses/y")
+    calls, total, slowest = client.latency["GET"]
+    self.assertEqual(calls, 2)
+    self.assertGreaterEqual(total, slowest)
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+      client.printStats()
+    self.assertIn("GET in", stderr.getvalue())
+
 if __name__ == '__main__':
     unittest.main()
@@ -27,17 +27,30 @@ rather than a test:
 """
 
 import contextlib
+import copy
+import hashlib
+import hmac
 import importlib.machinery
 import importlib.util
 import io
+import itertools
+import json
 import os
 import sys
 import tempfile
+import threading
 import unittest
+from argparse import Namespace
+from datetime import datetime
+
+import requests
+from graphql import print_ast
 
 REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, REPO)
 
+HERE = os.path.dirname(os.path.abspath(__file__))
+WEBHOOKS = os.path.join(HERE, "webhooks", "list-branch-pr.json")
 CHECK_NAME = "build/O2/alidist-test"
 PR_REPO = "alisw/alidist"
 
@@ -76,6 +89,37 @@ class CountingRestClient:
         self.calls += 1
 
 
+class RecordedSession:
+    """Stands in for the GraphQL session, answering from recorded results.
+
+    responses maps (repo, base branch) pairs to the "repository" part of a
+    statuses query's result, which is looked up for each alias in the query.
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def execute(self, request):
+        self.requests.append(request)
+        if request.operation_name == "team":
+            return {"organization": {"team": {"members": {"nodes": []}}}}
+        values, document = request.variable_values, print_ast(request.document)
+        data = {}
+        for i in itertools.count():
+            if "owner%d" % i not in values:
+                return data
+            # A variable the document does not use would be a GraphQL error.
+            alias = "repo%d: repository(owner: $owner%d, name: $name%d)" % (i, i, i)
+            assert alias in document, "%r not in the query" % alias
+            repository = dict(self.responses[
+                values["owner%d" % i] + "/" + values["name%d" % i],
+                values["branch%d" % i]])
+            if not values["includeBaseBranch"]:
+                repository.pop("object", None)
+            data["repo%d" % i] = repository
+
+
 def make_pr(number, committed_day, state=None, built_day=None, labels=(),
             draft=False, title="a pull request", association="MEMBER",
             approved=True, reviewed=True):
@@ -110,7 +154,9 @@ def make_pr(number, committed_day, state=None, built_day=None, labels=(),
     }
 
 
-class ListBranchPRTestCase(unittest.TestCase):
+class ScriptTestCase(unittest.TestCase):
+    """Runs list-branch-pr against a definitions tree with a single check."""
+
     def setUp(self):
         self.script = load_script()
         # A definitions tree of our own, so the test does not break when a real
@@ -128,30 +174,29 @@ class ListBranchPRTestCase(unittest.TestCase):
                        % (CHECK_NAME, PR_REPO, extra))
 
     def run_script(self, pulls, *, all_groups=False, no_status=True,
-                   worker_index=0, worker_pool_size=1):
+                   worker_index=0, worker_pool_size=1, daemon=None):
         """Run main() over `pulls`, returning (rows, rest_call_count).
 
         rows is a list of the tab-separated fields of each output line.
         """
         rest = CountingRestClient()
-        self.script.query_repo_info = \
-            lambda *a, **k: {"pullRequests": {"nodes": pulls}}
+        self.session = RecordedSession(
+            {(PR_REPO, "master"): {"pullRequests": {"nodes": pulls}}})
         self.script.github_token = lambda: "not-a-real-token"
         # Record how the GraphQL transport was built: which URL, and whether
         # the credential went as an auth= tuple (HTTP Basic) or a header.
         self.transport_kwargs = {}
         self.script.RequestsHTTPTransport = \
             lambda **kwargs: self.transport_kwargs.update(kwargs)
-        self.script.Client = lambda **kwargs: contextlib.nullcontext(None)
+        self.script.Client = lambda **kwargs: contextlib.nullcontext(self.session)
         self.script.GithubCachedClient = lambda *a, **k: rest
 
-        from argparse import Namespace
         args = Namespace(definitions_dir=self.definitions, mesos_role="role",
                          container_name="container", config_suffix="",
                          worker_index=worker_index,
                          worker_pool_size=worker_pool_size,
                          show_base_branch=False, all_groups=all_groups,
-                         no_status=no_status)
+                         no_status=no_status, serve=None, daemon=daemon)
         stdout = io.StringIO()
         with contextlib.redirect_stdout(stdout), \
                 contextlib.redirect_stderr(io.StringIO()):
@@ -159,6 +204,8 @@ class ListBranchPRTestCase(unittest.TestCase):
         rows = [line.split("\t") for line in stdout.getvalue().splitlines()]
         return rows, rest.calls
 
+
+class ListBranchPRTestCase(ScriptTestCase):
     # ---- the output contract ------------------------------------------------
 
     def test_output_is_always_five_fields(self):
@@ -356,5 +403,248 @@ class ListBranchPRTestCase(unittest.TestCase):
         self.assertEqual([row[1] for row in rows], ["1", "2", "3"])
 
 
+class PullIndexTestCase(ScriptTestCase):
+    """The --serve daemon must answer as a run against GitHub would.
+
+    It is seeded with one query, then fed webhook deliveries recorded from
+    GitHub (trimmed to the fields that matter, plus a few that do not) in the
+    order they arrived. Builders trust its answers as they trust this script's,
+    so the same invariants hold: five fields, sharding that partitions, and no
+    writes to GitHub on a read.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.seeded = [make_pr(1, "01"), make_pr(2, "02", "FAILURE", "05"),
+                       make_pr(5, "05", association="NONE", approved=False,
+                               reviewed=False),
+                       make_pr(6, "06")]
+        self.queries = 0
+        self.rest = CountingRestClient()
+        with open(WEBHOOKS) as webhooksf:
+            self.deliveries = json.load(webhooksf)
+
+    def make_index(self, set_status=False):
+        """Return a PullIndex seeded with self.seeded."""
+        def query(session, repo_branches, include_base_branch):
+            self.queries += 1
+            return {key: {"pullRequests": {"nodes": copy.deepcopy(self.seeded)}}
+                    for key in set(repo_branches)}
+        args = Namespace(definitions_dir=self.definitions, mesos_role="role",
+                         container_name="container", config_suffix="",
+                         worker_index=0, worker_pool_size=1)
+        with contextlib.redirect_stderr(io.StringIO()):
+            repos = list(self.script.repo_configs(args, set_status))
+            index = self.script.PullIndex(repos, self.rest, None, query=query)
+            index.seed()
+        return index
+
+    def replay(self, index):
+        for delivery in self.deliveries:
+            index.apply(delivery["event"], delivery["payload"])
+
+    def queue(self, index, worker_index=0, worker_pool_size=1, all_groups=True):
+        """Return the rows the daemon would send to the given worker."""
+        with contextlib.redirect_stderr(io.StringIO()):
+            text = index.queue(worker_index, worker_pool_size, all_groups)
+        return [line.split("\t") for line in text.splitlines()]
+
+    def test_a_seeded_index_answers_like_a_run(self):
+        index = self.make_index()
+        for all_groups in (False, True):
+            rows, _ = self.run_script(self.seeded, all_groups=all_groups)
+            self.assertEqual(self.queue(index, all_groups=all_groups), rows)
+
+    def test_sharding_matches_a_run(self):
+        """Each worker must get exactly the shard it would compute itself."""
+        self.seeded = [make_pr(n, "01") for n in range(1, 21)]
+        index = self.make_index()
+        for worker in range(4):
+            rows, _ = self.run_script(self.seeded, worker_index=worker,
+                                      worker_pool_size=4, all_groups=True)
+            self.assertEqual(self.queue(index, worker, 4), rows)
+
+    def test_replayed_webhooks(self):
+        index = self.make_index()
+        self.replay(index)
+        rows = self.queue(index)
+        # 3 was opened and labelled urgent, 5 approved, 2 pushed to; 1's check
+        # passed; 6 was closed and 7 targets a branch no check builds.
+        self.assertEqual([(row[0], row[1]) for row in rows], [
+            ("untested", "3"), ("untested", "5"), ("untested", "2"),
+            ("succeeded", "1"),
+        ])
+        self.assertEqual(rows[2][2], "sha2b")
+        self.assertEqual(rows[2][4], str(int(datetime.fromisoformat(
+            "2024-03-02T09:30:00+00:00").timestamp())))
+        for row in rows:
+            self.assertEqual(len(row), 5, "row %r" % (row,))
+
+    def test_queries_do_not_touch_github(self):
+        index = self.make_index()
+        self.replay(index)
+        for worker in range(3):
+            self.queue(index, worker, 3)
+            self.queue(index, worker, 3, all_groups=False)
+        self.assertEqual(self.queries, 1)
+        self.assertEqual(self.rest.calls, 0)
+
+    def review(self, index, action, review_id, state, number=5):
+        index.apply("pull_request_review", {
+            "action": action,
+            "repository": {"full_name": PR_REPO},
+            "review": {"id": review_id, "state": state},
+            "pull_request": {"number": number},
+        })
+
+    def test_a_dismissed_approval_is_withdrawn(self):
+        index = self.make_index()
+        self.replay(index)
+        self.review(index, "dismissed", 9001, "dismissed")
+        self.assertNotIn("5", [row[1] for row in self.queue(index)])
+
+    def test_other_dismissed_reviews_keep_the_approval(self):
+        index = self.make_index()
+        self.replay(index)
+        self.review(index, "submitted", 9002, "changes_requested")
+        self.review(index, "dismissed", 9002, "dismissed")
+        # Dismissing an approval twice only withdraws it once.
+        self.review(index, "submitted", 9003, "approved")
+        self.review(index, "dismissed", 9003, "dismissed")
+        self.review(index, "dismissed", 9003, "dismissed")
+        self.assertIn("5", [row[1] for row in self.queue(index)])
+        # A review not seen since the last seed may have been an approval.
+        self.review(index, "dismissed", 8000, "dismissed")
+        self.assertNotIn("5", [row[1] for row in self.queue(index)])
+
+    def test_comments_are_not_tracked(self):
+        index = self.make_index()
+        self.review(index, "submitted", 9004, "commented")
+        self.assertEqual(index.reviews, {})
+
+    def test_untrusted_prs_are_annotated_when_they_change(self):
+        """Not on every query."""
+        index = self.make_index(set_status=True)
+        seeded = self.rest.calls
+        self.assertGreater(seeded, 0, "PR 5 needs approval")
+        self.queue(index)
+        self.queue(index, all_groups=False)
+        self.assertEqual(self.rest.calls, seeded)
+
+    def test_over_http(self):
+        secret = b"not-a-real-secret"
+        index = self.make_index()
+        server = self.script.make_server(index, ("127.0.0.1", 0), secret)
+        server.RequestHandlerClass.log_message = lambda *args: None
+        threading.Thread(target=server.serve_forever, args=(0.01,),
+                         daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:%d" % server.server_address[1]
+
+        def post(delivery, key=secret):
+            body = json.dumps(delivery["payload"]).encode()
+            signature = hmac.new(key, body, hashlib.sha256).hexdigest()
+            return requests.post(url + "/webhook", data=body, headers={
+                "X-GitHub-Event": delivery["event"],
+                "X-Hub-Signature-256": "sha256=" + signature,
+            }, timeout=5)
+
+        # A forged delivery must not change anything.
+        self.assertEqual(post(self.deliveries[1], b"wrong").status_code, 403)
+        self.assertNotIn("3", [row[1] for row in self.queue(index)])
+        for delivery in self.deliveries:
+            self.assertLess(post(delivery).status_code, 300)
+
+        expected = self.queue(index, all_groups=True)
+        with contextlib.redirect_stderr(io.StringIO()):
+            text = requests.get(url + "/queue?worker-index=0&worker-pool-size=1"
+                                "&all-groups=1", timeout=5).text
+        self.assertEqual(text.splitlines(), ["\t".join(row) for row in expected])
+        self.assertEqual(requests.get(url + "/queue", timeout=5).status_code, 400)
+
+        # A builder pointed at the daemon prints its answer, asking GitHub
+        # nothing -- run_script's own PRs would give a different queue.
+        rows, calls = self.run_script([], all_groups=True, daemon=url)
+        self.assertEqual(rows, expected)
+        self.assertEqual(calls, 0)
+
+    def test_falls_back_to_github_without_a_daemon(self):
+        rows, _ = self.run_script([make_pr(1, "01")],
+                                  daemon="http://127.0.0.1:1")
+        self.assertEqual([row[1] for row in rows], ["1"])
+
+
+class MergedQueryTestCase(unittest.TestCase):
+    """All checks' PRs are fetched with one aliased query, same output."""
+
+    CHECKS = [("o2", "build/O2/alidist-test", "alisw/alidist"),
+              ("o2-gpu", "build/O2/gpu", "alisw/alidist"),
+              ("aliphysics", "build/AliPhysics/release", "alisw/AliPhysics")]
+
+    def setUp(self):
+        self.script = load_script()
+        self.definitions = tempfile.mkdtemp()
+        check_dir = os.path.join(self.definitions, "role", "container")
+        os.makedirs(check_dir)
+        for env_name, check_name, repo in self.CHECKS:
+            with open(os.path.join(check_dir, env_name + ".env"), "w") as envf:
+                envf.write("CHECK_NAME=%s\nPR_REPO=%s\nPR_BRANCH=master\n"
+                           % (check_name, repo))
+        with open(os.path.join(HERE, "graphql",
+                               "list-branch-pr-statuses.json")) as recordedf:
+            self.session = RecordedSession({
+                tuple(key.split("@")): repository
+                for key, repository in json.load(recordedf).items()
+            })
+        with open(os.path.join(HERE, "graphql",
+                               "list-branch-pr-expected.json")) as expectedf:
+            self.expected = json.load(expectedf)
+
+    def run_script(self, worker_index, worker_pool_size):
+        self.script.github_token = lambda: "not-a-real-token"
+        self.script.RequestsHTTPTransport = lambda **kwargs: None
+        self.script.Client = lambda **kwargs: contextlib.nullcontext(self.session)
+        self.script.GithubCachedClient = lambda *a, **k: CountingRestClient()
+        args = Namespace(definitions_dir=self.definitions, mesos_role="role",
+                         container_name="container", config_suffix="",
+                         worker_index=worker_index,
+                         worker_pool_size=worker_pool_size,
+                         show_base_branch=False, all_groups=True,
+                         no_status=True, serve=None, daemon=None)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(io.StringIO()):
+            self.script.main(args)
+        return stdout.getvalue().splitlines()
+
+    def test_output_is_unchanged(self):
+        for shard, expected in self.expected.items():
+            worker_index, _, worker_pool_size = shard.split()
+            with self.subTest(shard=shard):
+                self.assertEqual(self.run_script(int(worker_index),
+                                                 int(worker_pool_size)),
+                                 expected)
+
+    def test_one_request_per_run(self):
+        self.run_script(0, 1)
+        self.assertEqual(len(self.session.requests), 1)
+        # Two checks build alisw/alidist; it is asked for once.
+        self.assertEqual(sorted(value for name, value in
+                                self.session.requests[0].variable_values.items()
+                                if name.startswith("name")),
+                         ["AliPhysics", "alidist"])
+
+    def test_many_repos_are_split_into_batches(self):
+        """A query for every repo at once would only grow as checks are added."""
+        repo_branches = [("alisw/repo%d" % i, "master") for i in range(45)]
+        self.session.responses.update((key, {"pullRequests": {"nodes": []}})
+                                      for key in repo_branches)
+        results = self.script.query_repos_info(self.session,
+                                               repo_branches * 2)
+        self.assertEqual(sorted(results), sorted(repo_branches))
+        self.assertEqual(len(self.session.requests), 3)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,406 @@
+"""Tests for ci/process-pull-request-http.py's PR queue and permission checks."""
+
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from s3stub import REPO, load_script
+sys.path.insert(0, REPO)
+
+SERVICE = "ci/process-pull-request-http.py"
+
+try:
+    import klein
+except ImportError:
+    klein = None
+
+
+def wait_until(condition, timeout=10):
+    """Poll condition() until it is true; fail if it takes too long."""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+
+def idle(queue):
+    snapshot = queue.snapshot()
+    return not snapshot["queued"] and not snapshot["in_progress"]
+
+
+@unittest.skipIf(klein is None, "needs Twisted and klein")
+class PrQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script(SERVICE, "process_pull_request_http")
+
+    def make_queue(self, process, workers=4):
+        queue = self.script.PrQueue(process, workers)
+        self.addCleanup(queue.shutdown)
+        return queue
+
+    def test_a_slow_pr_does_not_hold_up_the_others(self):
+        release = threading.Event()
+        done = []
+
+        def process(pr):
+            if pr == "alisw/slow#1":
+                release.wait(10)
+            done.append(pr)
+            return True
+
+        queue = self.make_queue(process)
+        queue.add(["alisw/slow#1"])
+        queue.tick()
+        queue.add(["alisw/fast#%d" % i for i in range(20)])
+        queue.tick()
+        wait_until(lambda: len(done) == 20)
+        self.assertNotIn("alisw/slow#1", done)
+        self.assertEqual(queue.snapshot()["in_progress"], ["alisw/slow#1"])
+        self.assertGreater(queue.running_since(), 0)
+        release.set()
+        wait_until(lambda: idle(queue))
+        self.assertEqual(len(done), 21)
+
+    def test_never_two_workers_on_one_pr(self):
+        lock = threading.Lock()
+        active, overlaps, most = set(), [], [0]
+
+        def process(pr):
+            with lock:
+                if pr in active:
+                    overlaps.append(pr)
+                active.add(pr)
+                most[0] = max(most[0], len(active))
+            time.sleep(0.002)
+            with lock:
+                active.discard(pr)
+            return True
+
+        queue = self.make_queue(process, workers=8)
+        prs = ["alisw/alidist#%d" % i for i in range(5)]
+
+        def flood():
+            for _ in range(100):
+                queue.add(prs)
+                queue.tick()
+
+        flooders = [threading.Thread(target=flood) for _ in range(4)]
+        for thread in flooders:
+            thread.start()
+        for thread in flooders:
+            thread.join()
+        wait_until(lambda: idle(queue))
+        self.assertEqual(overlaps, [])
+        self.assertGreater(most[0], 1, "PRs were never processed concurrently")
+        self.assertLessEqual(most[0], len(prs))
+
+    def test_the_pool_is_bounded(self):
+        lock = threading.Lock()
+        running, most = [0], [0]
+
+        def process(pr):
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            time.sleep(0.005)
+            with lock:
+                running[0] -= 1
+            return True
+
+        queue = self.make_queue(process, workers=3)
+        queue.add(["alisw/alidist#%d" % i for i in range(30)])
+        queue.tick()
+        wait_until(lambda: idle(queue))
+        self.assertEqual(most[0], 3)
+        self.assertEqual(queue.snapshot()["processed"], 30)
+
+    def test_failures_wait_for_the_next_tick(self):
+        attempts = []
+
+        def process(pr):
+            attempts.append(pr)
+            if len(attempts) == 1:
+                raise RuntimeError("GitHub is having a bad day")
+            return True
+
+        queue = self.make_queue(process)
+        queue.add(["alisw/alidist#1"])
+        queue.tick()
+        wait_until(lambda: queue.snapshot()["requeued"] == 1)
+        time.sleep(0.05)
+        self.assertEqual(len(attempts), 1, "retried without waiting")
+        self.assertEqual(queue.snapshot()["queued"], ["alisw/alidist#1"])
+        queue.tick()
+        wait_until(lambda: idle(queue))
+        self.assertEqual(len(attempts), 2)
+        metrics = queue.snapshot()
+        self.assertEqual(metrics["processed"], 2)
+        self.assertGreaterEqual(metrics["latency_max_s"], metrics["latency_avg_s"])
+
+
+# Path rules as found in perms.yml, including awkward ones.
+RULES = [
+    ("^Detectors/TPC/", "tpc-expert approve=tpc1,tpc2 num_approve=2"),
+    ("^Detectors/(ITS|MFT)/", "its-expert approve=its1"),
+    ("CMakeLists\\.txt$", "cmake-expert approve=cm1"),
+    ("\\.md$", "doc-writer approve=doc1"),
+    ("^Framework/Core/src/.*\\.cxx$", "fw1 fw2 approve=fw3"),
+    ("^(Detectors|Steer)/.*/README", "approve=doc1,doc2"),
+    ("[", "approve=broken"),     # invalid: warned about, never matches
+]
+USERS = ["tpc-expert", "its-expert", "cmake-expert", "doc-writer", "fw1", "fw2",
+         "fw3", "tpc1", "tpc2", "its1", "cm1", "doc1", "doc2", "an-admin",
+         "someone"]
+
+
+def write_perms(directory, rules=RULES):
+    """Write perms.yml and friends for one repository to directory."""
+    with open(os.path.join(directory, "perms.yml"), "w") as permsf:
+        permsf.write("alisw/O2:\n  rules:\n")
+        for regexp, auth in rules:
+            permsf.write("    - %s: %s\n" % (json.dumps(regexp), auth))
+    with open(os.path.join(directory, "groups.yml"), "w") as groupsf:
+        groupsf.write("{}\n")
+    with open(os.path.join(directory, "mapusers.yml"), "w") as mapusersf:
+        mapusersf.write("".join("%s: %s\n" % (user, user) for user in USERS))
+
+
+def random_paths(rng, count):
+    """Paths of the kind an O2 pull request changes."""
+    tops = ["Detectors/TPC", "Detectors/ITS", "Detectors/MFT", "Framework/Core",
+            "Steer", "Utilities", "doc"]
+    leaves = ["CMakeLists.txt", "README.md", "src/Foo.cxx", "include/Foo.h",
+              "test/testFoo.cxx", "macro/run.C"]
+    return ["%s/%s%s" % (rng.choice(tops), "sub%d/" % rng.randrange(3)
+                         if rng.random() < 0.5 else "", rng.choice(leaves))
+            for _ in range(count)]
+
+
+def reference_approvers(script, rules, files, who):
+    """The per-file, per-rule loop State.action_check_permissions used to run."""
+    approvers = script.Approvers(users_override=["an-admin"])
+    for fn in files:
+        num_approve_this_file = 1
+        approvers_for_file = set()
+        for rule in rules:
+            num_approve, approve = rule(fn, who)
+            if approve:
+                if num_approve > 0 and num_approve_this_file > 0:
+                    num_approve_this_file = max(num_approve_this_file, num_approve)
+                else:
+                    num_approve_this_file = 0
+                if isinstance(approvers_for_file, bool):
+                    if not approvers_for_file:
+                        approvers_for_file = approve
+                elif isinstance(approve, bool):
+                    approvers_for_file = True
+                else:
+                    approvers_for_file |= approve
+        approvers.push(num_approve_this_file,
+                       approvers_for_file if isinstance(approvers_for_file, bool)
+                       else sorted(approvers_for_file))
+    return approvers
+
+
+@unittest.skipIf(klein is None, "needs Twisted and klein")
+class PermsIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script(SERVICE, "process_pull_request_http")
+        self.script.Approvers.usermap = {}
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        write_perms(self.tmp)
+        self.files = [os.path.join(self.tmp, name) for name in
+                      ("perms.yml", "groups.yml", "mapusers.yml")]
+        self.perms, _, _ = self.script.load_perms(*self.files,
+                                                  admins=["an-admin"])
+        self.rules = self.perms["alisw/O2"]
+
+    def test_matches_like_one_search_per_rule(self):
+        index = self.script.PermsIndex(self.rules)
+        for path in random_paths(random.Random(8), 500):
+            self.assertEqual(index.match(path),
+                             tuple(i for i, rule in enumerate(self.rules)
+                                   if rule.path_match(path)), path)
+
+    def test_plain_prefixes_are_looked_up(self):
+        rules = [self.script.Perms(regexp, [], ["x"], 1) for regexp in (
+            "^Detectors/TPC/", "^Detectors/TPC\\.old/", "^Steer/.*", "^.*$",
+            "^Detectors/TPC/$", "^Detectors/(ITS|MFT)/",
+        )]
+        index = self.script.PermsIndex(rules)
+        self.assertEqual(sorted(index.prefixes), [
+            "", "Detectors/TPC.old/", "Detectors/TPC/", "Steer/",
+        ])
+        self.assertEqual([i for i, _ in index.searched], [4, 5])
+        self.assertEqual(index.match("Detectors/TPC/base/a.cxx"), (0, 3))
+        self.assertEqual(index.match("Detectors/TPC.old/a.cxx"), (1, 3))
+        self.assertEqual(index.match("Detectors/TPCXold/a.cxx"), (3,))
+        self.assertEqual(index.match("Detectors/TPC/"), (0, 3, 4))
+        self.assertEqual(index.match("Detectors/MFT/a.cxx"), (3, 5))
+
+    def test_approvers_are_unchanged(self):
+        rng = random.Random(8)
+        index = self.script.PermsIndex(self.rules)
+        for _ in range(50):
+            files = random_paths(rng, rng.randrange(1, 50))
+            who = rng.choice(USERS)
+            approvers = self.script.Approvers(users_override=["an-admin"])
+            for num_approve, approve in index.approvals(files, who):
+                approvers.push(num_approve, approve if isinstance(approve, bool)
+                               else sorted(approve))
+            expected = reference_approvers(self.script, self.rules, files, who)
+            self.assertEqual(str(approvers), str(expected))
+
+    def test_yaml_is_reread_only_when_it_changes(self):
+        loads = []
+        real_load_perms = self.script.load_perms
+
+        def counting_load_perms(*args, **kwargs):
+            loads.append(args)
+            return real_load_perms(*args, **kwargs)
+
+        self.script.load_perms = counting_load_perms
+        loader = self.script.PermsLoader(*self.files, admins=["an-admin"])
+        first = loader()
+        self.assertIs(loader(), first)
+        self.assertEqual(len(loads), 1)
+
+        write_perms(self.tmp, RULES[:2])
+        stat = os.stat(self.files[0])
+        os.utime(self.files[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        perms, _, _ = loader()
+        self.assertEqual(len(loads), 2)
+        # Two rules, plus the catch-all for admins.
+        self.assertEqual(len(perms["alisw/O2"].rules), 3)
+
+
+class FakeRequest(object):
+    """Just enough of a klein request for the webhook handler."""
+
+    def __init__(self, payload):
+        self.content = io.BytesIO(json.dumps(payload).encode("utf-8"))
+
+
+@unittest.skipIf(klein is None, "needs Twisted and klein")
+class WebhookFloodTestCase(unittest.TestCase):
+    """Many deliveries for the same PRs, processed against MetaGit_Dummy."""
+
+    PRS = 12
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script(SERVICE, "process_pull_request_http")
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmp)    # the service reads its config from the cwd
+        with open("perms.yml", "w") as permsf:
+            permsf.write("alisw/alidist:\n  rules:\n    - '.*': approve=someone\n")
+        for name in ("groups.yml", "mapusers.yml"):
+            with open(name, "w") as ymlf:
+                ymlf.write("{}\n")
+        for num in range(1, self.PRS + 1):
+            os.makedirs(os.path.join("dummy", "alisw", "alidist", str(num)))
+            with open(os.path.join("dummy", "alisw", "alidist", str(num),
+                                   "status.yml"), "w") as statusf:
+                # An empty PR gets a comment, unless its status says it has
+                # had one already -- so processing it twice at once would
+                # comment twice.
+                statusf.write("title: PR %d\nfiles: []\nsha: sha%d\n"
+                              "closed_at: null\nmergeable: true\n"
+                              "author: someone\nwhen: 2024-01-01 00:00:00\n"
+                              % (num, num))
+
+        def new_git():
+            dummy = self.script.MetaGit.init(backend="Dummy", bot_user="alibuild",
+                                             store="dummy")
+            real_get_pull = dummy.get_pull
+
+            def slow_get_pull(*args, **kwargs):
+                time.sleep(0.002)   # widen the window for a race
+                return real_get_pull(*args, **kwargs)
+            dummy.get_pull = slow_get_pull
+            return dummy
+
+        self.rpc = self.script.PrRPC.__new__(self.script.PrRPC)
+        self.rpc.new_git = new_git
+        self.rpc.git = new_git()
+        self.rpc.worker_gits = threading.local()
+        self.rpc.bot_user = "alibuild"
+        self.rpc.admins = ["an-admin"]
+        self.rpc.dryRun = False
+        self.rpc.must_exit = False
+        self.rpc.queue = self.script.PrQueue(self.rpc.process_pull_request, 4)
+        self.rpc.load_perms = self.script.PermsLoader(
+            "perms.yml", "groups.yml", "mapusers.yml", admins=self.rpc.admins)
+        self.addCleanup(self.rpc.queue.shutdown)
+
+    def test_each_pr_is_commented_once(self):
+        for _ in range(10):
+            for num in range(1, self.PRS + 1):
+                self.assertEqual(self.rpc.github_callback(FakeRequest({
+                    "action": "synchronize", "number": num,
+                    "repository": {"full_name": "alisw/alidist"},
+                    "pull_request": {"number": num},
+                })), "roger")
+            self.rpc.queue.tick()
+        wait_until(lambda: idle(self.rpc.queue))
+
+        for num in range(1, self.PRS + 1):
+            pr = "alisw/alidist#%d" % num
+            comments = list(self.rpc.git.get_comments(pr))
+            self.assertEqual(len(comments), 1, pr)
+            self.assertEqual(self.rpc.git.get_status(pr, "review"),
+                             ("error", "empty pull request"))
+        self.assertGreaterEqual(self.rpc.queue.snapshot()["processed"], self.PRS)
+
+    def test_two_prs_of_one_repo_at_once(self):
+        """Workers processing PRs at the same time each use their own MetaGit."""
+        both_started = threading.Barrier(2, timeout=10)
+        used = []   # (thread, MetaGit) of each get_pull()
+        new_git = self.rpc.new_git
+
+        def recording_git():
+            git = new_git()
+            real_get_pull = git.get_pull
+
+            def get_pull_together(*args, **kwargs):
+                used.append((threading.current_thread(), git))
+                both_started.wait()   # neither goes on until both are here
+                return real_get_pull(*args, **kwargs)
+            git.get_pull = get_pull_together
+            return git
+        self.rpc.new_git = recording_git
+
+        self.rpc.queue.add(["alisw/alidist#1", "alisw/alidist#2"])
+        self.rpc.queue.tick()
+        wait_until(lambda: idle(self.rpc.queue))
+
+        self.assertEqual(len(used), 2)
+        (thread1, git1), (thread2, git2) = used
+        self.assertIsNot(thread1, thread2)
+        self.assertIsNot(git1, git2)
+        self.assertNotIn(self.rpc.git, (git1, git2))
+        for num in (1, 2):
+            pr = "alisw/alidist#%d" % num
+            self.assertEqual(len(list(self.rpc.git.get_comments(pr))), 1, pr)
+
+
+if __name__ == "__main__":
+    unittest.main()
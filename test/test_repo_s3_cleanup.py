@@ -0,0 +1,254 @@
+"""Tests for what repo-s3-cleanup decides it may delete, and how it deletes."""
+
+import logging
+import os
+import random
+import sys
+import unittest
+from argparse import Namespace
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from itertools import compress
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from s3stub import FakeS3Client, add_package, load_script, store_key
+
+ARCH = "slc9_x86-64"
+ARCH_PATH = "TARS/%s/" % ARCH
+DISTS = ("dist", "dist-direct", "dist-runtime")
+
+
+def fixed_point_deletable(to_delete, dependencies):
+    """The old find_deletable(): propagate blockers until nothing changes."""
+    dependencies = sorted(dependencies, key=lambda dep: dep[1], reverse=True)
+    blockers = defaultdict(set)
+    converged = False
+    while not converged:
+        converged = True
+        for up, down in dependencies:
+            if up not in to_delete and up not in blockers[down]:
+                blockers[down].add(up)
+                converged = False
+            elif blockers[up] - blockers[down]:
+                blockers[down] |= blockers[up]
+                converged = False
+    return to_delete - {down for down, ups in blockers.items() if ups}
+
+
+def populate(s3, packages, versions, deps, rng):
+    """Fill s3 with packages x versions, each depending on earlier packages.
+
+    Return the store keys of every tarball.
+    """
+    names = ["Pkg%03d" % i for i in range(packages)]
+    tarballs = []
+    for i, name in enumerate(names):
+        for v in range(versions):
+            pick = rng.sample(names[:i], min(i, deps))
+            add_package(s3, ARCH, name, "v%d-1" % v,
+                        deps=[(dep, "v%d-1" % rng.randrange(versions))
+                              for dep in pick])
+            tarballs.append(store_key(ARCH, name, "v%d-1" % v))
+    return tarballs
+
+
+def string_dependencies(s3, tarballs_to_delete):
+    """The old get_keys_for_deletion(), on key strings read straight from s3.
+
+    Return the keys to delete and the (up, down) dependency pairs.
+    """
+    targets = {}
+    dist_dirs = defaultdict(list)
+    for key, (body, _, _) in sorted(s3.objects.items()):
+        parts = key[len(ARCH_PATH):].split("/")
+        if len(parts) == 2:
+            targets[parts[1]] = body.decode("utf-8").strip()
+        elif parts[0] in DISTS:
+            dist_dirs[key.rpartition("/")[0]].append(key)
+    to_delete = set(tarballs_to_delete)
+    dependencies = []
+    for symlink_dir, contents in dist_dirs.items():
+        main = targets["%s.%s.tar.gz" % (os.path.basename(symlink_dir), ARCH)]
+        dependencies.extend((main, targets[os.path.basename(key)])
+                            for key in contents
+                            if targets[os.path.basename(key)] != main)
+        if main in tarballs_to_delete:
+            to_delete.update(contents)
+            dependencies.extend((main, key) for key in contents)
+    return to_delete, dependencies
+
+
+def load_symlinks(script, s3):
+    """Return the symlink table and dist symlinks main() builds for ARCH."""
+    symlinks = script.SymlinkTable()
+    _, dist_symlinks = script.load_architecture(s3, "alibuild-repo", ARCH_PATH,
+                                                symlinks)
+    return symlinks, dist_symlinks
+
+
+def dependencies_from(script, s3, tarballs_to_delete):
+    """Run the part of main() that turns a listing into dependency pairs."""
+    symlinks, dist_symlinks = load_symlinks(script, s3)
+    return script.get_keys_for_deletion(set(tarballs_to_delete),
+                                        dist_symlinks, symlinks)
+
+
+class FindDeletableTestCase(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script("repo-s3-cleanup")
+
+    def check(self, s3, tarballs_to_delete):
+        """Compare find_deletable() with the fixed-point loop; return both
+        what would be deleted and what may be."""
+        to_delete, graph = dependencies_from(self.script, s3,
+                                             tarballs_to_delete)
+        expected_to_delete, pairs = string_dependencies(s3, tarballs_to_delete)
+        self.assertEqual(to_delete, expected_to_delete)
+        expected = fixed_point_deletable(to_delete, pairs)
+        self.assertEqual(self.script.find_deletable(to_delete, graph), expected)
+        return to_delete, expected
+
+    def packages(self, s3, deps, delete):
+        """Add v1 of each package in deps, needing v1 of the packages listed
+        for it; return what check() does when deleting those in delete."""
+        for name, needs in deps.items():
+            add_package(s3, ARCH, name, "v1-1",
+                        deps=[(need, "v1-1") for need in needs])
+        return self.check(s3, [store_key(ARCH, name, "v1-1") for name in delete])
+
+    @staticmethod
+    def owners(keys):
+        """Return the packages owning the given store tarballs and dist
+        symlinks."""
+        return {key.split("/")[3] if key.split("/")[2] in DISTS
+                else os.path.basename(key).split("-")[0] for key in keys}
+
+    def test_generated_buckets(self):
+        for seed in range(5):
+            rng = random.Random(seed)
+            s3 = FakeS3Client()
+            tarballs = populate(s3, 30, 4, 5, rng)
+            for fraction in (0.1, 0.5, 0.9, 1.0):
+                with self.subTest(seed=seed, fraction=fraction):
+                    to_delete, deletable = self.check(
+                        s3, rng.sample(tarballs, int(len(tarballs) * fraction)))
+                    if fraction < 1:
+                        self.assertLess(len(deletable), len(to_delete))
+                    else:
+                        self.assertEqual(deletable, to_delete)
+
+    def test_kept_packages_block_their_whole_tree(self):
+        deps = {"app": ["lib"], "lib": ["base"], "other": ["base"], "base": []}
+        to_delete, deletable = self.packages(FakeS3Client(), deps,
+                                             ["lib", "base", "other"])
+        self.assertEqual(self.owners(to_delete), {"lib", "base", "other"})
+        self.assertEqual(self.owners(deletable), {"other"})
+
+    def test_cycles_among_deleted_keys_do_not_block(self):
+        deps = {"a": ["b"], "b": ["c"], "c": ["a"]}
+        _, deletable = self.packages(FakeS3Client(), deps, ["a", "b", "c"])
+        self.assertEqual(self.owners(deletable), {"a", "b", "c"})
+        _, deletable = self.packages(FakeS3Client(), deps, ["a", "b"])
+        self.assertEqual(deletable, set())
+
+    def test_no_dependencies(self):
+        to_delete, deletable = self.packages(FakeS3Client(),
+                                             {"a": [], "b": []}, ["a", "b"])
+        self.assertEqual(deletable, to_delete)
+        self.assertEqual(self.owners(deletable), {"a", "b"})
+
+    def test_graph_shares_keys_with_symlinks(self):
+        """Keys are interned once; the graph only holds their ids."""
+        rng = random.Random(0)
+        s3 = FakeS3Client()
+        tarballs = populate(s3, 20, 3, 4, rng)
+        symlinks, _ = load_symlinks(self.script, s3)
+        self.assertEqual(len(symlinks), len(tarballs))
+        self.assertEqual(len(symlinks.keys), len(tarballs))
+        deleted = rng.sample(tarballs, 10)
+        to_delete, graph = dependencies_from(self.script, s3, deleted)
+        # Only the dist symlinks of deleted tarballs are added as keys.
+        self.assertEqual(len(graph.keys), len(to_delete - set(deleted))
+                         + len(tarballs))
+        # With nothing deleted, exactly what something needs is blocked.
+        _, pairs = string_dependencies(s3, deleted)
+        self.assertEqual(len(graph), len(pairs))
+        pairs = set(pairs)
+        blocked_by = graph.blocked_by(bytearray(len(graph.keys)))
+        self.assertEqual(blocked_by.itemsize, 4)
+        self.assertEqual({graph.keys[key_id] for key_id, up in enumerate(blocked_by)
+                          if up >= 0}, {down for _, down in pairs})
+        for key_id, up in enumerate(blocked_by):
+            if up >= 0:
+                self.assertIn((graph.keys[up], graph.keys[key_id]), pairs)
+
+
+class ManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def test_both_cleanup_scripts_resolve_the_same_targets(self):
+        s3 = FakeS3Client()
+        versions = ["v%d-1" % v for v in range(5)]
+        for version in versions:
+            add_package(s3, ARCH, "ROOT", version)
+        symlink = "%sROOT/ROOT-%%s.%s.tar.gz" % (ARCH_PATH, ARCH)
+        # Every form of target the publishers have written; v4 is not in the
+        # manifest, and v3's entry is older than the symlink.
+        targets = {
+            "v0-1": store_key(ARCH, "ROOT", "v0-1"),
+            "v1-1": "../../" + store_key(ARCH, "ROOT", "v1-1"),
+            "v2-1": store_key(ARCH, "ROOT", "v2-1")[len("TARS/"):],
+            "v3-1": "../../%s/store/ff/stale/ROOT-v3-1.%s.tar.gz" % (ARCH, ARCH),
+        }
+        for version in versions[:3]:
+            s3.add(symlink % version, targets[version] + "\n")
+        s3.add("%sROOT.manifest" % ARCH_PATH, "".join(
+            "ROOT-%s.%s.tar.gz\t%s\n" % (version, ARCH, target)
+            for version, target in targets.items()))
+
+        script = load_script("repo-s3-cleanup")
+        symlinks, _ = load_symlinks(script, s3)
+        s3.reset_calls()
+        cleanup = load_script("cleanup/repo-s3-cleanup",
+                              "cleanup_repo_s3_cleanup")
+        inventory = cleanup.load_inventory(s3, "alibuild-repo", ARCH, None)
+        # The manifest answers for v0 to v2; v3 and v4 are read.
+        self.assertEqual(s3.calls["get_object"], 3)
+        expected = {symlink % version: store_key(ARCH, "ROOT", version)
+                    for version in versions}
+        self.assertEqual(inventory.targets, expected)
+        flags = symlinks.target_ids_of_packages(["ROOT"])
+        self.assertEqual({symlinks.keys[key_id] for key_id
+                          in compress(range(len(flags)), flags)},
+                         set(expected.values()))
+
+
+class MainTestCase(unittest.TestCase):
+    def test_blocked_tarballs_are_kept(self):
+        """Only what find_deletable() allows is passed to delete_objects()."""
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        script = load_script("repo-s3-cleanup")
+        s3 = FakeS3Client()
+        old = datetime.now(timezone.utc) - timedelta(days=30)
+        add_package(s3, ARCH, "zlib", "v1.2-1", mtime=old)
+        add_package(s3, ARCH, "zlib", "v1.3-1", mtime=old)
+        add_package(s3, ARCH, "ROOT", "v6-30-1", deps=[("zlib", "v1.3-1")])
+        args = Namespace(verbose=False, endpoint_url=None, bucket="alibuild-repo",
+                         architecture_patterns=[], packages=["zlib"],
+                         max_age=7, do_it=True, jobs=2, fetch_concurrency=4)
+        with patch.object(script, "client", lambda *a, **kw: s3), \
+             patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "x",
+                                     "AWS_SECRET_ACCESS_KEY": "y"}):
+            self.assertEqual(script.main(args), 0)
+        self.assertNotIn(store_key(ARCH, "zlib", "v1.2-1"), s3.objects)
+        self.assertIn(store_key(ARCH, "zlib", "v1.3-1"), s3.objects)
+
+
+if __name__ == "__main__":
+    unittest.main()
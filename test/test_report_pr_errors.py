@@ -0,0 +1,115 @@
+"""Tests for what report-pr-errors extracts from build logs."""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from s3stub import REPO, load_script
+sys.path.insert(0, REPO)
+
+# One line for each kind of message grep() looks for, plus lines that must not
+# match anything.
+INTERESTING_LINES = [
+    "foo.cxx:12:3: error: expected ';' before '}' token",
+    "foo.cxx:12:3: fatal error: Killed signal terminated program cc1plus",
+    "foo.cxx:15:1: warning: unused variable 'x'",
+    "Warning: Unused direct dependencies:",
+    "ninja: build stopped: subcommand failed.",
+    "make[2]: *** [all] Error 2",
+    "CMake Error at CMakeLists.txt:10 (find_package):",
+    "Test  #12: o2-test-foo ...............***Failed    0.12 sec",
+    "97% tests passed, 3 tests failed out of 100",
+    "================ List of errors found ================",
+    "================ List of issues found ================",
+    "task timeout reached .. exiting",
+    "Detected critical problem in logfile tpcreco.log",
+    "command o2-sim -n 10 had nonzero exit code 1",
+    "Exception encountered in xrootd copy",
+    "[ERROR] could not open file",
+]
+FILLER = ["-- Configuring done", "[ 12%] Building CXX object foo.o",
+          "Scanning dependencies of target bar", ""]
+
+
+def write_log(path, n_lines, rng, interesting=0.05):
+    """Write a synthetic build log with some interesting lines mixed in."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as logf:
+        for _ in range(n_lines):
+            pool = INTERESTING_LINES if rng.random() < interesting else FILLER
+            logf.write(rng.choice(pool) + "\n")
+
+
+class ScanLogsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.script = load_script("report-pr-errors")
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        rng = random.Random(42)
+        build = os.path.join(self.tmp, "BUILD")
+        self.logs = self.script.Logs.__new__(self.script.Logs)
+        self.logs.limit = 50
+        self.logs.all_logs = []
+        for package in ("zlib", "ROOT", "o2checkcode", "O2", "O2Physics"):
+            path = os.path.join(build, package + "-latest", "log")
+            # Dense enough that context blocks overlap and run into each other.
+            write_log(path, 2000, rng, interesting=0.2)
+            self.logs.all_logs.append(path)
+        # A log that cannot be read must be reported, not abort the scan.
+        broken = os.path.join(build, "broken-latest", "log")
+        os.makedirs(broken)
+        self.logs.all_logs.append(broken)
+        self.logs.important_logs = [p for p in self.logs.all_logs
+                                    if "/O2" in p or "broken" in p]
+
+    def test_every_search_matches_grep_logs(self):
+        found = self.logs.scan_logs(self.script.LOG_SEARCHES)
+        for name, search in self.script.LOG_SEARCHES.items():
+            with self.subTest(search=name):
+                expected = self.logs.grep_logs(
+                    search.regex, search.context_before, search.context_after,
+                    search.main_packages_only, search.ignore_log_files)
+                self.assertTrue(expected, "fixture should match %s" % name)
+                self.assertEqual(found[name], expected)
+
+    def test_grep_sets_the_same_attributes(self):
+        self.logs.grep()
+        for name, search in self.script.LOG_SEARCHES.items():
+            if name == "error_log":
+                continue    # only feeds the preview below
+            self.assertEqual(getattr(self.logs, name), self.logs.grep_logs(
+                search.regex, search.context_before, search.context_after,
+                search.main_packages_only, search.ignore_log_files))
+        self.assertTrue(self.logs.preview_error_log)
+
+    def test_each_file_is_opened_once(self):
+        opened = []
+        real_open = open
+
+        def counting_open(path, *args, **kwargs):
+            opened.append(path)
+            return real_open(path, *args, **kwargs)
+
+        self.script.open = counting_open
+        try:
+            self.logs.scan_logs(self.script.LOG_SEARCHES)
+        finally:
+            del self.script.open
+        self.assertEqual(sorted(opened), sorted(self.logs.all_logs))
+
+    def test_main_packages_listed_twice(self):
+        """grep_logs searches a log twice if it is listed twice; so must we."""
+        self.logs.important_logs = self.logs.important_logs * 2
+        search = self.script.LOG_SEARCHES["warnings_log"]
+        self.assertEqual(
+            self.logs.scan_logs({"w": search})["w"],
+            self.logs.grep_logs(search.regex, search.context_before,
+                                search.context_after, True))
+
+
+if __name__ == "__main__":
+    unittest.main()
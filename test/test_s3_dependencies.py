@@ -0,0 +1,100 @@
+"""Tests for alibot_helpers.s3_dependencies."""
+
+import os
+import sys
+import unittest
+from itertools import compress
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from alibot_helpers.s3_dependencies import (
+    KeyIndex, SymlinkTable, dist_dependencies, find_deletable,
+)
+
+ARCH = "slc9_x86-64"
+
+
+def dist_tree(needs):
+    """Return a symlink table and sorted dist symlinks for v1 of packages.
+
+    needs maps each package name to the names of the packages it needs.
+    """
+    table = SymlinkTable()
+    dist_symlinks = []
+    for name, deps in needs.items():
+        basename = "%s-v1-1.%s.tar.gz" % (name, ARCH)
+        table.add(basename, "TARS/%s/store/%s" % (ARCH, basename), name)
+        dist_symlinks.extend(
+            "TARS/%s/dist/%s/%s-v1-1/%s-v1-1.%s.tar.gz"
+            % (ARCH, name, name, dep, ARCH) for dep in [name] + deps)
+    dist_symlinks.sort()
+    return table, dist_symlinks
+
+
+def store(name):
+    return "TARS/%s/store/%s-v1-1.%s.tar.gz" % (ARCH, name, ARCH)
+
+
+class KeyIndexTestCase(unittest.TestCase):
+    def test_intern_all_matches_intern(self):
+        keys = KeyIndex()
+        self.assertEqual(keys.intern("b"), 0)
+        self.assertEqual(list(keys.intern_all(["c", "b", "a", "c"])),
+                         [1, 0, 2, 1])
+        self.assertEqual(list(keys), ["b", "c", "a"])
+        self.assertEqual(keys.id_of("a"), 2)
+        self.assertIsNone(keys.get("d"))
+        self.assertRaises(KeyError, keys.id_of, "d")
+
+
+class SymlinkTableTestCase(unittest.TestCase):
+    def test_adding_a_basename_again_replaces_it(self):
+        table = SymlinkTable()
+        table.add("A-v1-1.%s.tar.gz" % ARCH, "store/a1", "A")
+        table.add("A-v1-1.%s.tar.gz" % ARCH, "store/a2", "A")
+        self.assertEqual(len(table), 1)
+        flags = table.target_ids_of_packages(["A"])
+        self.assertEqual([table.keys[key_id] for key_id
+                          in compress(range(len(flags)), flags)], ["store/a2"])
+        self.assertEqual(table.package("A-v1-1.%s.tar.gz" % ARCH), "A")
+        self.assertRaises(KeyError, table.package, "B-v1-1.%s.tar.gz" % ARCH)
+
+
+class DependencyGraphTestCase(unittest.TestCase):
+    def test_blocked_by_follows_chains_from_kept_keys(self):
+        table, dist_symlinks = dist_tree(
+            {"a": ["b"], "b": ["c"], "c": [], "d": ["e"], "e": [], "f": ["d"]})
+        _, graph = dist_dependencies(dist_symlinks, table, set())
+        deleting = bytearray(len(graph.keys))
+        for name in "bcde":
+            deleting[graph.keys.id_of(store(name))] = 1
+        blocked_by = graph.blocked_by(deleting)
+        self.assertEqual({graph.keys[key_id]: graph.keys[up]
+                          for key_id, up in enumerate(blocked_by) if up >= 0},
+                         {store("b"): store("a"), store("c"): store("b"),
+                          store("d"): store("f"), store("e"): store("d")})
+
+    def test_dist_dependencies(self):
+        table, dist_symlinks = dist_tree({"A": ["B", "C"], "B": ["C"], "C": []})
+        symlinks, graph = dist_dependencies(dist_symlinks, table, {store("B")})
+        b_symlinks = {key for key in dist_symlinks if "/dist/B/" in key}
+        self.assertEqual(symlinks, b_symlinks)
+        self.assertIs(graph.keys, table.keys)
+        self.assertEqual(len(graph), 3 + len(b_symlinks))
+        # A is kept and needs B, which keeps its dist directory.
+        self.assertEqual(find_deletable({store("B")} | symlinks, graph), set())
+
+    def test_deleted_dist_directories_go_with_their_tarball(self):
+        table, dist_symlinks = dist_tree({"A": ["B", "C"], "B": ["C"], "C": []})
+        for deleted, deletable in (("AB", "AB"), ("BC", ""), ("C", ""),
+                                   ("ABC", "ABC")):
+            tarballs = {store(name) for name in deleted}
+            symlinks, graph = dist_dependencies(dist_symlinks, table, tarballs)
+            self.assertEqual(
+                find_deletable(tarballs | symlinks, graph),
+                {store(name) for name in deletable} |
+                {key for key in dist_symlinks
+                 if key.split("/")[3] in deletable}, deleted)
+
+
+if __name__ == "__main__":
+    unittest.main()
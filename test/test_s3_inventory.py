@@ -0,0 +1,187 @@
+"""Tests for alibot_helpers.s3_inventory."""
+
+import gzip
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from alibot_helpers.s3_inventory import (
+    SNAPSHOT_VERSION, Inventory, list_inventory, load_snapshot,
+    symlink_target_key,
+)
+from s3stub import FakeS3Client, add_package, store_key
+
+ARCH = "slc9_x86-64"
+BUCKET = "alibuild-repo"
+PREFIX = "TARS/%s/" % ARCH
+
+
+def populate(s3, versions=40):
+    """Add a few packages, each version depending on the previous package."""
+    names = ["zlib", "ROOT", "O2"]
+    for i, name in enumerate(names):
+        for v in range(versions):
+            deps = [(names[i - 1], "v%d-1" % v)] if i else []
+            add_package(s3, ARCH, name, "v%d-1" % v, deps=deps)
+    return s3
+
+
+def write_package_manifest(s3, package):
+    """Write <package>.manifest the way update-symlink-manifests does."""
+    start = PREFIX + package + "/"
+    lines = ["%s\t%s" % (key[len(start):], s3.body(key).decode().rstrip("\n"))
+             for key in sorted(s3.objects)
+             if key.startswith(start) and "/" not in key[len(start):]]
+    s3.add(PREFIX + package + ".manifest", "".join(l + "\n" for l in lines))
+
+
+def write_dist_manifest(s3, kind):
+    """Write <kind>.manifest.gz the way update-symlink-manifests does."""
+    start = PREFIX + kind + "/"
+    lines = ["%s\t%s" % (key, s3.body(key).decode().rstrip("\n"))
+             for key in sorted(s3.objects) if key.startswith(start)]
+    s3.add(PREFIX + kind + ".manifest.gz",
+           gzip.compress("".join(l + "\n" for l in lines).encode()))
+
+
+class SymlinkTargetKeyTestCase(unittest.TestCase):
+    def test_target_forms(self):
+        link = PREFIX + "O2/O2-v1-1.%s.tar.gz" % ARCH
+        target = store_key(ARCH, "O2", "v1-1")
+        self.assertEqual(symlink_target_key(link, target + "\n"), target)
+        self.assertEqual(symlink_target_key(link, "../../../" + target), target)
+        self.assertEqual(symlink_target_key(link, target[len("TARS/"):]), target)
+        self.assertEqual(symlink_target_key(link, "../../" + target[len("TARS/"):]),
+                         target)
+
+
+class InventoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.s3 = populate(FakeS3Client())
+        # Something that is neither a tarball, a symlink nor a manifest.
+        self.s3.add(PREFIX + "README")
+
+    def test_one_listing(self):
+        inventory = list_inventory(self.s3, BUCKET, PREFIX)
+        self.assertEqual(self.s3.calls["list_objects_v2"],
+                         -(-len(self.s3.objects) // 1000))
+        self.assertEqual(set(self.s3.calls), {"list_objects_v2"})
+        self.assertEqual(len(inventory.tarballs), 3 * 40)
+        self.assertEqual(len(inventory.symlinks),
+                         3 * 40 + 3 * (40 + 2 * 40 * 2))
+        self.assertEqual(list(inventory.others), [PREFIX + "README"])
+        self.assertEqual(inventory.packages(), ["O2", "ROOT", "zlib"])
+        self.assertEqual(len(inventory.package_symlinks("O2")), 40)
+        self.assertEqual(len(inventory.package_symlinks()), 3 * 40)
+
+    def test_resolve_without_manifests(self):
+        inventory = list_inventory(self.s3, BUCKET, PREFIX)
+        read = inventory.resolve_symlinks(self.s3, workers=8)
+        self.assertEqual(read, len(inventory.symlinks))
+        self.assertEqual(self.s3.calls["get_object"], read)
+        for key, target in inventory.targets.items():
+            self.assertEqual(target, self.s3.body(key).decode().strip())
+            self.assertIn(target, inventory.tarballs)
+
+    def test_resolve_from_manifests(self):
+        for package in ("zlib", "ROOT", "O2"):
+            write_package_manifest(self.s3, package)
+        for kind in ("dist", "dist-direct", "dist-runtime"):
+            write_dist_manifest(self.s3, kind)
+        expected = list_inventory(self.s3, BUCKET, PREFIX)
+        expected.resolve_symlinks(self.s3, use_manifests=False)
+
+        # A symlink changed since its manifest was written is read again.
+        changed = PREFIX + "O2/O2-v3-1.%s.tar.gz" % ARCH
+        self.s3.add(changed, store_key(ARCH, "O2", "v4-1") + "\n")
+        expected.targets[changed] = store_key(ARCH, "O2", "v4-1")
+
+        self.s3.reset_calls()
+        inventory = list_inventory(self.s3, BUCKET, PREFIX)
+        self.assertEqual(inventory.resolve_symlinks(self.s3), 1)
+        # Six manifests and the one changed symlink.
+        self.assertEqual(self.s3.calls["get_object"], 6 + 1)
+        self.assertEqual(inventory.targets, expected.targets)
+
+    def test_resolve_only_reads_relevant_manifests(self):
+        write_package_manifest(self.s3, "O2")
+        write_package_manifest(self.s3, "ROOT")
+        write_dist_manifest(self.s3, "dist")
+        inventory = list_inventory(self.s3, BUCKET, PREFIX)
+        self.s3.reset_calls()
+        self.assertEqual(inventory.resolve_symlinks(
+            self.s3, inventory.package_symlinks("O2")), 0)
+        self.assertEqual(self.s3.calls["get_object"], 1)
+
+    def test_deleted_symlinks_are_dropped(self):
+        inventory = list_inventory(self.s3, BUCKET, PREFIX)
+        gone = inventory.package_symlinks("zlib")[0]
+        self.s3.remove(gone)
+        inventory.resolve_symlinks(self.s3, inventory.package_symlinks("zlib"))
+        self.assertNotIn(gone, inventory.symlinks)
+        self.assertNotIn(gone, inventory.targets)
+        self.assertEqual(len(inventory.targets), 39)
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.s3 = populate(FakeS3Client(), versions=5)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "inventory", "slc9.json.gz")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        inventory = list_inventory(self.s3, BUCKET, PREFIX)
+        inventory.resolve_symlinks(self.s3, inventory.package_symlinks("O2"))
+        inventory.save(self.path)
+        loaded = Inventory.load(self.path)
+        self.assertEqual((loaded.bucket, loaded.prefix, loaded.listed_at),
+                         (BUCKET, PREFIX, inventory.listed_at))
+        for group in ("tarballs", "symlinks", "manifests", "others"):
+            self.assertEqual(
+                {key: (info.size, int(info.mtime.timestamp()), info.etag)
+                 for key, info in getattr(inventory, group).items()},
+                {key: (info.size, int(info.mtime.timestamp()), info.etag)
+                 for key, info in getattr(loaded, group).items()}, group)
+        self.assertEqual(loaded.targets, inventory.targets)
+
+    def test_targets_of_unchanged_symlinks_are_reused(self):
+        previous = list_inventory(self.s3, BUCKET, PREFIX)
+        previous.resolve_symlinks(self.s3, previous.package_symlinks())
+        changed, *_ = previous.package_symlinks("O2")
+        self.s3.add(changed, store_key(ARCH, "O2", "v4-1") + "\n")
+        add_package(self.s3, ARCH, "O2", "v5-1")
+        inventory = list_inventory(self.s3, BUCKET, PREFIX)
+        self.assertEqual(inventory.reuse_targets(previous), 3 * 5 - 1)
+        self.s3.reset_calls()
+        self.assertEqual(inventory.resolve_symlinks(
+            self.s3, inventory.package_symlinks()), 2)
+        self.assertEqual(inventory.targets[changed], store_key(ARCH, "O2", "v4-1"))
+
+    def test_unusable_snapshots(self):
+        list_inventory(self.s3, BUCKET, PREFIX).save(self.path)
+        self.assertIsNotNone(load_snapshot(self.path, BUCKET, PREFIX, 60))
+        self.assertIsNone(load_snapshot(self.path, BUCKET, "TARS/other/", 60))
+        self.assertIsNone(load_snapshot(self.path, "other", PREFIX, 60))
+        self.assertIsNone(load_snapshot(self.path + ".missing", BUCKET, PREFIX, 60))
+
+        stale = list_inventory(self.s3, BUCKET, PREFIX)
+        stale.listed_at = time.time() - 120
+        stale.save(self.path)
+        self.assertIsNone(load_snapshot(self.path, BUCKET, PREFIX, 60))
+
+        with gzip.open(self.path, "wt") as f:
+            f.write('{"version": %d}' % (SNAPSHOT_VERSION + 1))
+        self.assertIsNone(load_snapshot(self.path, BUCKET, PREFIX, 60))
+        with open(self.path, "w") as f:
+            f.write("not gzip")
+        self.assertIsNone(load_snapshot(self.path, BUCKET, PREFIX, 60))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+"""Tests for alibot_helpers.s3_utilities."""
+
+import logging
+import os
+import sys
+import unittest
+
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from alibot_helpers.s3_utilities import delete_objects, fetch_object, fetch_objects
+from s3stub import FakeS3Client, load_script
+
+BUCKET = "alibuild-repo"
+
+
+def slow_down():
+    return ClientError({"Error": {"Code": "SlowDown",
+                                  "Message": "Please reduce your request rate."}},
+                       "GetObject")
+
+
+class FlakyS3Client(FakeS3Client):
+    """Fail the first `failures` reads of each key, and track concurrency."""
+
+    def __init__(self, failures=0, error=slow_down, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.error = error
+        self.failed = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get_object(self, Bucket, Key, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            failed = self.failed.get(Key, 0)
+            self.failed[Key] = failed + 1
+        try:
+            if failed < self.failures:
+                self._request("get_object")
+                raise self.error()
+            return super().get_object(Bucket, Key, **kwargs)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+class FetchObjectsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.keys = ["link-%04d" % i for i in range(500)]
+
+    def populate(self, s3):
+        for key in self.keys:
+            s3.add(key, "target of " + key)
+        return s3
+
+    def test_results_are_in_order(self):
+        s3 = self.populate(FakeS3Client(latency=0.001))
+        keys = list(reversed(self.keys))
+        self.assertEqual(list(fetch_objects(s3, BUCKET, keys, workers=16)),
+                         [(key, b"target of " + key.encode()) for key in keys])
+        self.assertEqual(s3.calls["get_object"], len(keys))
+
+    def test_concurrency_is_bounded(self):
+        s3 = self.populate(FlakyS3Client(latency=0.002))
+        for _ in fetch_objects(s3, BUCKET, iter(self.keys), workers=8):
+            pass
+        self.assertLessEqual(s3.max_in_flight, 8)
+        self.assertGreater(s3.max_in_flight, 1)
+
+    def test_transient_errors_are_retried(self):
+        s3 = self.populate(FlakyS3Client(failures=2))
+        result = dict(fetch_objects(s3, BUCKET, self.keys, backoff=0))
+        self.assertEqual(len(result), len(self.keys))
+        self.assertEqual(s3.calls["get_object"], 3 * len(self.keys))
+
+    def test_persistent_errors_are_raised(self):
+        s3 = self.populate(FlakyS3Client(failures=3))
+        with self.assertRaises(ClientError):
+            list(fetch_objects(s3, BUCKET, self.keys, retries=2, backoff=0))
+
+    def test_other_errors_are_not_retried(self):
+        def denied():
+            return ClientError({"Error": {"Code": "AccessDenied"}}, "GetObject")
+        s3 = self.populate(FlakyS3Client(failures=1, error=denied))
+        with self.assertRaises(ClientError):
+            fetch_object(s3, BUCKET, self.keys[0], backoff=0)
+        self.assertEqual(s3.calls["get_object"], 1)
+
+    def test_missing_objects(self):
+        s3 = self.populate(FakeS3Client())
+        s3.remove(self.keys[1])
+        result = list(fetch_objects(s3, BUCKET, self.keys[:3], missing_ok=True))
+        self.assertEqual([body for _, body in result],
+                         [b"target of link-0000", None, b"target of link-0002"])
+        with self.assertRaises(ClientError):
+            list(fetch_objects(s3, BUCKET, self.keys[:3]))
+
+    def test_stopping_early_leaves_the_rest_unread(self):
+        s3 = self.populate(FakeS3Client(latency=0.001))
+        results = fetch_objects(s3, BUCKET, self.keys, workers=4)
+        next(results)
+        results.close()
+        self.assertLess(s3.calls["get_object"], len(self.keys))
+
+
+
+class FailingS3Client(FakeS3Client):
+    """Refuse to delete some keys, reporting them per key like S3 does."""
+
+    def __init__(self, latency=0, refuse=()):
+        super().__init__(latency)
+        self.refuse = set(refuse)
+        self.batch_sizes = []
+        self.in_flight = self.max_in_flight = 0
+
+    def delete_objects(self, Bucket, Delete):
+        with self._lock:
+            self.batch_sizes.append(len(Delete["Objects"]))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            allowed = [obj for obj in Delete["Objects"]
+                       if obj["Key"] not in self.refuse]
+            response = super().delete_objects(Bucket, {"Objects": allowed})
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        response["Errors"] = [{"Key": obj["Key"], "Code": "AccessDenied",
+                               "Message": "Access Denied"}
+                              for obj in Delete["Objects"]
+                              if obj["Key"] in self.refuse]
+        return response
+
+
+class DeleteObjectsTestCase(unittest.TestCase):
+    """Keys are deleted in concurrent batches of at most 1000, none skipped."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.keys = ["TARS/slc9_x86-64/store/%04d.tar.gz" % i for i in range(3500)]
+
+    def delete(self, s3, to_delete, **kwargs):
+        for key in self.keys:
+            s3.add(key, b"x")
+        ok = delete_objects(s3, BUCKET, to_delete, **kwargs)
+        return ok, set(self.keys) - set(s3.objects)
+
+    def test_exactly_the_given_keys_are_deleted(self):
+        to_delete = set(self.keys[:1000] + self.keys[1500:3001])
+        s3 = FailingS3Client()
+        ok, deleted = self.delete(s3, to_delete, do_it=True)
+        self.assertTrue(ok)
+        self.assertEqual(deleted, to_delete)
+        self.assertEqual(sorted(s3.batch_sizes), [501, 1000, 1000])
+
+    def test_dry_run_deletes_nothing(self):
+        s3 = FailingS3Client()
+        ok, deleted = self.delete(s3, set(self.keys))
+        self.assertTrue(ok)
+        self.assertEqual(deleted, set())
+        self.assertEqual(s3.calls["delete_objects"], 0)
+
+    def test_per_key_errors_fail_without_stopping(self):
+        refuse = {self.keys[10], self.keys[2999]}
+        s3 = FailingS3Client(refuse=refuse)
+        ok, deleted = self.delete(s3, set(self.keys), do_it=True)
+        self.assertFalse(ok)
+        self.assertEqual(deleted, set(self.keys) - refuse)
+
+    def test_batches_run_concurrently(self):
+        s3 = FailingS3Client(latency=0.05)
+        ok, _ = self.delete(s3, set(self.keys), do_it=True, workers=3)
+        self.assertTrue(ok)
+        self.assertEqual(s3.max_in_flight, 3)
+
+    def test_both_cleanup_scripts_use_it(self):
+        for script in ("repo-s3-cleanup", "cleanup/repo-s3-cleanup"):
+            with self.subTest(script=script):
+                self.assertIs(load_script(script).delete_objects, delete_objects)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,269 @@
+"""Tests for the manifests update-symlink-manifests writes."""
+
+import gzip
+import logging
+import os
+import sys
+import unittest
+from argparse import Namespace
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from s3stub import FakeS3Client, add_package, load_script, store_key
+
+ARCH = "slc9_x86-64"
+BUCKET = "alibuild-repo"
+
+
+class NotIterable(frozenset):
+    """A set of store tarballs that may be queried, but not walked."""
+
+    def __iter__(self):
+        raise AssertionError("the store listing was scanned")
+
+
+def big_package(s3, versions):
+    """Upload many versions of O2 and return their expected dist symlinks.
+
+    The result maps each TARS/<arch>/dist/O2/O2-<version>/ directory to the
+    symlinks it should contribute to the dist manifest, which is nothing if
+    the directory is not complete yet.
+    """
+    add_package(s3, ARCH, "zlib", "v1.3-1")
+    expected = {}
+    for i in range(versions):
+        version = "v%d-1" % i
+        add_package(s3, ARCH, "O2", version, deps=[("zlib", "v1.3-1")])
+        path = "TARS/%s/dist/O2/O2-%s/" % (ARCH, version)
+        expected[path] = {
+            path + "%s-%s.%s.tar.gz" % (name, ver, ARCH): store_key(ARCH, name, ver)
+            for name, ver in (("O2", version), ("zlib", "v1.3-1"))
+        }
+    # Still uploading: the store tarball comes last...
+    s3.remove(store_key(ARCH, "O2", "v1-1"))
+    expected["TARS/%s/dist/O2/O2-v1-1/" % ARCH] = {}
+    # ...and the dist directory is not complete either.
+    s3.remove("TARS/%s/dist/O2/O2-v2-1/O2-v2-1.%s.tar.gz" % (ARCH, ARCH))
+    expected["TARS/%s/dist/O2/O2-v2-1/" % ARCH] = {}
+    return expected
+
+
+class DistSymlinksTestCase(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script("update-symlink-manifests")
+        self.s3 = FakeS3Client()
+
+    def store(self):
+        tarballs = frozenset(self.script.list_files(
+            self.s3, BUCKET, "TARS/%s/store/" % ARCH, recursive=True))
+        return NotIterable(tarballs), frozenset(map(os.path.basename, tarballs))
+
+    def test_big_package(self):
+        expected = big_package(self.s3, 10000)
+        store_tarballs, store_basenames = self.store()
+        for path, symlinks in expected.items():
+            self.assertEqual(self.script.get_dist_symlinks_for_package(
+                self.s3, BUCKET, path, store_tarballs, store_basenames,
+            ), symlinks, path)
+
+    def test_missing_dependency(self):
+        """A symlink pointing to a tarball not in the store rejects its dir."""
+        add_package(self.s3, ARCH, "ROOT", "v6-1", deps=[("zlib", "v1.3-1")])
+        store_tarballs, store_basenames = self.store()
+        self.assertEqual(self.script.get_dist_symlinks_for_package(
+            self.s3, BUCKET, "TARS/%s/dist/ROOT/ROOT-v6-1/" % ARCH,
+            store_tarballs, store_basenames,
+        ), {})
+
+
+class PackageManifestTestCase(unittest.TestCase):
+    PACKAGE = "TARS/%s/O2/" % ARCH
+    MANIFEST = "TARS/%s/O2.manifest" % ARCH
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script("update-symlink-manifests")
+        self.s3 = FakeS3Client()
+        for i in range(50):
+            add_package(self.s3, ARCH, "O2", "v%d-1" % i)
+
+    def run_once(self, read_only=False):
+        self.s3.reset_calls()
+        self.script.build_package_manifest(self.s3, BUCKET, self.PACKAGE,
+                                           read_only)
+        return self.s3.calls["get_object"], self.s3.calls["put_object"]
+
+    def manifest(self):
+        return dict(line.split("\t") for line in
+                    self.s3.body(self.MANIFEST).decode().splitlines())
+
+    def expected(self):
+        return {key[len(self.PACKAGE):]: self.s3.body(key).decode().rstrip("\n")
+                for key in self.s3.objects if key.startswith(self.PACKAGE)}
+
+    def test_second_run_reads_and_writes_nothing_new(self):
+        self.assertEqual(self.run_once(), (1 + 50, 1))
+        self.assertEqual(self.manifest(), self.expected())
+        self.assertEqual(self.run_once(), (1, 0))
+
+    def test_only_new_and_changed_symlinks_are_read(self):
+        self.run_once()
+        add_package(self.s3, ARCH, "O2", "v50-1")
+        changed = self.PACKAGE + "O2-v3-1.%s.tar.gz" % ARCH
+        self.s3.add(changed, "TARS/%s/store/00/0000/O2-v3-1.%s.tar.gz\n"
+                    % (ARCH, ARCH))
+        self.assertEqual(self.run_once(), (1 + 2, 1))
+        self.assertEqual(self.manifest(), self.expected())
+        self.assertEqual(self.run_once(), (1, 0))
+
+    def test_line_endings_are_not_changes(self):
+        """The manifest drops trailing newlines; their ETag must still match."""
+        self.run_once()
+        key = self.PACKAGE + "O2-v3-1.%s.tar.gz" % ARCH
+        for ending in (b"", b"\r\n"):
+            self.s3.add(key, self.s3.body(key).rstrip(b"\r\n") + ending)
+            self.assertEqual(self.run_once(), (1, 0))
+
+    def test_changed_symlinks_are_read_again(self):
+        self.run_once()
+        key = self.PACKAGE + "O2-v3-1.%s.tar.gz" % ARCH
+        self.s3.add(key, b"../../store/00/0000/O2-v3-1.tar.gz")
+        self.assertEqual(self.run_once(), (2, 1))
+        self.assertEqual(self.manifest(), self.expected())
+
+    def test_deleted_symlinks_stay_in_the_manifest(self):
+        """Revision numbers must never be reused, even if a tarball is gone."""
+        self.run_once()
+        gone = "O2-v3-1.%s.tar.gz" % ARCH
+        self.s3.remove(self.PACKAGE + gone)
+        self.assertEqual(self.run_once(), (1, 0))
+        self.assertIn(gone, self.manifest())
+
+    def test_read_only(self):
+        self.assertEqual(self.run_once(read_only=True), (1 + 50, 0))
+        self.assertNotIn(self.MANIFEST, self.s3.objects)
+
+
+
+class DistManifestTestCase(unittest.TestCase):
+    DIST = "TARS/%s/dist/" % ARCH
+    MANIFEST = "TARS/%s/dist.manifest.gz" % ARCH
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script("update-symlink-manifests")
+        self.s3 = FakeS3Client()
+        add_package(self.s3, ARCH, "zlib", "v1.3-1")
+        for i in range(100):
+            add_package(self.s3, ARCH, "O2", "v%d-1" % i,
+                        deps=[("zlib", "v1.3-1")])
+
+    def run_once(self, read_only=False):
+        """Return the (LIST, GET, PUT) requests made building the manifest."""
+        store_tarballs = frozenset(self.script.list_files(
+            self.s3, BUCKET, "TARS/%s/store/" % ARCH, recursive=True))
+        self.s3.reset_calls()
+        self.script.build_dist_manifest(
+            self.s3, BUCKET, store_tarballs,
+            frozenset(map(os.path.basename, store_tarballs)), self.DIST,
+            read_only)
+        return (self.s3.calls["list_objects_v2"], self.s3.calls["get_object"],
+                self.s3.calls["put_object"])
+
+    def manifest(self):
+        return dict(line.split("\t") for line in gzip.decompress(
+            self.s3.body(self.MANIFEST)).decode().splitlines())
+
+    def expected(self, incomplete=()):
+        return {key: self.s3.body(key).decode().rstrip("\n")
+                for key in self.s3.objects if key.startswith(self.DIST)
+                and os.path.dirname(key) + "/" not in incomplete}
+
+    def test_second_run_reads_and_writes_nothing_new(self):
+        symlinks = 1 + 100 * 2
+        self.assertEqual(self.run_once(), (1, 1 + symlinks, 1))
+        self.assertEqual(self.manifest(), self.expected())
+        self.assertEqual(self.run_once(), (1, 1, 0))
+
+    def test_only_new_and_changed_symlinks_are_read(self):
+        self.run_once()
+        add_package(self.s3, ARCH, "O2", "v100-1", deps=[("zlib", "v1.3-1")])
+        changed = self.DIST + "O2/O2-v3-1/zlib-v1.3-1.%s.tar.gz" % ARCH
+        self.s3.add(changed, "../../" + store_key(ARCH, "zlib", "v1.3-1"))
+        self.assertEqual(self.run_once(), (1, 1 + 2 + 1, 1))
+        self.assertEqual(self.manifest(), self.expected())
+        self.assertEqual(self.run_once(), (1, 1, 0))
+
+    def test_incomplete_directories_are_added_once_complete(self):
+        self.s3.remove(store_key(ARCH, "O2", "v5-1"))
+        incomplete = self.DIST + "O2/O2-v5-1/"
+        self.run_once()
+        self.assertEqual(self.manifest(), self.expected([incomplete]))
+        add_package(self.s3, ARCH, "O2", "v5-1", deps=[("zlib", "v1.3-1")])
+        self.assertEqual(self.run_once(), (1, 1 + 2, 1))
+        self.assertEqual(self.manifest(), self.expected())
+
+    def test_removed_directories_are_dropped(self):
+        self.run_once()
+        for key in list(self.s3.objects):
+            if "O2-v7-1" in key:
+                self.s3.remove(key)
+        self.s3.remove(store_key(ARCH, "O2", "v8-1"))
+        self.assertEqual(self.run_once(), (1, 1, 1))
+        self.assertEqual(self.manifest(), self.expected(
+            [self.DIST + "O2/O2-v8-1/"]))
+
+    def test_read_only(self):
+        self.assertEqual(self.run_once(read_only=True)[2], 0)
+        self.assertNotIn(self.MANIFEST, self.s3.objects)
+
+
+
+class MainTestCase(unittest.TestCase):
+    ARCHS = ARCH, "ubuntu2404_x86-64"
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.script = load_script("update-symlink-manifests")
+        self.s3 = FakeS3Client()
+        for arch in self.ARCHS:
+            add_package(self.s3, arch, "zlib", "v1.3-1")
+            for i in range(20):
+                add_package(self.s3, arch, "O2", "v%d-1" % i,
+                            deps=[("zlib", "v1.3-1")])
+
+    def run_main(self):
+        args = Namespace(verbose=0, read_only=False, download_threads=4,
+                         fetch_concurrency=8, store_prefix="TARS/",
+                         architectures="*", s3_bucket=BUCKET,
+                         s3_endpoint_url=None)
+        self.s3.reset_calls()
+        with patch.object(self.script, "create_s3_client",
+                          return_value=self.s3), \
+             patch.object(self.script, "setup_logging"):
+            self.script.main(args)
+
+    def test_each_architecture_is_listed_once(self):
+        self.run_main()
+        # One request for the architectures, then one page for each.
+        self.assertEqual(self.s3.calls["list_objects_v2"], 1 + len(self.ARCHS))
+        for arch in self.ARCHS:
+            prefix = "TARS/%s/" % arch
+            self.assertEqual(
+                len(self.s3.body(prefix + "O2.manifest").splitlines()), 20)
+            dist = gzip.decompress(self.s3.body(prefix + "dist.manifest.gz"))
+            self.assertEqual(len(dist.splitlines()), 1 + 20 * 2)
+
+    def test_second_run_writes_nothing(self):
+        self.run_main()
+        self.run_main()
+        self.assertEqual(self.s3.calls["put_object"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()